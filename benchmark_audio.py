@@ -0,0 +1,50 @@
+# coding: utf-8
+"""
+Benchmark audio feature extraction
+
+usage: benchmark_audio.py [options] <wav_path>...
+
+options:
+    --repeat=<n>             Number of repetitions per file [default: 5].
+    -h, --help               Show help message.
+"""
+
+from docopt import docopt
+import time
+import numpy as np
+import data.audio as audio
+
+
+def _time(f, wavs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for wav in wavs:
+            f(wav)
+    return (time.perf_counter() - start) / (repeat * len(wavs))
+
+
+def separate(wav):
+    return audio.spectrogram(wav).astype(np.float32), audio.melspectrogram(wav).astype(np.float32)
+
+
+def combined(wav):
+    return audio.spectrograms(wav)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    repeat = int(args["--repeat"])
+    wavs = [audio.load_wav(path) for path in args["<wav_path>"]]
+
+    for wav in wavs:
+        spec, mel = separate(wav)
+        spec2, mel2 = combined(wav)
+        assert spec2.dtype == np.float32 and mel2.dtype == np.float32
+        np.testing.assert_allclose(spec, spec2, atol=1e-4)
+        np.testing.assert_allclose(mel, mel2, atol=1e-4)
+
+    separate_time = _time(separate, wavs, repeat)
+    combined_time = _time(combined, wavs, repeat)
+    print("spectrogram + melspectrogram: %.2f ms/utterance" % (separate_time * 1000))
+    print("spectrograms:                 %.2f ms/utterance" % (combined_time * 1000))
+    print("speedup: %.2fx" % (separate_time / combined_time))
@@ -0,0 +1,204 @@
+# coding: utf-8
+"""
+Benchmark the Frontend input pipeline of train.py or eval.py without the model
+
+usage: benchmark_input_pipeline.py [options] [<data-root>]
+
+options:
+    --dataset=<name>         Dataset name [default: jsut].
+    --hparams=<parmas>       Hyper parameters [default: ].
+    --mode=<mode>            Pipeline to benchmark, train or eval [default: train].
+    --num-batches=<n>        Number of measured batches [default: 100].
+    --warmup=<n>             Number of batches before measurement [default: 10].
+    --per-stage              Measure latency of every stage of the pipeline.
+    --synthetic=<n>          Benchmark n synthetic utterances instead of a corpus.
+    --synthetic-shard-size=<n>  Utterances per synthetic TFRecord shard [default: 100].
+    --materialize            Read targets materialized like train.py --materialize. Train mode only.
+    --cache-dir=<dir>        Cache prepared utterances like train.py --cache-dir. Train mode only.
+    --cache-in-memory        Cache prepared utterances in memory like train.py --cache-in-memory. Train mode only.
+    -h, --help               Show help message.
+"""
+
+from docopt import docopt
+import importlib
+import os
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from deepvoice3_tensorflow.frontend import TRAIN_SEQ2SEQ
+from deepvoice3_tensorflow.frontend.bucketing import bucket_boundaries_from_metadata
+from deepvoice3_tensorflow.frontend.pipeline import train_frontend, eval_frontend, train_stages, eval_stages, \
+    apply_stages, materialized_train_targets, train_cache_filename
+from deepvoice3_tensorflow.frontend.cache import remove_stale_lock
+from data.tfrecord_utils import ShardedTFRecordWriter, preprocessed_source_example2, preprocessed_target_example, \
+    read_shard_index, shard_files, shard_index_filename
+from hparams import hparams, hparams_debug_string
+
+
+def write_synthetic_corpus(out_dir, num_utterances, hparams, shard_size, seed=0):
+    '''
+    Writes random sources and targets with lengths like JSUT utterances.
+    :return: source files and target files
+    '''
+    random = np.random.RandomState(seed)
+    with ShardedTFRecordWriter(out_dir, "synthetic-source", shard_size) as source_writer, \
+            ShardedTFRecordWriter(out_dir, "synthetic-target", shard_size) as target_writer:
+        for id in range(1, num_utterances + 1):
+            source_length = random.randint(20, 150)
+            source = random.randint(1, 0x3000, size=source_length).astype(np.int64)
+            text = "".join(chr(c) for c in source[:-1])
+            source_writer.write(id, preprocessed_source_example2(id, text, source, text, source).SerializeToString())
+            target_length = random.randint(100, 800)
+            spec = random.uniform(size=(target_length, hparams.fft_size // 2 + 1)).astype(np.float32)
+            mel = random.uniform(size=(target_length, hparams.num_mels)).astype(np.float32)
+            target_writer.write(id, preprocessed_target_example(id, spec, mel).SerializeToString())
+    return [shard_files(read_shard_index(os.path.join(out_dir, shard_index_filename(prefix))), out_dir) for prefix in
+            ["synthetic-source", "synthetic-target"]]
+
+
+def _dataset(view):
+    # the prepared view keeps sources and targets apart until they are zipped
+    return view.dataset if hasattr(view, "dataset") else tf.data.Dataset.zip((view.source, view.target))
+
+
+def _num_utterances(target):
+    if hasattr(target, "segment_ids"):
+        # packed rows
+        return int(np.sum(np.max(np.atleast_2d(target.segment_ids), axis=1)))
+    return 1 if np.ndim(target.id) == 0 else len(target.id)
+
+
+def _measure(make_dataset, num_elements, warmup, on_element=None):
+    '''
+    :return: seconds, number of elements and number of utterances of the measured elements
+    '''
+    with tf.Graph().as_default():
+        next_element = make_dataset().make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            try:
+                for _ in range(warmup):
+                    sess.run(next_element)
+            except tf.errors.OutOfRangeError:
+                raise ValueError("the pipeline has fewer elements than --warmup")
+            elements = 0
+            utterances = 0
+            start = time.perf_counter()
+            try:
+                for _ in range(num_elements):
+                    _, target = sess.run(next_element)
+                    elements += 1
+                    utterances += _num_utterances(target)
+                    if on_element is not None:
+                        on_element(target)
+            except tf.errors.OutOfRangeError:
+                pass
+            return time.perf_counter() - start, elements, utterances
+
+
+def benchmark(make_frontend, stages, hparams, num_batches, warmup):
+    frames = {"real": 0, "padded": 0}
+
+    def count_frames(target):
+        # mel of finished batches is downsampled
+        frames["real"] += int(np.sum(target.target_length))
+        frames["padded"] += target.mel.shape[0] * target.mel.shape[1] * hparams.downsample_step
+
+    seconds, batches, utterances = _measure(lambda: apply_stages(make_frontend(), stages), num_batches, warmup,
+                                            count_frames)
+    print("batches:          %d" % batches)
+    print("examples/sec:     %.1f" % (utterances / seconds))
+    print("frames/sec:       %.1f" % (frames["real"] / seconds))
+    print("batches/sec:      %.2f" % (batches / seconds))
+    print("padding ratio:    %.3f" % (1.0 - frames["real"] / max(frames["padded"], 1)))
+
+
+def benchmark_stages(make_frontend, stages, num_utterances, warmup):
+    '''
+    Measures pipelines truncated after every stage.
+    The latency of a stage is the difference of time per utterance from the pipeline before it.
+    '''
+
+    def decoded():
+        frontend = make_frontend()
+        return tf.data.Dataset.zip((frontend._decode_source(), frontend._decode_target())).repeat()
+
+    def truncated(n):
+        return lambda: _dataset(apply_stages(make_frontend(), stages[:n])).repeat()
+
+    pipelines = [("decode", decoded)] + [(name, truncated(n + 1)) for n, (name, _) in enumerate(stages)]
+    print("stage              total ms/utterance   stage ms/utterance")
+    previous = 0.0
+    for name, make_dataset in pipelines:
+        seconds, _, utterances = _measure(make_dataset, num_utterances, warmup)
+        total = seconds * 1000 / max(utterances, 1)
+        print("%-18s %18.3f %20.3f" % (name, total, total - previous))
+        previous = total
+
+
+def main():
+    args = docopt(__doc__)
+    hparams.parse(args["--hparams"])
+    mode = args["--mode"]
+    assert mode in ["train", "eval"]
+    assert mode == "train" or not (args["--materialize"] or args["--cache-dir"] or args["--cache-in-memory"]), \
+        "--materialize and caches only apply to --mode=train"
+    assert not (args["--materialize"] and args["--synthetic"]), "--materialize requires <data-root>"
+    if mode == "eval":
+        # eval.py evaluates the seq2seq model, so linear spectrograms are not loaded
+        hparams.train_mode = TRAIN_SEQ2SEQ
+    print(hparams_debug_string())
+    num_batches = int(args["--num-batches"])
+    warmup = int(args["--warmup"])
+
+    bucket_boundaries = None
+    target_store = None
+    spec_files = None
+    materialized_dir = None
+    if args["--synthetic"]:
+        temp_dir = tempfile.TemporaryDirectory()
+        source_files, target_files = write_synthetic_corpus(temp_dir.name, int(args["--synthetic"]), hparams,
+                                                            int(args["--synthetic-shard-size"]))
+    else:
+        data_root = args["<data-root>"]
+        assert data_root is not None, "<data-root> is required without --synthetic"
+        dataset = importlib.import_module("data." + args["--dataset"])
+        dataset_instance = dataset.instantiate(in_dir="", out_dir=data_root)
+        source_files = list(dataset_instance.source_files)
+        target_files = list(dataset_instance.target_files)
+        target_store = dataset_instance.packed_target_store
+        spec_files = dataset_instance.spec_files
+        spec_files = None if spec_files is None else list(spec_files)
+        if mode == "train" and hparams.bucket_by_metadata:
+            bucket_boundaries = bucket_boundaries_from_metadata(data_root, hparams)
+        if args["--materialize"]:
+            materialized_dir = materialized_train_targets(data_root, source_files, target_files, hparams,
+                                                          target_store, spec_files)
+
+    cache_filename = None
+    if args["--cache-in-memory"]:
+        cache_filename = ""
+    elif args["--cache-dir"]:
+        cache_filename = train_cache_filename(args["--cache-dir"], source_files, target_files, hparams, target_store,
+                                              spec_files, materialized_dir)
+        print("Caching prepared utterances at %s" % cache_filename)
+
+    if mode == "train":
+        stages = train_stages(hparams, bucket_boundaries, cache_filename)
+
+        def make_frontend():
+            if cache_filename:
+                # measurements stop reading before the end of the cache and leave its lock behind
+                remove_stale_lock(cache_filename)
+            return train_frontend(source_files, target_files, hparams, target_store, spec_files, materialized_dir)
+    else:
+        stages = eval_stages(hparams)
+        make_frontend = lambda: eval_frontend(source_files, target_files, hparams, target_store, spec_files)
+
+    benchmark(make_frontend, stages, hparams, num_batches, warmup)
+    if args["--per-stage"]:
+        benchmark_stages(make_frontend, stages, num_batches * hparams.batch_size, warmup)
+
+
+if __name__ == "__main__":
+    main()
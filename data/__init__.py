@@ -17,6 +17,9 @@ class TargetMetaData(collections.namedtuple("TargetMetaData", ["id", "filename",
 class SourceMetaData(collections.namedtuple("SourceMetaData", ["id", "filename", "text", "text_length", "source_length", "text2", "text2_length", "source2_length"])):
     pass
 
+class ShardIndexEntry(collections.namedtuple("ShardIndexEntry", ["id", "filename", "offset", "length"])):
+    pass
+
 # https://github.com/tqdm/tqdm/blob/master/examples/tqdm_wget.py
 class TqdmUpTo(tqdm):
     """Alternative Class-based version of the above.
@@ -25,18 +25,46 @@ def melspectrogram(y):
     return _normalize(S)
 
 
+def spectrograms(y):
+    '''
+    Computes the linear and the mel spectrogram from a single STFT.
+    :param y: waveform, which is processed in float32
+    :return: (linear spectrogram, mel spectrogram) as float32 arrays with shape (num_freq, T) and (num_mels, T)
+    '''
+    # preemphasis filters with float64 coefficients, so its output is cast back before the STFT
+    y = preemphasis(np.asarray(y, dtype=np.float32)).astype(np.float32)
+    D = _lws_processor_cached().stft(y).T
+    magnitude = np.abs(D).astype(np.float32)
+    S = _amp_to_db(magnitude) - hparams.ref_level_db
+    M = _amp_to_db(_linear_to_mel(magnitude, _mel_basis_float32)) - hparams.ref_level_db
+    if not hparams.allow_clipping_in_normalization:
+        assert M.max() <= 0 and M.min() - hparams.min_level_db >= 0
+    # python scalars do not promote float32 arrays, so both features stay float32
+    return _normalize(S), _normalize(M)
+
+
 def _lws_processor():
     return lws.lws(hparams.fft_size, hparams.hop_size, mode="speech")
 
 
+_lws_cache = {}
+
+def _lws_processor_cached():
+    key = (hparams.fft_size, hparams.hop_size)
+    if key not in _lws_cache:
+        _lws_cache[key] = _lws_processor()
+    return _lws_cache[key]
+
+
 def _build_mel_basis():
     assert hparams.fmax <= hparams.sample_rate // 2
     return librosa.filters.mel(hparams.sample_rate, hparams.fft_size, fmin=hparams.fmin, fmax=hparams.fmax, n_mels=hparams.num_mels)
 
 _mel_basis = _build_mel_basis()
+_mel_basis_float32 = _mel_basis.astype(np.float32)
 
-def _linear_to_mel(spectrogram):
-    return np.dot(_mel_basis, spectrogram)
+def _linear_to_mel(spectrogram, mel_basis=_mel_basis):
+    return np.dot(mel_basis, spectrogram)
 
 def _amp_to_db(x):
     return 20 * np.log10(np.maximum(1e-5, x + 0.01))
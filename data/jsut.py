@@ -10,11 +10,18 @@ from concurrent.futures import ProcessPoolExecutor
 from nnmnkwii.datasets import jsut
 from nnmnkwii.io import hts
 from hparams import hparams
-from data.tfrecord_utils import write_preprocessed_target_data, write_preprocessed_source_data2
+from data.tfrecord_utils import write_tfrecord, preprocessed_target_example, preprocessed_source_example2, \
+    preprocessed_mel_example, preprocessed_spec_example, \
+    ShardedTFRecordWriter, read_shard_index, shard_files, shard_index_filename, read_tfrecord_at, STORAGE_FLOAT32
+from data.packed_store import PackedFeatureWriter, PackedFeatureStore, packed_data_filename
+from data.parallel import imap, imap_unordered
+from data.manifest import PreprocessManifest, hparams_hash, text_hash, AUDIO_HPARAMS, TEXT_HPARAMS
 from data import TqdmUpTo, TargetMetaData, SourceMetaData, SOURCE_AND_TARGET, SOURCE_ONLY, TARGET_ONLY
 from janome.tokenizer import Tokenizer
 import jaconv
 from typing import List
+from collections import namedtuple
+from itertools import groupby
 
 n_vocab = 0xffff
 _eos = 1
@@ -106,21 +113,37 @@ def sequence_to_text(seq):
     return "".join(chr(n) for n in seq)
 
 
-def _process_text(out_dir, index, text):
+def _source_example(index, text):
     sequence, text1 = text_to_sequence(text, index, mix=False)
     sequence = np.array(sequence, dtype=np.int64)
     sequence_mixed, text2 = text_to_sequence(text, index, mix=True)
     sequence_mixed = np.array(sequence_mixed, dtype=np.int64)
     filename = 'jsut-source-%05d.tfrecords' % index
-    write_preprocessed_source_data2(index, text1, sequence, text2, sequence_mixed, os.path.join(out_dir, filename))
-    return SourceMetaData(index, filename, text1, len(text1), len(sequence), text2, len(text2), len(sequence_mixed))
+    example = preprocessed_source_example2(index, text1, sequence, text2, sequence_mixed)
+    return SourceMetaData(index, filename, text1, len(text1), len(sequence), text2, len(text2),
+                          len(sequence_mixed)), example
+
+
+def _process_text(out_dir, index, text):
+    metadata, example = _source_example(index, text)
+    write_tfrecord(example, os.path.join(out_dir, metadata.filename))
+    return metadata
+
+
+def _process_text_record(index, text):
+    metadata, example = _source_example(index, text)
+    return metadata, [example.SerializeToString()]
 
 
-def _process_audio(out_dir, index, wav_path):
+def _lab_path(wav_path):
+    return wav_path.replace("wav/", "lab/").replace(".wav", ".lab")
+
+
+def _target_features(index, wav_path):
     sr = hparams.sample_rate
     # Load the audio to a numpy array:
     wav = audio.load_wav(wav_path)
-    lab_path = wav_path.replace("wav/", "lab/").replace(".wav", ".lab")
+    lab_path = _lab_path(wav_path)
 
     # Trim silence from hts labels if available
     if os.path.exists(lab_path):
@@ -136,19 +159,104 @@ def _process_audio(out_dir, index, wav_path):
     if hparams.rescaling:
         wav = wav / np.abs(wav).max() * hparams.rescaling_max
 
-    # Compute the linear-scale spectrogram from the wav:
-    spectrogram = audio.spectrogram(wav).astype(np.float32)
+    # Compute the linear-scale and mel-scale spectrograms from a single STFT of the wav:
+    spectrogram, mel_spectrogram = audio.spectrograms(wav)
     n_frames = spectrogram.shape[1]
 
-    # Compute a mel-scale spectrogram from the wav:
-    mel_spectrogram = audio.melspectrogram(wav).astype(np.float32)
+    filename = 'jsut-target-%05d.tfrecords' % index
+
+    # Return a tuple describing this training example and its (T, F) features:
+    return TargetMetaData(index, filename, n_frames), spectrogram.T, mel_spectrogram.T
+
 
+def _target_examples(index, wav_path, storage_format, split_spec):
+    '''
+    :return: metadata and either a combined target example or a mel example and a linear spectrogram example
+    '''
+    metadata, spec, mel = _target_features(index, wav_path)
+    if split_spec:
+        return metadata, [preprocessed_mel_example(index, mel, storage_format),
+                          preprocessed_spec_example(index, spec, storage_format)]
+    return metadata, [preprocessed_target_example(index, spec, mel, storage_format)]
+
+
+def _process_audio(out_dir, index, wav_path, storage_format=STORAGE_FLOAT32, split_spec=False):
+    metadata, examples = _target_examples(index, wav_path, storage_format, split_spec)
     # Write the spectrograms to disk:
-    filename = 'jsut-target-%05d.tfrecords' % index
-    write_preprocessed_target_data(index, spectrogram.T, mel_spectrogram.T, os.path.join(out_dir, filename))
+    for prefix, example in zip(_target_prefixes(split_spec), examples):
+        write_tfrecord(example, os.path.join(out_dir, "%s-%05d.tfrecords" % (prefix, index)))
+    return metadata
+
+
+def _process_audio_record(index, wav_path, storage_format=STORAGE_FLOAT32, split_spec=False):
+    metadata, examples = _target_examples(index, wav_path, storage_format, split_spec)
+    return metadata, [example.SerializeToString() for example in examples]
+
+
+def _target_prefixes(split_spec):
+    return ["jsut-target", "jsut-spec"] if split_spec else ["jsut-target"]
+
+
+def _process_audio_arrays(index, wav_path):
+    metadata, spec, mel = _target_features(index, wav_path)
+    return metadata, (spec, mel)
+
+
+_Task = namedtuple("_Task", ["id", "input", "input_hash", "stat"])
 
-    # Return a tuple describing this training example:
-    return TargetMetaData(index, filename, n_frames)
+_Execution = namedtuple("_Execution", ["executor", "streaming", "max_in_flight", "chunk_size"])
+
+
+def _map(execution: _Execution, function, tasks: List[_Task], ordered):
+    inputs = [(task.id, task.input) for task in tasks]
+    tasks_by_id = {task.id: task for task in tasks}
+    if execution.streaming:
+        streamed = imap if ordered else imap_unordered
+        mapped = streamed(execution.executor, function, inputs, execution.max_in_flight, execution.chunk_size)
+    else:
+        futures = [(args, execution.executor.submit(function, *args)) for args in inputs]
+        mapped = ((args, future.result()) for args, future in futures)
+    for (id, _), result in mapped:
+        yield tasks_by_id[id], result
+
+
+class _ColumnWriter():
+    '''
+    Writes each column of a record to its own ShardedTFRecordWriter.
+    '''
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def finished(self):
+        return min(writer.finished for writer in self.writers)
+
+    def write(self, id: int, columns: List[bytes]):
+        filenames = [writer.write(id, column) for writer, column in zip(self.writers, columns)]
+        return filenames[0]
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+
+def _write_metadata(f, metadata):
+    f.write('|'.join([str(x) for x in metadata]) + '\n')
+    f.flush()
 
 
 class JSUT():
@@ -173,43 +281,237 @@ class JSUT():
                 for zipinfo in members:
                     zip_ref.extract(zipinfo, self.dl_dir)
 
-    def preprocess(self, num_workers=4, mode=SOURCE_AND_TARGET):
+    def preprocess(self, num_workers=4, mode=SOURCE_AND_TARGET, shard_size=None, force=False, streaming=False,
+                   max_in_flight=None, chunk_size=1, packed=False, packed_spec=False, storage_format=STORAGE_FLOAT32,
+                   split_spec=False):
+        '''
+        :param shard_size: if given, pack this number of utterances per TFRecord shard
+        and write a sidecar index instead of writing one file per utterance.
+        :param packed: write targets into a packed feature store read through np.memmap instead of TFRecords.
+        :param packed_spec: also pack linear spectrograms, which only the postnet needs.
+        :param storage_format: one of data.tfrecord_utils.STORAGE_FORMATS for spectrograms in target TFRecords.
+        Packed stores are always float32.
+        :param split_spec: write mel and linear spectrograms of targets to separate records so that training without
+        the postnet never reads linear spectrograms.
+        :param force: reprocess every utterance even if the manifest says its output is up to date.
+        :param streaming: keep at most `max_in_flight` tasks of `chunk_size` utterances in the process pool
+        and consume results as they complete instead of submitting every utterance at once.
+        '''
         if not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
         executor = ProcessPoolExecutor(max_workers=num_workers)
+        execution = _Execution(executor, streaming, max_in_flight or num_workers * 4, chunk_size)
         if mode in [TARGET_ONLY, SOURCE_AND_TARGET]:
-            futures = []
             wav_paths = jsut.WavFileDataSource(
                 self.in_dir, subsets=jsut.available_subsets).collect_files()
-
-            for index, wav_path in enumerate(wav_paths):
-                futures.append(executor.submit(partial(_process_audio, self.out_dir, index + 1, wav_path)))
-            result = [future.result() for future in tqdm(futures, desc="targets")]
-            self._write_target_metadata(result)
+            # float32 keeps the hash of records written before storage formats were introduced
+            storage = {} if storage_format == STORAGE_FLOAT32 or packed else {"storage_format": storage_format}
+            if split_spec and not packed:
+                storage["split_spec"] = True
+            params_hash = hparams_hash(hparams, AUDIO_HPARAMS, **storage)
+            with self._manifest("jsut-target") as manifest:
+                tasks = []
+                for index, wav_path in enumerate(wav_paths):
+                    inputs = [p for p in [wav_path, _lab_path(wav_path)] if os.path.exists(p)]
+                    input_hash, stat = manifest.files_hash(index + 1, inputs)
+                    tasks.append(_Task(index + 1, wav_path, input_hash, stat))
+                with open(os.path.join(self.out_dir, 'train-target.txt'), 'w', encoding='utf-8') as f:
+                    if packed:
+                        result = self._run_packed(execution, manifest, tasks, params_hash, "targets",
+                                                  self.packed_target_prefix, packed_spec, force, f)
+                    else:
+                        result = self._run(execution, manifest, tasks, params_hash,
+                                           partial(_process_audio, storage_format=storage_format,
+                                                   split_spec=split_spec),
+                                           partial(_process_audio_record, storage_format=storage_format,
+                                                   split_spec=split_spec),
+                                           TargetMetaData, "targets", _target_prefixes(split_spec), shard_size,
+                                           force, f)
+            self._print_target_summary(result)
         if mode in [SOURCE_ONLY, SOURCE_AND_TARGET]:
-            futures = []
             transcriptions = jsut.TranscriptionDataSource(
                 self.in_dir, subsets=jsut.available_subsets).collect_files()
-            for index, text in enumerate(transcriptions):
-                futures.append(executor.submit(partial(_process_text, self.out_dir, index + 1, text)))
-            result = [future.result() for future in tqdm(futures, desc="sources")]
-            self._write_source_metadata(result)
+            params_hash = hparams_hash(hparams, TEXT_HPARAMS)
+            with self._manifest("jsut-source") as manifest:
+                tasks = [_Task(index + 1, text, text_hash(text), None) for index, text in enumerate(transcriptions)]
+                with open(os.path.join(self.out_dir, 'train-source.txt'), 'w', encoding='utf-8') as f:
+                    result = self._run(execution, manifest, tasks, params_hash, _process_text, _process_text_record,
+                                       SourceMetaData, "sources", ["jsut-source"], shard_size, force, f)
+            self._print_source_summary(result)
         executor.shutdown()
 
-    def _write_target_metadata(self, metadata: List[TargetMetaData]):
-        with open(os.path.join(self.out_dir, 'train-target.txt'), 'w', encoding='utf-8') as f:
-            for m in metadata:
-                f.write('|'.join([str(x) for x in m]) + '\n')
+    def _manifest(self, prefix):
+        return PreprocessManifest(os.path.join(self.out_dir, prefix + "-manifest.jsonl"))
+
+    def _run(self, execution, manifest, tasks, params_hash, process, process_record, metadata_class, desc, prefixes,
+             shard_size, force, metadata_file):
+        '''
+        :param prefixes: file prefix of each column that process and process_record write. The first one is the main
+        column whose filename is recorded in the metadata.
+        '''
+        if shard_size is None:
+            return self._run_per_utterance(execution, manifest, tasks, params_hash, process, metadata_class, desc,
+                                           prefixes, force, metadata_file)
+        else:
+            return self._run_sharded(execution, manifest, tasks, params_hash, process_record, metadata_class, desc,
+                                     prefixes, shard_size, force, metadata_file)
+
+    def _run_per_utterance(self, execution, manifest, tasks, params_hash, process, metadata_class, desc, prefixes,
+                           force, metadata_file):
+        result = []
+        pending = []
+        for task in tasks:
+            entry = None if force else manifest.lookup(task.id, task.input_hash, params_hash)
+            outputs = ["%s-%05d.tfrecords" % (prefix, task.id) for prefix in prefixes]
+            if entry is not None and entry.output == outputs[0] and all(
+                    os.path.exists(os.path.join(self.out_dir, output)) for output in outputs):
+                result.append(metadata_class(*entry.metadata))
+            else:
+                pending.append(task)
+        print("%s: %d up to date, %d to process" % (desc, len(result), len(pending)))
+        for task, metadata in tqdm(_map(execution, partial(process, self.out_dir), pending, ordered=False),
+                                   desc=desc, total=len(pending)):
+            # record each output as soon as it is written so that a crashed run can continue from here
+            manifest.record(task.id, task.input_hash, params_hash, metadata.filename, metadata, task.stat)
+            result.append(metadata)
+        # metadata is written in id order regardless of completion order, so the same corpus gives the same file
+        result.sort(key=lambda metadata: metadata.id)
+        for metadata in result:
+            _write_metadata(metadata_file, metadata)
+        return result
+
+    def _run_sharded(self, execution, manifest, tasks, params_hash, process_record, metadata_class, desc, prefixes,
+                     shard_size, force, metadata_file):
+        previous_indices = []
+        for prefix in prefixes:
+            index_path = os.path.join(self.out_dir, shard_index_filename(prefix))
+            previous_indices.append(read_shard_index(index_path) if os.path.exists(index_path) else [])
+        located_by_id = [{e.id: e for e in index} for index in previous_indices]
+
+        def cached_column(task, entry, prefix, located_by_id, main):
+            # up-to-date records are copied from the previous shards or per utterance files
+            located = located_by_id.get(task.id)
+            if entry.output == "%s-%05d.tfrecords" % (prefixes[0], task.id):
+                filename, offset = "%s-%05d.tfrecords" % (prefix, task.id), 0
+            elif located is not None and (not main or located.filename == entry.output):
+                filename, offset = located.filename, located.offset
+            else:
+                return None
+            path = os.path.join(self.out_dir, filename)
+            if not os.path.exists(path):
+                return None
+            return path, offset
+
+        def cached_record(task):
+            entry = None if force else manifest.lookup(task.id, task.input_hash, params_hash)
+            if entry is None:
+                return None
+            columns = [cached_column(task, entry, prefix, located, i == 0) for i, (prefix, located) in
+                       enumerate(zip(prefixes, located_by_id))]
+            if any(column is None for column in columns):
+                return None
+            # records are read only when they are written, so up-to-date records are not held in memory
+            return metadata_class(*entry.metadata), lambda: [read_tfrecord_at(path, offset) for path, offset in columns]
+
+        def written(tasks):
+            # the previous shards hold exactly these records in this order and with this shard size
+            ids = [task.id for task in tasks]
+            for index in previous_indices:
+                if [e.id for e in index] != ids:
+                    return False
+                shard_sizes = [len(list(entries)) for _, entries in groupby(index, key=lambda e: e.filename)]
+                if any(size != shard_size for size in shard_sizes[:-1]) or sum(shard_sizes[-1:]) > shard_size:
+                    return False
+            return True
+
+        def writer():
+            return _ColumnWriter([ShardedTFRecordWriter(self.out_dir, prefix, shard_size, previous_index) for
+                                  prefix, previous_index in zip(prefixes, previous_indices)])
+
+        return self._write_in_order(execution, manifest, tasks, params_hash, process_record, desc, cached_record,
+                                    writer, metadata_file, written)
+
+    def _run_packed(self, execution, manifest, tasks, params_hash, desc, prefix, with_spec, force, metadata_file):
+        previous = PackedFeatureStore(self.out_dir, prefix) if PackedFeatureStore.exists(self.out_dir, prefix) else None
+
+        def cached_record(task):
+            entry = None if force else manifest.lookup(task.id, task.input_hash, params_hash)
+            if entry is None or entry.output != packed_data_filename(prefix, "mel"):
+                return None
+            if previous is None or task.id not in previous:
+                return None
+            if with_spec and not previous.has_spec:
+                return None
+            # the previous store is memory mapped, so it stays readable after the new one replaces it
+            return TargetMetaData(*entry.metadata), lambda: (previous.spec(task.id) if with_spec else None,
+                                                             previous.mel(task.id))
+
+        def written(tasks):
+            return previous is not None and previous.has_spec == with_spec and list(previous.index[:, 0]) == [
+                task.id for task in tasks]
+
+        writer = partial(PackedFeatureWriter, self.out_dir, prefix, with_spec)
+        return self._write_in_order(execution, manifest, tasks, params_hash, _process_audio_arrays, desc,
+                                    cached_record, writer, metadata_file, written)
+
+    def _write_in_order(self, execution, manifest, tasks, params_hash, process_record, desc, cached_record, writer,
+                        metadata_file, written):
+        '''
+        :param cached_record: function from a task to the metadata of its up-to-date record and a function that reads
+        the record, or None if the task has to be processed
+        :param writer: function that opens a writer. It is not opened if the previous outputs are up to date.
+        Manifest entries are recorded for the first `finished` written records, which are in place on disk.
+        :param written: function that tells if the previous outputs already hold the records of tasks in order
+        '''
+        cached = {}
+        for task in tasks:
+            record = cached_record(task)
+            if record is not None:
+                cached[task.id] = record
+        pending = [task for task in tasks if task.id not in cached]
+        print("%s: %d up to date, %d to process" % (desc, len(cached), len(pending)))
+
+        if not pending and written(tasks):
+            result = [cached[task.id][0] for task in tasks]
+            for metadata in result:
+                _write_metadata(metadata_file, metadata)
+            return result
+
+        # records are written in id order so that sources and targets can be zipped
+        processed = _map(execution, process_record, pending, ordered=True)
+        result = []
+        recorded = 0
+
+        def record_finished(finished):
+            nonlocal recorded
+            for task, metadata in result[recorded:finished]:
+                manifest.record(task.id, task.input_hash, params_hash, metadata.filename, metadata, task.stat)
+            recorded = max(recorded, finished)
+
+        with writer() as w:
+            for task in tqdm(tasks, desc=desc):
+                if task.id in cached:
+                    metadata, read = cached.pop(task.id)
+                    payload = read()
+                else:
+                    _, (metadata, payload) = next(processed)
+                filename = w.write(metadata.id, payload)
+                metadata = metadata._replace(filename=filename)
+                _write_metadata(metadata_file, metadata)
+                result.append((task, metadata))
+                # outputs that have been moved into place can be skipped by a later run
+                record_finished(w.finished)
+        record_finished(len(result))
+        return [metadata for _, metadata in result]
+
+    def _print_target_summary(self, metadata: List[TargetMetaData]):
         frames = sum([m.n_frames for m in metadata])
         frame_shift_ms = hparams.hop_size / hparams.sample_rate * 1000
         hours = frames * frame_shift_ms / (3600 * 1000)
         print('Wrote %d utterances, %d frames (%.2f hours)' % (len(metadata), frames, hours))
         print('Max output length: %d' % max(m.n_frames for m in metadata))
 
-    def _write_source_metadata(self, metadata: List[SourceMetaData]):
-        with open(os.path.join(self.out_dir, 'train-source.txt'), 'w', encoding='utf-8') as f:
-            for m in metadata:
-                f.write('|'.join([str(x) for x in m]) + '\n')
+    def _print_source_summary(self, metadata: List[SourceMetaData]):
         print('Max input text length:  %d' % max(m.text_length for m in metadata))
         print('Max input array length:  %d' % max(m.source_length for m in metadata))
         print('Max alternative input text length:  %d' % max(m.text2_length for m in metadata))
@@ -225,11 +527,41 @@ class JSUT():
 
     @property
     def source_files(self):
-        return (os.path.join(self.out_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, self.data_num + 1))
+        return self._files("jsut-source")
 
     @property
     def target_files(self):
-        return (os.path.join(self.out_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, self.data_num + 1))
+        return self._files("jsut-target")
+
+    @property
+    def spec_files(self):
+        '''
+        :return: files of linear spectrogram records or None if they are stored in target records
+        '''
+        prefix = _target_prefixes(split_spec=True)[1]
+        if os.path.exists(os.path.join(self.out_dir, shard_index_filename(prefix))) or os.path.exists(
+                os.path.join(self.out_dir, prefix + "-%05d.tfrecords" % 1)):
+            return self._files(prefix)
+        return None
+
+    @property
+    def packed_target_prefix(self):
+        return "jsut-packed-target"
+
+    @property
+    def packed_target_store(self):
+        '''
+        :return: PackedFeatureStore of targets or None if targets are not packed
+        '''
+        if PackedFeatureStore.exists(self.out_dir, self.packed_target_prefix):
+            return PackedFeatureStore(self.out_dir, self.packed_target_prefix)
+        return None
+
+    def _files(self, prefix):
+        index_path = os.path.join(self.out_dir, shard_index_filename(prefix))
+        if os.path.exists(index_path):
+            return (f for f in shard_files(read_shard_index(index_path), self.out_dir))
+        return (os.path.join(self.out_dir, prefix + "-%05d.tfrecords" % i) for i in range(1, self.data_num + 1))
 
 
 def instantiate(in_dir, out_dir):
@@ -0,0 +1,107 @@
+import collections
+import hashlib
+import json
+import os
+
+# hyper parameters that change the content of preprocessed records
+AUDIO_HPARAMS = ["num_mels", "fmin", "fmax", "fft_size", "hop_size", "sample_rate", "preemphasis", "min_level_db",
+                 "ref_level_db", "rescaling", "rescaling_max", "allow_clipping_in_normalization"]
+TEXT_HPARAMS = []
+
+
+class ManifestEntry(collections.namedtuple("ManifestEntry",
+                                           ["key", "input_hash", "params_hash", "output", "metadata", "stat"])):
+    pass
+
+
+def hparams_hash(hparams, names, **extra):
+    values = hparams.values()
+    params = {name: values[name] for name in names}
+    params.update(extra)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def files_fingerprint(files):
+    '''
+    Hash of file names, sizes and modification times. Rewritten files change it without reading their contents.
+    '''
+    h = hashlib.sha1()
+    for path in files:
+        stat = os.stat(path)
+        h.update(("%s|%d|%d\n" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _file_stat(paths):
+    return [[os.path.getsize(p), os.stat(p).st_mtime_ns] for p in paths]
+
+
+def _files_hash(paths):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+class PreprocessManifest():
+    '''
+    Append-only record of (input hash, hyper parameter hash, output) per preprocessed utterance.
+    Entries are flushed one by one, so a crashed run can continue from the last written entry.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        truncated = False
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    truncated = not line.endswith('\n')
+                    try:
+                        entry = ManifestEntry(**json.loads(line))
+                    except ValueError:
+                        # a line cut off by a crash
+                        continue
+                    self.entries[entry.key] = entry
+        self._file = open(filename, 'a', encoding='utf-8')
+        if truncated:
+            # terminate a line cut off by a crash so that new entries start on their own line
+            self._file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def files_hash(self, key, paths):
+        '''
+        Hash of the content of input files.
+        The previous hash is reused when size and modification time of the files are unchanged.
+        '''
+        stat = _file_stat(paths)
+        entry = self.entries.get(key)
+        if entry is not None and entry.stat == stat:
+            return entry.input_hash, stat
+        return _files_hash(paths), stat
+
+    def lookup(self, key, input_hash, params_hash):
+        entry = self.entries.get(key)
+        if entry is not None and entry.input_hash == input_hash and entry.params_hash == params_hash:
+            return entry
+        return None
+
+    def record(self, key, input_hash, params_hash, output, metadata, stat=None):
+        entry = ManifestEntry(key, input_hash, params_hash, output, list(metadata), stat)
+        self.entries[key] = entry
+        self._file.write(json.dumps(entry._asdict(), ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
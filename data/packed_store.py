@@ -0,0 +1,194 @@
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from data import PreprocessedTargetData
+
+# A packed store keeps all frames of a corpus in one contiguous float32 file per feature:
+#   <prefix>-mel.f32, <prefix>-spec.f32 (optional): raw (total frames, width) float32 arrays
+#   <prefix>-index.npy: (utterances, 3) int64 array of id, frame offset and frame length
+#   <prefix>.json: widths and the total number of frames
+# Files are written as .tmp files and replaced when the store is closed. The header is written last, and its .tmp
+# file marks that every .tmp file is complete, so a close that is interrupted is completed when the store is opened.
+
+
+def packed_data_filename(prefix, feature):
+    return "%s-%s.f32" % (prefix, feature)
+
+
+def _store_filenames(prefix):
+    # the header is replaced last
+    return [packed_data_filename(prefix, "mel"), packed_data_filename(prefix, "spec"), prefix + "-index.npy",
+            prefix + ".json"]
+
+
+def _complete_interrupted_close(data_dir, prefix):
+    header = os.path.join(data_dir, prefix + ".json")
+    if not os.path.exists(header + ".tmp"):
+        return
+    for name in _store_filenames(prefix):
+        path = os.path.join(data_dir, name)
+        try:
+            os.replace(path + ".tmp", path)
+        except FileNotFoundError:
+            # replaced before the interruption, or by another process
+            pass
+
+
+class PackedFeatureWriter():
+
+    def __init__(self, out_dir, prefix, with_spec=False):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.with_spec = with_spec
+        self.index = []
+        # records are in place only when the store is closed
+        self.finished = 0
+        self.mel_width = None
+        self.spec_width = None
+        self._num_frames = 0
+        _complete_interrupted_close(out_dir, prefix)
+        self._mel_file = open(self._path("mel") + ".tmp", 'wb')
+        self._spec_file = open(self._path("spec") + ".tmp", 'wb') if with_spec else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, id: int, payload):
+        '''
+        :param payload: (spec, mel) with shape (T, spec_width) and (T, mel_width)
+        :return: filename of the mel data
+        '''
+        spec, mel = payload
+        mel = np.ascontiguousarray(mel, dtype=np.float32)
+        self.mel_width = mel.shape[1]
+        self._mel_file.write(mel.tobytes())
+        if self.with_spec:
+            spec = np.ascontiguousarray(spec, dtype=np.float32)
+            assert len(spec) == len(mel)
+            self.spec_width = spec.shape[1]
+            self._spec_file.write(spec.tobytes())
+        self.index.append((id, self._num_frames, len(mel)))
+        self._num_frames += len(mel)
+        return packed_data_filename(self.prefix, "mel")
+
+    def close(self):
+        # replace a previous store only when this one is complete, so it stays readable while writing
+        self._mel_file.close()
+        if self.with_spec:
+            self._spec_file.close()
+        with open(os.path.join(self.out_dir, self.prefix + "-index.npy.tmp"), 'wb') as f:
+            np.save(f, np.array(self.index, dtype=np.int64))
+        with open(os.path.join(self.out_dir, self.prefix + ".json.tmp"), 'w', encoding='utf-8') as f:
+            json.dump({"num_frames": self._num_frames, "mel_width": self.mel_width, "spec_width": self.spec_width}, f)
+        for name in _store_filenames(self.prefix):
+            path = os.path.join(self.out_dir, name)
+            if os.path.exists(path + ".tmp"):
+                os.replace(path + ".tmp", path)
+        self.finished = len(self.index)
+
+    def abort(self):
+        self._mel_file.close()
+        os.remove(self._path("mel") + ".tmp")
+        if self.with_spec:
+            self._spec_file.close()
+            os.remove(self._path("spec") + ".tmp")
+
+    def _path(self, feature):
+        return os.path.join(self.out_dir, packed_data_filename(self.prefix, feature))
+
+
+class PackedFeatureStore():
+    '''
+    Read-only view of a packed store through np.memmap.
+    Slices are views into the page cache, so several processes on a host share one copy of the corpus.
+    '''
+
+    def __init__(self, data_dir, prefix):
+        _complete_interrupted_close(data_dir, prefix)
+        with open(os.path.join(data_dir, prefix + ".json"), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+        self.data_dir = data_dir
+        self.prefix = prefix
+        self.mel_width = header["mel_width"]
+        self.spec_width = header["spec_width"]
+        self.index = np.load(os.path.join(data_dir, prefix + "-index.npy"))
+        self._rows = {id: row for row, id in enumerate(self.index[:, 0])}
+        self._mel = np.memmap(os.path.join(data_dir, packed_data_filename(prefix, "mel")), dtype=np.float32,
+                              mode='r', shape=(header["num_frames"], self.mel_width))
+        self._spec = np.memmap(os.path.join(data_dir, packed_data_filename(prefix, "spec")), dtype=np.float32,
+                               mode='r', shape=(header["num_frames"], self.spec_width)) if self.has_spec else None
+
+    @staticmethod
+    def exists(data_dir, prefix):
+        _complete_interrupted_close(data_dir, prefix)
+        return os.path.exists(os.path.join(data_dir, prefix + ".json"))
+
+    @property
+    def files(self):
+        names = [self.prefix + ".json", self.prefix + "-index.npy", packed_data_filename(self.prefix, "mel")]
+        if self.has_spec:
+            names.append(packed_data_filename(self.prefix, "spec"))
+        return [os.path.join(self.data_dir, name) for name in names]
+
+    @property
+    def has_spec(self):
+        return self.spec_width is not None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def mel(self, id):
+        _, offset, length = self.index[self._rows[id]]
+        return self._mel[offset:offset + length]
+
+    def spec(self, id):
+        _, offset, length = self.index[self._rows[id]]
+        return self._spec[offset:offset + length]
+
+    def _generate(self, with_spec):
+        for id, offset, length in self.index:
+            mel = self._mel[offset:offset + length]
+            spec = self._spec[offset:offset + length] if with_spec else np.zeros((length, 0), dtype=np.float32)
+            yield PreprocessedTargetData(
+                id=id,
+                spec=spec,
+                spec_width=spec.shape[1],
+                mel=mel,
+                mel_width=self.mel_width,
+                target_length=length,
+            )
+
+    def dataset(self, with_spec=True):
+        '''
+        :param with_spec: if False, linear spectrograms are not read and spec is an empty (T, 0) array
+        :return: tf.data.Dataset of decoded PreprocessedTargetData in id order
+        '''
+        if with_spec and not self.has_spec:
+            raise ValueError("linear spectrograms are not packed in %s. preprocess with --packed-spec." % self.prefix)
+        return tf.data.Dataset.from_generator(lambda: self._generate(with_spec),
+                                              output_types=PreprocessedTargetData(
+                                                  id=tf.int64,
+                                                  spec=tf.float32,
+                                                  spec_width=tf.int64,
+                                                  mel=tf.float32,
+                                                  mel_width=tf.int64,
+                                                  target_length=tf.int64,
+                                              ),
+                                              output_shapes=PreprocessedTargetData(
+                                                  id=tf.TensorShape([]),
+                                                  spec=tf.TensorShape([None, self.spec_width if with_spec else 0]),
+                                                  spec_width=tf.TensorShape([]),
+                                                  mel=tf.TensorShape([None, self.mel_width]),
+                                                  mel_width=tf.TensorShape([]),
+                                                  target_length=tf.TensorShape([]),
+                                              ))
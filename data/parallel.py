@@ -0,0 +1,77 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+from itertools import islice
+
+
+def _call_chunk(function, chunk):
+    return [function(*args) for _, args in chunk]
+
+
+def _chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _imap_enumerated(executor, function, inputs, max_in_flight, chunk_size, ordered):
+    '''
+    :param ordered: yield in input order. Chunks that complete before their predecessors wait in a reorder buffer,
+    and they count towards max_in_flight so that a slow chunk stops submission instead of growing the buffer.
+    '''
+    chunks = _chunks(enumerate(inputs), chunk_size)
+    in_flight = {}
+    completed = {}
+    submitted = 0
+    next_chunk = 0
+
+    def submit_next():
+        nonlocal submitted
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        in_flight[executor.submit(_call_chunk, function, chunk)] = (submitted, chunk)
+        submitted += 1
+        return True
+
+    while len(in_flight) + len(completed) < max_in_flight and submit_next():
+        pass
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, chunk = in_flight.pop(future)
+            completed[index] = (chunk, future.result())
+        ready = []
+        if ordered:
+            while next_chunk in completed:
+                ready.append(completed.pop(next_chunk))
+                next_chunk += 1
+        else:
+            ready = list(completed.values())
+            completed.clear()
+        for chunk, results in ready:
+            for (position, args), result in zip(chunk, results):
+                yield position, args, result
+        while len(in_flight) + len(completed) < max_in_flight and submit_next():
+            pass
+
+
+def imap_unordered(executor, function, inputs, max_in_flight, chunk_size=1):
+    '''
+    Streams `function(*args)` for each args in `inputs` on `executor`.
+    Each submitted task carries `chunk_size` inputs and at most `max_in_flight` tasks are pending at a time.
+    :return: generator of (args, result) in completion order
+    '''
+    for _, args, result in _imap_enumerated(executor, function, inputs, max_in_flight, chunk_size, ordered=False):
+        yield args, result
+
+
+def imap(executor, function, inputs, max_in_flight, chunk_size=1):
+    '''
+    Same as `imap_unordered` but yields in input order.
+    Results that complete early wait in a reorder buffer until their predecessors complete. Buffered tasks count
+    towards `max_in_flight`, so at most `max_in_flight` tasks are pending or buffered at a time.
+    '''
+    for _, args, result in _imap_enumerated(executor, function, inputs, max_in_flight, chunk_size, ordered=True):
+        yield args, result
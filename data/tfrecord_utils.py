@@ -1,7 +1,30 @@
 import tensorflow as tf
 import numpy as np
+import glob
+import os
+import struct
 from collections.abc import Iterable
-from data import PreprocessedTargetData, PreprocessedSourceData
+from typing import List
+from data import PreprocessedTargetData, PreprocessedSourceData, ShardIndexEntry
+
+# Storage formats of spectrograms in target records.
+# Spectrograms are normalized to [0, 1], so integer formats quantize them linearly over that range.
+STORAGE_FLOAT32 = "float32"
+STORAGE_FLOAT16 = "float16"
+STORAGE_UINT8 = "uint8"
+STORAGE_UINT16 = "uint16"
+STORAGE_FORMATS = [STORAGE_FLOAT32, STORAGE_FLOAT16, STORAGE_UINT8, STORAGE_UINT16]
+
+_storage_dtypes = {
+    STORAGE_FLOAT32: (np.float32, tf.float32, None),
+    STORAGE_FLOAT16: (np.float16, tf.float16, None),
+    STORAGE_UINT8: (np.uint8, tf.uint8, 255),
+    STORAGE_UINT16: (np.uint16, tf.uint16, 65535),
+}
+
+# A TFRecord is framed as uint64 length, uint32 masked crc of length, data, uint32 masked crc of data.
+_tfrecord_header_size = 12
+_tfrecord_footer_size = 4
 
 
 def bytes_feature(value):
@@ -19,31 +42,210 @@ def write_tfrecord(example: tf.train.Example, filename: str):
         writer.write(example.SerializeToString())
 
 
-def write_preprocessed_target_data(id: int, spec: np.ndarray, mel: np.ndarray, filename: str):
-    raw_spec = spec.tostring()
-    raw_mel = mel.tostring()
-    example = tf.train.Example(features=tf.train.Features(feature={
+class ShardedTFRecordWriter():
+    '''
+    Packs many serialized examples into fixed size shards and writes a sidecar index of
+    id -> (shard filename, byte offset, record length).
+    Each shard is moved into place as soon as it is full, and the index is then rewritten to list the finished shards
+    and the records of the previous index that have not been written again. New shards never take the name of a
+    previous shard, so previous shards stay readable while writing and a crashed run leaves a consistent index.
+    '''
+
+    def __init__(self, out_dir, prefix, shard_size, previous_index: List[ShardIndexEntry] = None):
+        '''
+        :param previous_index: index of the shards that this writer replaces. Their files are removed on close.
+        '''
+        assert shard_size > 0
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.index = []
+        self.previous_index = previous_index or []
+        # number of written records whose shard has been moved into place
+        self.finished = 0
+        self._written_ids = set()
+        self._writer = None
+        self._shard_filename = None
+        self._num_records_in_shard = 0
+        self._next_shard = 0
+        self._offset = 0
+        # temporary shards of a crashed run
+        for path in glob.glob(os.path.join(glob.escape(out_dir), glob.escape(prefix) + "-shard-*.tfrecords.tmp")):
+            os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, id: int, serialized: bytes):
+        if self._writer is None:
+            self._open_next_shard()
+        self._writer.write(serialized)
+        self.index.append(ShardIndexEntry(id, self._shard_filename, self._offset, len(serialized)))
+        self._written_ids.add(id)
+        self._offset += _tfrecord_header_size + len(serialized) + _tfrecord_footer_size
+        self._num_records_in_shard += 1
+        filename = self._shard_filename
+        if self._num_records_in_shard == self.shard_size:
+            self._finish_shard()
+        return filename
+
+    def close(self):
+        if self._writer is not None:
+            self._finish_shard()
+        write_shard_index(self.index, os.path.join(self.out_dir, shard_index_filename(self.prefix)))
+        written = {entry.filename for entry in self.index}
+        for filename in {entry.filename for entry in self.previous_index} - written:
+            path = os.path.join(self.out_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.remove(os.path.join(self.out_dir, self._shard_filename) + ".tmp")
+
+    def _finish_shard(self):
+        self._writer.close()
+        self._writer = None
+        path = os.path.join(self.out_dir, self._shard_filename)
+        os.replace(path + ".tmp", path)
+        self.finished = len(self.index)
+        remaining = [entry for entry in self.previous_index if entry.id not in self._written_ids]
+        write_shard_index(self.index + remaining, os.path.join(self.out_dir, shard_index_filename(self.prefix)))
+
+    def _open_next_shard(self):
+        previous_files = {entry.filename for entry in self.previous_index}
+        while shard_filename(self.prefix, self._next_shard) in previous_files or os.path.exists(
+                os.path.join(self.out_dir, shard_filename(self.prefix, self._next_shard))):
+            self._next_shard += 1
+        self._shard_filename = shard_filename(self.prefix, self._next_shard)
+        self._writer = tf.python_io.TFRecordWriter(os.path.join(self.out_dir, self._shard_filename) + ".tmp")
+        self._next_shard += 1
+        self._num_records_in_shard = 0
+        self._offset = 0
+
+
+def shard_filename(prefix: str, shard: int):
+    return "%s-shard-%05d.tfrecords" % (prefix, shard)
+
+
+def shard_index_filename(prefix: str):
+    return "%s-index.txt" % prefix
+
+
+def write_shard_index(index: List[ShardIndexEntry], filename: str):
+    # replaced in one step so that a crash never leaves a partial index
+    with open(filename + ".tmp", 'w', encoding='utf-8') as f:
+        for entry in index:
+            f.write('|'.join([str(x) for x in entry]) + '\n')
+    os.replace(filename + ".tmp", filename)
+
+
+def read_shard_index(filename) -> List[ShardIndexEntry]:
+    with open(filename, 'r', encoding='utf-8') as f:
+        index = []
+        for line in f:
+            id, shard, offset, length = line.rstrip('\n').split('|')
+            index.append(ShardIndexEntry(int(id), shard, int(offset), int(length)))
+        return index
+
+
+def shard_files(index: List[ShardIndexEntry], data_dir):
+    # keep shard order so that records are read in the order they were written
+    filenames = []
+    for entry in index:
+        if not filenames or filenames[-1] != entry.filename:
+            filenames.append(entry.filename)
+    return [os.path.join(data_dir, f) for f in filenames]
+
+
+def read_tfrecord_at(filename, offset):
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        length, = struct.unpack('<Q', f.read(8))
+        f.seek(offset + _tfrecord_header_size)
+        return f.read(length)
+
+
+def encode_spectrogram(spectrogram: np.ndarray, storage_format=STORAGE_FLOAT32):
+    np_dtype, _, scale = _storage_dtypes[storage_format]
+    if scale is None:
+        return spectrogram.astype(np_dtype)
+    return np.round(np.clip(spectrogram, 0, 1) * scale).astype(np_dtype)
+
+
+def decode_spectrogram(raw: bytes, storage_format=STORAGE_FLOAT32):
+    np_dtype, _, scale = _storage_dtypes[storage_format]
+    spectrogram = np.frombuffer(raw, dtype=np_dtype).astype(np.float32)
+    return spectrogram if scale is None else spectrogram / scale
+
+
+def preprocessed_target_example(id: int, spec: np.ndarray, mel: np.ndarray, storage_format=STORAGE_FLOAT32):
+    raw_spec = encode_spectrogram(spec, storage_format).tostring()
+    raw_mel = encode_spectrogram(mel, storage_format).tostring()
+    return tf.train.Example(features=tf.train.Features(feature={
         'id': int64_feature([id]),
         'spec': bytes_feature([raw_spec]),
         'spec_width': int64_feature([spec.shape[1]]),
         'mel': bytes_feature([raw_mel]),
         'mel_width': int64_feature([mel.shape[1]]),
         'target_length': int64_feature([len(mel)]),
+        'storage_format': bytes_feature([storage_format.encode('utf-8')]),
     }))
-    write_tfrecord(example, filename)
 
 
-def write_preprocessed_source_data2(id: int, text1: str, source1: np.ndarray, text2: str, source2: np.ndarray,
-                                    filename: str):
+def preprocessed_mel_example(id: int, mel: np.ndarray, storage_format=STORAGE_FLOAT32):
+    '''
+    Mel column of a target record. parse_preprocessed_target_data(with_spec=False) reads it.
+    '''
+    return tf.train.Example(features=tf.train.Features(feature={
+        'id': int64_feature([id]),
+        'mel': bytes_feature([encode_spectrogram(mel, storage_format).tostring()]),
+        'mel_width': int64_feature([mel.shape[1]]),
+        'target_length': int64_feature([len(mel)]),
+        'storage_format': bytes_feature([storage_format.encode('utf-8')]),
+    }))
+
+
+def preprocessed_spec_example(id: int, spec: np.ndarray, storage_format=STORAGE_FLOAT32):
+    '''
+    Linear spectrogram column of a target record. parse_preprocessed_target_data(with_mel=False) reads it.
+    '''
+    return tf.train.Example(features=tf.train.Features(feature={
+        'id': int64_feature([id]),
+        'spec': bytes_feature([encode_spectrogram(spec, storage_format).tostring()]),
+        'spec_width': int64_feature([spec.shape[1]]),
+        'target_length': int64_feature([len(spec)]),
+        'storage_format': bytes_feature([storage_format.encode('utf-8')]),
+    }))
+
+
+def write_preprocessed_target_data(id: int, spec: np.ndarray, mel: np.ndarray, filename: str,
+                                   storage_format=STORAGE_FLOAT32):
+    write_tfrecord(preprocessed_target_example(id, spec, mel, storage_format), filename)
+
+
+def preprocessed_source_example2(id: int, text1: str, source1: np.ndarray, text2: str, source2: np.ndarray):
     raw_source1 = source1.tostring()
     raw_source2 = source2.tostring()
-    example = tf.train.Example(features=tf.train.Features(feature={
+    return tf.train.Example(features=tf.train.Features(feature={
         'id': int64_feature([id]),
         'text': bytes_feature([text1.encode('utf-8'), text2.encode('utf-8')]),
         'source': bytes_feature([raw_source1, raw_source2]),
         'source_length': int64_feature([len(source1), len(source2)]),
     }))
-    write_tfrecord(example, filename)
+
+
+def write_preprocessed_source_data2(id: int, text1: str, source1: np.ndarray, text2: str, source2: np.ndarray,
+                                    filename: str):
+    write_tfrecord(preprocessed_source_example2(id, text1, source1, text2, source2), filename)
 
 
 def read_preprocessed_target_data(filename):
@@ -57,8 +259,10 @@ def read_preprocessed_target_data(filename):
         spec_width = example.features.feature['spec_width'].int64_list.value[0]
         mel_width = example.features.feature['mel_width'].int64_list.value[0]
         target_length = example.features.feature['target_length'].int64_list.value[0]
-        spec = np.frombuffer(spec, dtype=np.float32).reshape([target_length, spec_width])
-        mel = np.frombuffer(mel, dtype=np.float32).reshape([target_length, mel_width])
+        storage_format = example.features.feature['storage_format'].bytes_list.value
+        storage_format = storage_format[0].decode('utf-8') if storage_format else STORAGE_FLOAT32
+        spec = decode_spectrogram(spec, storage_format).reshape([target_length, spec_width])
+        mel = decode_spectrogram(mel, storage_format).reshape([target_length, mel_width])
         yield PreprocessedTargetData(
             id=id,
             spec=spec,
@@ -69,30 +273,63 @@ def read_preprocessed_target_data(filename):
         )
 
 
-def parse_preprocessed_target_data(proto):
+def parse_preprocessed_target_data(proto, with_spec=True, with_mel=True):
+    '''
+    Columns that are not requested are neither parsed nor decoded,
+    so mel only and spec only records as well as combined records can be read.
+    '''
     features = {
         'id': tf.FixedLenFeature((), tf.int64),
-        'spec': tf.FixedLenFeature((), tf.string),
-        'spec_width': tf.FixedLenFeature((), tf.int64),
-        'mel': tf.FixedLenFeature((), tf.string),
-        'mel_width': tf.FixedLenFeature((), tf.int64),
         'target_length': tf.FixedLenFeature((), tf.int64),
+        # records written before storage formats were introduced are float32
+        'storage_format': tf.FixedLenFeature((), tf.string, default_value=STORAGE_FLOAT32),
     }
+    if with_spec:
+        features['spec'] = tf.FixedLenFeature((), tf.string)
+        features['spec_width'] = tf.FixedLenFeature((), tf.int64)
+    if with_mel:
+        features['mel'] = tf.FixedLenFeature((), tf.string)
+        features['mel_width'] = tf.FixedLenFeature((), tf.int64)
     parsed_features = tf.parse_single_example(proto, features)
     return parsed_features
 
 
+def _decode_raw_spectrogram(raw, storage_format):
+    def decode(tf_dtype, scale):
+        def f():
+            spectrogram = tf.decode_raw(raw, tf_dtype)
+            if tf_dtype == tf.float32:
+                return spectrogram
+            spectrogram = tf.to_float(spectrogram)
+            return spectrogram if scale is None else spectrogram / scale
+
+        return f
+
+    cases = [(tf.equal(storage_format, name), decode(tf_dtype, scale)) for name, (_, tf_dtype, scale) in
+             _storage_dtypes.items() if name != STORAGE_FLOAT32]
+    return tf.case(cases, default=decode(tf.float32, None), exclusive=True)
+
+
 def decode_preprocessed_target_data(parsed):
-    spec_width = parsed['spec_width']
-    mel_width = parsed['mel_width']
+    '''
+    A column that was not parsed is decoded as an empty (target_length, 0) tensor with width 0.
+    '''
     target_length = parsed['target_length']
-    spec = tf.decode_raw(parsed['spec'], tf.float32)
-    mel = tf.decode_raw(parsed['mel'], tf.float32)
+
+    def decode(column):
+        if column not in parsed:
+            return tf.zeros(tf.stack([target_length, 0], axis=0)), tf.to_int64(0)
+        width = parsed[column + '_width']
+        decoded = _decode_raw_spectrogram(parsed[column], parsed['storage_format'])
+        return tf.reshape(decoded, shape=tf.stack([target_length, width], axis=0)), width
+
+    spec, spec_width = decode('spec')
+    mel, mel_width = decode('mel')
     return PreprocessedTargetData(
         id=parsed['id'],
-        spec=tf.reshape(spec, shape=tf.stack([target_length, spec_width], axis=0)),
+        spec=spec,
         spec_width=spec_width,
-        mel=tf.reshape(mel, shape=tf.stack([target_length, mel_width], axis=0)),
+        mel=mel,
         mel_width=mel_width,
         target_length=target_length,
     )
@@ -2,6 +2,7 @@ import tensorflow as tf
 import math
 from functools import reduce
 from collections import namedtuple
+from contextlib import contextmanager
 from .modules import Linear, Embedding, Conv1d, NonCausalConv1d, NonCausalConvTransposed1d, Conv1dGLU, \
     NonCausalConv1dGLU, SinusoidalEncodingEmbedding
 from .cnn_cell import CNNCell, MultiCNNCell
@@ -31,7 +32,10 @@ class Encoder(tf.layers.Layer):
     def build(self, _):
         self.built = True
 
-    def call(self, text_sequences, text_positions=None):
+    def call(self, text_sequences, text_positions=None, segment_ids=None):
+        '''
+        :param segment_ids: (B, T) ids of packed utterances if several utterances are packed into a row
+        '''
         x = self.embed_tokens(text_sequences)
         x = tf.layers.dropout(x, rate=self.dropout, training=self.training)
 
@@ -39,7 +43,7 @@ class Encoder(tf.layers.Layer):
         keys = x
         # use normal convolution instead of causal convolution
         for conv in self.convolutions:
-            keys = conv(keys)
+            keys = conv(keys, segment_ids=segment_ids)
 
         # add output to input embedding for attention
         values = (keys + input_embedding) + math.sqrt(0.5)
@@ -59,8 +63,8 @@ class ScaledDotProductAttentionMechanism(AttentionMechanism):
         '''
         :param memory: (B, src_len, embed_dim)
         :param embed_dim:
-        :param window_ahead:
-        :param window_backward:
+        :param window_ahead: number of keys from the last attended one that a windowed query attends to
+        :param window_backward: number of keys before the last attended one that a windowed query attends to
         :param dropout:
         :param use_key_projection:
         :param use_value_projection:
@@ -88,14 +92,45 @@ class ScaledDotProductAttentionMechanism(AttentionMechanism):
 
         self._embed_dim = embed_dim
         self.training = training
+        # rows of the batch that queries belong to, and their keys, values and memory mask. See select_rows.
+        self._rows = None
+        self._selected_keys = None
+        self._selected_values = None
+        self._selected_memory_mask = None
 
     @property
     def values(self):
-        return self._values
+        return self._values if self._rows is None else self._selected_values
 
     @property
     def keys(self):
-        return self._keys
+        return self._keys if self._rows is None else self._selected_keys
+
+    @contextmanager
+    def select_rows(self, rows, keys, values, memory_mask=None):
+        '''
+        Queries within this context belong to some rows of the batch, e.g. utterances that are still decoded.
+        :param rows: (B',) indices of the rows in the batch
+        :param keys: (B', T_memory, embed_dim) keys of the rows, which are gathered from keys once by the caller
+        :param values: (B', T_memory, embed_dim) values of the rows
+        :param memory_mask: (B', T_memory) memory mask of the rows, which replaces the mask given to __call__
+        '''
+        previous = self._rows, self._selected_keys, self._selected_values, self._selected_memory_mask
+        self._rows, self._selected_keys, self._selected_values, self._selected_memory_mask = (rows, keys, values,
+                                                                                              memory_mask)
+        try:
+            yield
+        finally:
+            self._rows, self._selected_keys, self._selected_values, self._selected_memory_mask = previous
+
+    def scatter_rows(self, x):
+        '''
+        Places a tensor of selected rows at their positions in the whole batch. Other rows are zero.
+        '''
+        if self._rows is None:
+            return x
+        shape = tf.concat([tf.shape(self._keys)[:1], tf.shape(x)[1:]], axis=0)
+        return tf.scatter_nd(tf.expand_dims(self._rows, axis=1), x, shape)
 
     @property
     def embed_dim(self):
@@ -110,12 +145,18 @@ class ScaledDotProductAttentionMechanism(AttentionMechanism):
         size = tf.stack([batch_size, tf.ones(shape=(), dtype=tf.int32), key_length], axis=0)
         return tf.zeros(size, dtype=dtype)
 
-    def __call__(self, query, memory_mask=None):
+    def __call__(self, query, memory_mask=None, last_attended=None):
         '''
         :param query: (B, T//r, embed_dim)
         :param mask: (B, T_memory)
+        :param last_attended: (B,) index of the key with the highest weight at the previous step.
+        If given, a query of one step attends only to a window of keys around it.
         :return:
         '''
+        if self._rows is not None and memory_mask is not None:
+            memory_mask = self._selected_memory_mask
+        if last_attended is not None:
+            return self._windowed(query, memory_mask, last_attended)
 
         # Q K^\top
         x = tf.matmul(query, self.keys, transpose_b=True)
@@ -136,6 +177,35 @@ class ScaledDotProductAttentionMechanism(AttentionMechanism):
         x = x / tf.sqrt(s)
         return x, alignment_scores
 
+    def _windowed(self, query, memory_mask, last_attended):
+        key_length = tf.shape(self.keys)[1]
+        width = tf.minimum(self.window_backward + self.window_ahead, key_length)
+        # shift the window into the memory instead of shrinking it at both ends
+        start = tf.clip_by_value(last_attended - self.window_backward, 0, key_length - width)
+        positions = tf.expand_dims(start, axis=1) + tf.range(width)
+        batch_size = tf.shape(positions)[0]
+        # (B, W, 2) indices of the window in keys and values
+        indices = tf.stack([tf.tile(tf.expand_dims(tf.range(batch_size), axis=1), [1, width]), positions], axis=2)
+
+        # (B, 1, W)
+        x = tf.matmul(query, tf.gather_nd(self.keys, indices), transpose_b=True)
+        if memory_mask is not None:
+            x = self._memory_mask(x, tf.gather_nd(memory_mask, indices))
+        x = tf.nn.softmax(x, axis=-1)
+        window_scores = x
+
+        x = tf.layers.dropout(x, rate=self.dropout, training=self.training)
+
+        x = tf.matmul(x, tf.gather_nd(self.values, indices))
+
+        # scale by the whole memory length like unwindowed attention
+        s = tf.cast(key_length, dtype=tf.float32)
+        x = x / tf.sqrt(s)
+
+        # alignment scores are zero outside the window
+        alignment_scores = tf.scatter_nd(indices, tf.squeeze(window_scores, axis=1), tf.stack([batch_size, key_length]))
+        return x, tf.expand_dims(alignment_scores, axis=1)
+
     def register_metrics(self):
         if self.use_key_projection:
             self.key_projection.register_metrics()
@@ -145,6 +215,9 @@ class ScaledDotProductAttentionMechanism(AttentionMechanism):
     def _memory_mask(self, qk, memory_mask):
         if memory_mask is None:
             return qk
+        if memory_mask.shape.ndims == 3:
+            # (B, T_query, T_memory) mask of packed utterances
+            return qk + memory_mask
         # reshape mask to (B, 1, T_memory) to broadcast
         mask = tf.expand_dims(memory_mask, axis=1)
         return qk + mask
@@ -170,14 +243,14 @@ class AttentionLayer(tf.layers.Layer):
         self.out_projection = Linear(embed_dim, conv_channels, dropout=self.dropout,
                                      weight_initializer=self.out_projection_weight_initializer, name="out_projection")
 
-    def call(self, query, memory_mask=None):
+    def call(self, query, memory_mask=None, last_attended=None):
         residual = query
 
         # attention
         # (B, T//r, embed_dim)
         x = self.query_projection(query)
 
-        x, alignment_scores = self.attention_mechanism(x, memory_mask=memory_mask)
+        x, alignment_scores = self.attention_mechanism(x, memory_mask=memory_mask, last_attended=last_attended)
 
         # project back
         x = self.out_projection(x)
@@ -200,9 +273,14 @@ class CNNAttentionWrapper(CNNCell):
     def __init__(self, attention_mechanism, in_channels, out_channels, kernel_size, dilation, dropout,
                  is_incremental, r, memory_mask=None, kernel_initializer=None, query_projection_weight_initializer=None,
                  out_projection_weight_initializer=None,
+                 segment_ids=None,
+                 window=False,
                  training=False,
                  trainable=True,
                  name=None, **kwargs):
+        '''
+        :param window: if True, each incremental step attends only to a window around the last attended key
+        '''
         super(CNNAttentionWrapper, self).__init__(name=name, trainable=trainable, **kwargs)
         # To support residual connection in_channels == out_channels is necessary.
         assert in_channels == out_channels
@@ -219,6 +297,8 @@ class CNNAttentionWrapper(CNNCell):
         self._output_size = out_channels
         self.r = r
         self.memory_mask = memory_mask
+        self.segment_ids = segment_ids
+        self.window = window
         self._collect_metrics = training
 
     @property
@@ -266,15 +346,20 @@ class CNNAttentionWrapper(CNNCell):
         if self.is_incremental:
             query, next_cell_state = self.convolution(query, state.cell_state)
         else:
-            query = self.convolution(query)
+            query = self.convolution(query, segment_ids=self.segment_ids)
 
         query = query if frame_pos_embed is None else query + frame_pos_embed
         if self._collect_metrics:
             tf.summary.histogram("query", query)
 
-        output, attention_scores = self.attention(query, memory_mask=self.memory_mask)
+        # the previous alignment is zero at the first step, so the window starts at the first key
+        last_attended = tf.argmax(tf.squeeze(state.alignments, axis=1), axis=-1,
+                                  output_type=tf.int32) if self.is_incremental and self.window else None
+        output, attention_scores = self.attention(query, memory_mask=self.memory_mask, last_attended=last_attended)
         # attention_scores: (batch_size, T_query=1, T_memory)
-        alignment_history = state.alignment_history.write(state.time, attention_scores)
+        # the history keeps the whole batch when only some rows are decoded
+        alignment_history = state.alignment_history.write(
+            state.time, self.attention.attention_mechanism.scatter_rows(attention_scores))
         output = (output + residual) * math.sqrt(0.5)
         if self.is_incremental:
             return CNNAttentionWrapperInput(output, frame_pos_embed), CNNAttentionWrapperState(next_cell_state,
@@ -299,6 +384,8 @@ class MultiHopAttention(CNNCell):
     def __init__(self, attention_mechanism, in_channels, convolutions, r, is_incremental,
                  memory_mask=None, kernel_initializer=None, query_projection_weight_initializer=None,
                  out_projection_weight_initializer=None,
+                 segment_ids=None,
+                 window=False,
                  training=False,
                  trainable=True,
                  name=None, **kwargs):
@@ -310,6 +397,8 @@ class MultiHopAttention(CNNCell):
                                      dilation, dropout, is_incremental, r, memory_mask, kernel_initializer,
                                      query_projection_weight_initializer,
                                      out_projection_weight_initializer,
+                                     segment_ids,
+                                     window,
                                      training)
             next_in_channels = aw.output_size
             cells.append(aw)
@@ -517,6 +606,11 @@ class Decoder(tf.layers.Layer):
                  max_decoder_steps=200,
                  min_decoder_steps=10,
                  is_incremental=False,
+                 window_attention=False,
+                 window_ahead=3,
+                 window_backward=1,
+                 window_teacher_forcing=False,
+                 compact_finished=False,
                  prenet_weight_initializer=None,
                  prenet_bias_initializer=None,
                  attention_key_projection_weight_initializer=None,
@@ -532,6 +626,13 @@ class Decoder(tf.layers.Layer):
                  done_bias_initializer=None,
                  training=False, trainable=True,
                  name=None, **kwargs):
+        '''
+        :param window_attention: if True, each step of incremental decoding attends only to window_backward keys
+        before and window_ahead keys from the last attended key
+        :param window_teacher_forcing: if True, the window is also applied when test_inputs are given
+        :param compact_finished: if True, incremental decoding without test_inputs runs each step only on
+        the utterances that have not finished. Otherwise finished utterances are decoded and masked.
+        '''
         super(Decoder, self).__init__(name=name, trainable=trainable, **kwargs)
         self.embed_dim = embed_dim
         self.dropout = dropout
@@ -574,6 +675,12 @@ class Decoder(tf.layers.Layer):
         self.is_incremental = is_incremental
         self.training = training
 
+        self.window_attention = window_attention
+        self.window_ahead = window_ahead
+        self.window_backward = window_backward
+        self.window_teacher_forcing = window_teacher_forcing
+        self.compact_finished = compact_finished
+
         if attention_key_projection_weight_initializer is None and attention_query_projection_weight_initializer is None:
             # key projection and query projection should have the same weight values.
             # Otherwise, initial alignment built by positional encoding will be broken.
@@ -595,15 +702,22 @@ class Decoder(tf.layers.Layer):
         pass
 
     def call(self, encoder_out, input=None, text_positions=None, frame_positions=None, test_inputs=None,
-             memory_mask=None):
+             memory_mask=None, segment_ids=None):
+        '''
+        :param segment_ids: (B, T//r) ids of packed utterances per decoder step.
+        memory_mask must then be a (B, T//r, T_memory) mask that separates the packed utterances.
+        :return: outputs, done, attention states, and in incremental mode (B,) output lengths in decoder steps
+        '''
         if self.is_incremental:
-            return self._call_incremental(encoder_out, text_positions, test_inputs)
+            memory_mask = memory_mask if self.use_memory_mask else None
+            return self._call_incremental(encoder_out, text_positions, test_inputs, memory_mask=memory_mask)
         else:
             with tf.control_dependencies([tf.assert_equal(0, tf.shape(input)[1] % self.r)]):
                 return self._call(encoder_out, input, text_positions=text_positions, frame_positions=frame_positions,
-                                  memory_mask=memory_mask)
+                                  memory_mask=memory_mask, segment_ids=segment_ids)
 
-    def _call(self, encoder_out, inputs, text_positions=None, frame_positions=None, memory_mask=None):
+    def _call(self, encoder_out, inputs, text_positions=None, frame_positions=None, memory_mask=None,
+              segment_ids=None):
         if inputs.shape[-1].value == self.in_dim:
             inputs = self.reduce_inputs(inputs)
 
@@ -639,18 +753,21 @@ class Decoder(tf.layers.Layer):
                                                                  value_projection_weight_initializer=self.attention_value_projection_weight_initializer,
                                                                  value_projection_bias_initializer=self.attention_value_projection_bias_initializer,
                                                                  training=self.training)
-        memory_mask = memory_mask if self.use_memory_mask else None
+        # packed utterances must not attend to each other regardless of use_memory_mask
+        memory_mask = memory_mask if self.use_memory_mask or segment_ids is not None else None
         mp_attention = MultiHopAttention(attention_mechanism, self.preattention.output_size,
                                          self.mh_attentions, self.r, self.is_incremental,
                                          memory_mask=memory_mask,
                                          kernel_initializer=self.attention_kernel_initializer,
                                          query_projection_weight_initializer=self.attention_query_projection_weight_initializer,
                                          out_projection_weight_initializer=self.attention_out_projection_weight_initializer,
+                                         segment_ids=segment_ids,
                                          training=self.training)
 
+        # batch size is dynamic if batches are filled up to a frame budget
+        batch_size = inputs.shape[0].value or tf.shape(inputs)[0]
         x, alignments = mp_attention(CNNAttentionWrapperInput(x, frame_pos_embed),
-                                     mp_attention.zero_state(inputs.shape[0].value,
-                                                             inputs.dtype))  # ToDo: does not work when batch size is None
+                                     mp_attention.zero_state(batch_size, inputs.dtype))
 
         if self._collect_metrics:
             mp_attention.register_metrics()
@@ -665,18 +782,26 @@ class Decoder(tf.layers.Layer):
         done = self.fc(x)
         return outputs, done, alignments
 
-    def _call_incremental(self, encoder_out, text_positions, test_inputs=None):
+    def _call_incremental(self, encoder_out, text_positions, test_inputs=None, memory_mask=None):
+        '''
+        :param memory_mask: (B, T_memory) mask of padded keys
+        :return: outputs, done probabilities of the last step of each utterance, attention states and
+        (B,) numbers of decoder steps of each utterance. Outputs after the last step of an utterance are zero.
+        '''
         if test_inputs is not None and test_inputs.shape[-1].value == self.in_dim:
             test_inputs = self.reduce_inputs(test_inputs)
 
         keys, values = encoder_out
-        batch_size = keys.shape[0].value
+        batch_size = keys.shape[0].value or tf.shape(keys)[0]
         # position encodings
         w = self.key_position_rate
         text_pos_embed = self.embed_key_positions(text_positions, w)
         keys = keys + text_pos_embed
 
+        window = self.window_attention and (test_inputs is None or self.window_teacher_forcing)
         attention_mechanism = ScaledDotProductAttentionMechanism(keys, values, self.embed_dim,
+                                                                 window_ahead=self.window_ahead,
+                                                                 window_backward=self.window_backward,
                                                                  key_projection_weight_initializer=self.attention_key_projection_weight_initializer,
                                                                  key_projection_bias_initializer=self.attention_key_projection_bias_initializer,
                                                                  value_projection_weight_initializer=self.attention_value_projection_weight_initializer,
@@ -684,71 +809,124 @@ class Decoder(tf.layers.Layer):
                                                                  training=self.training)
         attention = MultiHopAttention(attention_mechanism, self.preattention.output_size,
                                       self.mh_attentions, self.r, self.is_incremental,
+                                      memory_mask=memory_mask,
                                       kernel_initializer=self.attention_kernel_initializer,
                                       query_projection_weight_initializer=self.attention_query_projection_weight_initializer,
                                       out_projection_weight_initializer=self.attention_out_projection_weight_initializer,
+                                      window=window,
                                       training=self.training)
 
         test_input_length = 0 if test_inputs is None else tf.shape(test_inputs)[1]
         # append one element to avoid index overflow
         test_inputs = test_inputs if test_inputs is None else self.append_unused_final_test_input(test_inputs,
                                                                                                   batch_size)
+        # all rows are decoded to the end with teacher forcing
+        compact = self.compact_finished and test_inputs is None
 
         def condition(time, unused_input, unused_preattention_state, unused_attention_state, unused_frame_pos,
                       unused_last_conv_state,
-                      unused_outputs, done):
-            termination_criteria = tf.greater(done, 0.5)
-            minimum_requirement = tf.greater(time, self.min_decoder_steps)
-            maximum_criteria = tf.greater_equal(time, self.max_decoder_steps)
-            termination = tf.logical_or(tf.logical_and(termination_criteria, minimum_requirement), maximum_criteria)
+                      unused_outputs, unused_done, finished, unused_lengths, unused_rows, unused_memory):
             # tf.while_loop continues body until cond returns False
-            result = tf.logical_not(termination)
-            return tf.squeeze(tf.reduce_all(result, axis=0))
+            return tf.logical_not(tf.reduce_all(finished))
 
         def test_condition(time, unused_input, unused_preattention_state, unused_attention_state, unused_frame_pos,
                            unused_last_conv_state,
-                           unused_outputs, done):
+                           unused_outputs, unused_done, unused_finished, unused_lengths, unused_rows, unused_memory):
             return tf.less(time, test_input_length)
 
-        def body(time, input, preattention_state, attention_state, frame_pos, last_conv_state, outputs, done):
+        def body(time, input, preattention_state, attention_state, frame_pos, last_conv_state, outputs, done,
+                 finished, lengths, rows, memory):
+            '''
+            finished, done and lengths are of the whole batch. The other states are of the rows that are decoded.
+            In compact mode, they are the rows that have not finished, and memory is their keys, values and
+            memory mask.
+            '''
             w = self.query_position_rate
             frame_pos_embed = self.embed_query_positions(frame_pos, w)
             x = tf.layers.dropout(input, rate=self.dropout, training=self.training)
             x, next_preattention_state = self.preattention(x, state=preattention_state)
-            (x, _), next_attention_states = attention.apply(CNNAttentionWrapperInput(x, frame_pos_embed),
-                                                            attention_state)
+            if compact:
+                with attention_mechanism.select_rows(rows, *memory):
+                    (x, _), next_attention_states = attention.apply(CNNAttentionWrapperInput(x, frame_pos_embed),
+                                                                    attention_state)
+            else:
+                (x, _), next_attention_states = attention.apply(CNNAttentionWrapperInput(x, frame_pos_embed),
+                                                                attention_state)
             x, next_last_conv_state = self.last_conv(x, last_conv_state)
             # project to mel-spectorgram
             output = tf.sigmoid(x)
             # Done flag
-            done = tf.squeeze(tf.sigmoid(self.fc(x)), axis=[1, 2])
-            outputs = outputs.write(time, output)
+            step_done = tf.squeeze(tf.sigmoid(self.fc(x)), axis=[1, 2])
             next_time = time + 1
             next_frame_pos = frame_pos + 1
-            output = output if test_inputs is None else tf.expand_dims(test_inputs[:, next_time, :], axis=1)
+
+            if compact:
+                indices = tf.expand_dims(rows, axis=1)
+                batch_output = tf.scatter_nd(indices, output,
+                                             tf.concat([tf.shape(finished), tf.shape(output)[1:]], axis=0))
+                step_done = tf.scatter_nd(indices, step_done, tf.shape(done))
+            else:
+                batch_output = tf.where(finished, tf.zeros_like(output), output)
+            outputs = outputs.write(time, batch_output)
+            # rows that have finished keep their done flags and lengths
+            done = tf.where(finished, done, step_done)
+            lengths = tf.where(finished, lengths, tf.fill(tf.shape(lengths), next_time))
+
+            if test_inputs is not None:
+                next_input = tf.expand_dims(test_inputs[:, next_time, :], axis=1)
+                return (
+                    next_time, next_input, next_preattention_state, next_attention_states, next_frame_pos,
+                    next_last_conv_state, outputs, done, finished, lengths, rows, memory)
+
+            termination_criteria = tf.greater(done, 0.5)
+            minimum_requirement = tf.greater(next_time, self.min_decoder_steps)
+            maximum_criteria = tf.greater_equal(next_time, self.max_decoder_steps)
+            finished = tf.logical_or(finished, tf.logical_or(tf.logical_and(termination_criteria, minimum_requirement),
+                                                             maximum_criteria))
+            next_input = output
+            if compact:
+                # drop the rows that have finished from the states of the next step
+                keep = tf.squeeze(tf.where(tf.logical_not(tf.gather(finished, rows))), axis=1)
+                (next_input, next_preattention_state, next_attention_states, next_frame_pos, next_last_conv_state,
+                 rows, memory) = nest.map_structure(lambda t: _gather_rows(t, keep), (
+                    next_input, next_preattention_state, next_attention_states, next_frame_pos, next_last_conv_state,
+                    rows, memory))
             return (
-                next_time, output, next_preattention_state, next_attention_states, next_frame_pos, next_last_conv_state,
-                outputs,
-                done)
+                next_time, next_input, next_preattention_state, next_attention_states, next_frame_pos,
+                next_last_conv_state, outputs, done, finished, lengths, rows, memory)
 
         time = tf.constant(0)
-        outputs_ta = tf.TensorArray(dtype=tf.float32, size=self.max_decoder_steps,
-                                    element_shape=tf.TensorShape([batch_size, 1, self.in_dim * self.r]))
-        initial_done = tf.constant(shape=[batch_size], value=0, dtype=tf.float32)
+        # outputs have as many steps as the longest utterance. Steps that are never written cannot be stacked
+        # when the batch size is unknown.
+        outputs_ta = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True,
+                                    element_shape=tf.TensorShape([keys.shape[0], 1, self.in_dim * self.r]))
+        initial_done = tf.zeros(shape=[batch_size], dtype=tf.float32)
+        initial_finished = tf.zeros(shape=[batch_size], dtype=tf.bool)
+        initial_lengths = tf.zeros(shape=[batch_size], dtype=tf.int32)
+        initial_rows = tf.range(batch_size)
+        initial_memory = (attention_mechanism.keys, attention_mechanism.values) + (
+            () if memory_mask is None else (memory_mask,)) if compact else ()
         condition_function = condition if test_inputs is None else test_condition
         initial_input = self.initial_input(batch_size) if test_inputs is None else tf.expand_dims(test_inputs[:, 0, :],
                                                                                                   axis=1)
-        _, _, _, final_attention_state, _, _, out_online_ta, done = tf.while_loop(condition_function, body, (
-            time, initial_input, self.preattention.zero_state(batch_size, tf.float32),
-            attention.zero_state(batch_size, tf.float32),
-            self.initial_frame_pos(batch_size), self.last_conv.zero_state(batch_size, tf.float32), outputs_ta,
-            initial_done))
+        loop_vars = (time, initial_input, self.preattention.zero_state(batch_size, tf.float32),
+                     attention.zero_state(batch_size, tf.float32),
+                     self.initial_frame_pos(batch_size), self.last_conv.zero_state(batch_size, tf.float32), outputs_ta,
+                     initial_done, initial_finished, initial_lengths, initial_rows, initial_memory)
+        if compact:
+            # the number of decoded rows shrinks as utterances finish
+            shape_invariants = nest.map_structure(_row_shape_invariant, loop_vars)
+            _, _, _, final_attention_state, _, _, out_online_ta, done, _, lengths, _, _ = tf.while_loop(
+                condition_function, body, loop_vars, shape_invariants=shape_invariants)
+        else:
+            _, _, _, final_attention_state, _, _, out_online_ta, done, _, lengths, _, _ = tf.while_loop(
+                condition_function, body, loop_vars)
         output_online = nest.map_structure(lambda ta: ta.stack(), out_online_ta)
 
         output_online = tf.squeeze(output_online, axis=2)
         output_online = tf.transpose(output_online, perm=(1, 0, 2))
 
-        return output_online, done, final_attention_state
+        return output_online, done, final_attention_state, lengths
 
     def initial_input(self, batch_size):
         return tf.zeros(shape=(batch_size, 1, self.in_dim * self.r))
@@ -778,6 +956,21 @@ class Decoder(tf.layers.Layer):
         self.last_conv.register_metrics()
 
 
+def _gather_rows(t, indices):
+    # scalars and TensorArrays are not batched
+    if isinstance(t, tf.TensorArray) or t.shape.ndims == 0:
+        return t
+    return tf.gather(t, indices)
+
+
+def _row_shape_invariant(t):
+    if isinstance(t, tf.TensorArray):
+        return tf.TensorShape(None)
+    if t.shape.ndims == 0:
+        return t.shape
+    return tf.TensorShape([None]).concatenate(t.shape[1:])
+
+
 class Converter(tf.layers.Layer):
 
     def __init__(self, in_dim, out_dim, convolutions=((256, 5, 1),) * 4,
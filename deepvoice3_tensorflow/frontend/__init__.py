@@ -1,8 +1,11 @@
 import tensorflow as tf
 import collections
 import math
+from multiprocessing import cpu_count
 from abc import abstractmethod
 from data import PreprocessedTargetData, PreprocessedSourceData
+from deepvoice3_tensorflow.frontend.bucketing import BucketBoundaries, bucket_id, fixed_width_bucket_boundaries, \
+    budget_batch_sizes
 from data.tfrecord_utils import parse_preprocessed_source_data, parse_preprocessed_target_data, \
     decode_preprocessed_source_data, decode_preprocessed_target_data
 
@@ -37,22 +40,154 @@ class PreparedTargetDataWithMask(
     pass
 
 
+class PackedSourceData(collections.namedtuple("PackedSourceData",
+                                              ["id", "text", "source", "source_length", "text_positions",
+                                               "segment_ids"])):
+    pass
+
+
+class PackedSourceDataWithMask(collections.namedtuple("PackedSourceDataWithMask",
+                                                      ["id", "text", "source", "source_length", "text_positions",
+                                                       "segment_ids", "mask"])):
+    pass
+
+
+class PackedTargetData(
+    collections.namedtuple("PackedTargetData",
+                           ["id", "spec", "spec_width", "mel", "mel_width", "target_length", "done",
+                            "frame_positions", "spec_loss_mask", "binary_loss_mask", "segment_ids"])):
+    pass
+
+
+# Training modes decide which target columns are loaded. Only the postnet needs linear spectrograms.
+TRAIN_SEQ2SEQ = "seq2seq"
+TRAIN_POSTNET = "postnet"
+TRAIN_SEQ2SEQ_AND_POSTNET = "seq2seq_and_postnet"
+
+# Batch modes. Budget batches are filled up to a number of padded frames and source tokens.
+BATCH_FIXED = "fixed"
+BATCH_BUDGET = "budget"
+# Packed batches hold rows of several short utterances concatenated up to a number of frames and source tokens.
+BATCH_PACKED = "packed"
+
+
 def _lcm(a, b):
     return a * b // math.gcd(a, b)
 
 
+def _autotune(fallback):
+    # AUTOTUNE is not available in older TensorFlow
+    return getattr(tf.contrib.data, "AUTOTUNE", fallback)
+
+
+def num_parallel_calls(hparams):
+    '''
+    :return: num_parallel_calls of maps from hparams.input_num_parallel_calls.
+    A negative value means autotune and None or 0 means sequential maps.
+    '''
+    value = getattr(hparams, "input_num_parallel_calls", None)
+    if not value:
+        return None
+    return _autotune(cpu_count()) if value < 0 else value
+
+
+def prefetch_buffer_size(hparams):
+    '''
+    :return: number of prefetched elements from hparams.input_prefetch_buffer_size, negative for autotune.
+    None means no prefetch.
+    '''
+    value = getattr(hparams, "input_prefetch_buffer_size", None)
+    if not value:
+        return None
+    return _autotune(2) if value < 0 else value
+
+
+def read_tfrecords(files, hparams):
+    '''
+    Reads hparams.input_num_parallel_reads files concurrently.
+    Records keep file order, so sources and targets can still be zipped.
+    '''
+    files = list(files)
+    num_parallel_reads = getattr(hparams, "input_num_parallel_reads", 1)
+    if num_parallel_reads <= 1:
+        return tf.data.TFRecordDataset(files)
+    # a block spans whole files, so files are read ahead in parallel but emitted one after another
+    return tf.data.Dataset.from_tensor_slices(files).apply(
+        tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset, cycle_length=num_parallel_reads,
+                                            block_length=2 ** 62, sloppy=False))
+
+
+def loads_spec(hparams):
+    return getattr(hparams, "train_mode", TRAIN_SEQ2SEQ_AND_POSTNET) != TRAIN_SEQ2SEQ
+
+
+def _spec_width(hparams):
+    # linear spectrograms that are not loaded are empty tensors of width 0
+    return hparams.fft_size // 2 + 1 if loads_spec(hparams) else 0
+
+
 class Frontend():
 
-    def __init__(self, source, target, hparams):
+    def __init__(self, source, target, hparams, decoded_target=False, spec=None):
+        '''
+        :param decoded_target: True if target already yields PreprocessedTargetData instead of serialized records
+        :param spec: serialized linear spectrogram records if they are stored apart from mel records in target
+        '''
         self.source = source
         self.target = target
         self.hparams = hparams
+        self.decoded_target = decoded_target
+        self.spec = spec
+
+    @staticmethod
+    def from_tfrecord_files(source_files, target_files, hparams, spec_files=None):
+        '''
+        Reads either one TFRecord file per utterance or multi-example shards.
+        Records are read in file order, so source and target files must list the same ids in the same order.
+        :param spec_files: files of linear spectrogram records if target files only contain mel records.
+        They are not read in the seq2seq training mode.
+        '''
+        source = read_tfrecords(source_files, hparams)
+        target = read_tfrecords(target_files, hparams)
+        spec = read_tfrecords(spec_files, hparams) if spec_files is not None and loads_spec(hparams) else None
+        return Frontend(source, target, hparams, spec=spec)
+
+    @staticmethod
+    def from_packed_store(source_files, target_store, hparams):
+        '''
+        Reads targets from a data.packed_store.PackedFeatureStore.
+        Frames are sliced from the memory mapped store instead of being parsed and decoded per record.
+        '''
+        source = read_tfrecords(source_files, hparams)
+        return Frontend(source, target_store.dataset(with_spec=loads_spec(hparams)), hparams, decoded_target=True)
 
     def _decode_source(self):
-        return self.source.map(lambda d: decode_preprocessed_source_data(parse_preprocessed_source_data(d)))
+        return self.source.map(lambda d: decode_preprocessed_source_data(parse_preprocessed_source_data(d)),
+                               num_parallel_calls=num_parallel_calls(self.hparams))
 
     def _decode_target(self):
-        return self.target.map(lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d)))
+        if self.decoded_target:
+            return self.target
+        with_spec = loads_spec(self.hparams)
+        if self.spec is None:
+            return self.target.map(
+                lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d, with_spec=with_spec)),
+                num_parallel_calls=num_parallel_calls(self.hparams))
+
+        def merge(mel: PreprocessedTargetData, spec: PreprocessedTargetData):
+            with tf.control_dependencies([tf.assert_equal(mel.id, spec.id)]):
+                return mel._replace(spec=tf.identity(spec.spec), spec_width=spec.spec_width)
+
+        mel = self.target.map(
+            lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d, with_spec=False)),
+            num_parallel_calls=num_parallel_calls(self.hparams))
+        if not with_spec:
+            return mel
+        spec = self.spec.map(
+            lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d, with_mel=False)),
+            num_parallel_calls=num_parallel_calls(self.hparams))
+        return tf.data.Dataset.zip((mel, spec)).map(lambda m, s: merge(m, s),
+                                                    num_parallel_calls=num_parallel_calls(self.hparams))
 
     def prepare_source(self):
         def convert(inputs: PreprocessedSourceData):
@@ -65,7 +200,8 @@ class Frontend():
             return PreparedSourceData(inputs.id, inputs.text, inputs.source, inputs.source_length, text_positions1,
                                       inputs.text2, inputs.source2, inputs.source_length2, text_positions2)
 
-        return self._decode_source().map(lambda inputs: convert(inputs))
+        return self._decode_source().map(lambda inputs: convert(inputs),
+                                         num_parallel_calls=num_parallel_calls(self.hparams))
 
     def prepare_target(self):
         def convert(target: PreprocessedTargetData):
@@ -94,7 +230,7 @@ class Frontend():
             spec = tf.cond(no_padding_condition, lambda: spec, padding_function(spec))
             mel = tf.cond(no_padding_condition, lambda: mel, padding_function(mel))
 
-            spec.set_shape((None, self.hparams.fft_size // 2 + 1))
+            spec.set_shape((None, _spec_width(self.hparams)))
             mel.set_shape((None, self.hparams.num_mels))
 
             # done flag
@@ -104,25 +240,208 @@ class Frontend():
                               tf.ones(done_tail_size, dtype=tf.float32)], axis=0)
             return _PreparedTargetData(target.id, spec, target.spec_width, mel, target.mel_width, target_length, done)
 
-        return self._decode_target().map(lambda inputs: convert(inputs))
+        return self._decode_target().map(lambda inputs: convert(inputs),
+                                         num_parallel_calls=num_parallel_calls(self.hparams))
 
     def prepare(self):
         return _FrontendPreparedView(self.prepare_source(), self.prepare_target(), self.hparams)
 
 
+def _swap_source_random(s: PreparedSourceData, swap_probability):
+    r = tf.random_uniform(shape=(), minval=0, maxval=1)
+
+    def s1():
+        return s.text, s.source, s.source_length, s.text_positions
+
+    def s2():
+        return s.text2, s.source2, s.source_length2, s.text_positions2
+
+    condition = r > swap_probability
+    text, source, source_length, text_positions = tf.cond(condition, s1, s2)
+    text2, source2, source_length2, text_positions2 = tf.cond(condition, s2, s1)
+
+    return PreparedSourceData(
+        id=s.id,
+        text=text,
+        source=source,
+        source_length=source_length,
+        text_positions=text_positions,
+        text2=text2,
+        source2=source2,
+        source_length2=source_length2,
+        text_positions2=text_positions2,
+    )
+
+
+def _add_memory_mask(s: PreparedSourceData):
+    mask_value = -1e9
+
+    def to_float_mask(mask):
+        return tf.to_float(tf.logical_not(mask)) * mask_value
+
+    s1_mask = to_float_mask(tf.sequence_mask(s.source_length, tf.shape(s.source)[1]))
+    s2_mask = to_float_mask(tf.sequence_mask(s.source_length2, tf.shape(s.source2)[1]))
+
+    return PreparedSourceDataWithMask(
+        id=s.id,
+        text=s.text,
+        source=s.source,
+        source_length=s.source_length,
+        mask=s1_mask,
+        text_positions=s.text_positions,
+        text2=s.text2,
+        source2=s.source2,
+        source_length2=s.source_length2,
+        text_positions2=s.text_positions2,
+        mask2=s2_mask,
+    )
+
+
+def _frame_positions(mel, r, mel_downsample_step):
+    max_decoder_target_len = tf.shape(mel)[1] // r // mel_downsample_step
+    # batch size is taken from mel since batches filled up to a frame budget vary in size
+    return tf.tile(tf.expand_dims(tf.range(1, max_decoder_target_len + 1), axis=0), [tf.shape(mel)[0], 1])
+
+
+def _target_masks(target_length, mel, frame_positions, r, downsample_step, mel_downsample_step):
+    def to_float_mask(mask):
+        return tf.to_float(mask)
+
+    spec_loss_mask = to_float_mask(
+        tf.sequence_mask(target_length // downsample_step, tf.shape(mel)[1] // mel_downsample_step))
+    binary_loss_mask = to_float_mask(
+        tf.sequence_mask(target_length // r // downsample_step, tf.shape(frame_positions)[1]))
+    return spec_loss_mask, binary_loss_mask
+
+
+def _padded_shapes(hparams):
+    return (
+        PreparedSourceData(
+            id=tf.TensorShape([]),
+            text=tf.TensorShape([]),
+            source=tf.TensorShape([None]),
+            source_length=tf.TensorShape([]),
+            text_positions=tf.TensorShape([None]),
+            text2=tf.TensorShape([]),
+            source2=tf.TensorShape([None]),
+            source_length2=tf.TensorShape([]),
+            text_positions2=tf.TensorShape([None]),
+        ),
+        _PreparedTargetData(
+            id=tf.TensorShape([]),
+            spec=tf.TensorShape([None, _spec_width(hparams)]),
+            spec_width=tf.TensorShape([]),
+            mel=tf.TensorShape([None, hparams.num_mels]),
+            mel_width=tf.TensorShape([]),
+            target_length=tf.TensorShape([]),
+            done=tf.TensorShape([None]),
+        ))
+
+
+def _padding_values():
+    return (
+        PreparedSourceData(
+            id=tf.to_int64(0),
+            text="",
+            source=tf.to_int64(0),
+            source_length=tf.to_int64(0),
+            text_positions=tf.to_int64(0),
+            text2="",
+            source2=tf.to_int64(0),
+            source_length2=tf.to_int64(0),
+            text_positions2=tf.to_int64(0),
+        ),
+        _PreparedTargetData(
+            id=tf.to_int64(0),
+            spec=tf.to_float(0),
+            spec_width=tf.to_int64(0),
+            mel=tf.to_float(0),
+            mel_width=tf.to_int64(0),
+            target_length=tf.to_int64(0),
+            done=tf.to_float(1),
+        ))
+
+
+def _concat_segments(s: PreparedSourceData, t: _PreparedTargetData, r, downsample_step):
+    '''
+    Concatenates a padded batch of utterances with downsampled mel into one packed row.
+    '''
+    length_factor = _lcm(r, downsample_step)
+
+    def concat(x, lengths):
+        # (K, T, ...) -> (sum of lengths, ...)
+        return tf.boolean_mask(x, tf.sequence_mask(lengths, tf.shape(x)[1]))
+
+    def per_segment(values, lengths):
+        # values of segments repeated over their frames
+        return concat(tf.tile(tf.expand_dims(values, axis=1), tf.stack([1, tf.reduce_max(lengths)])), lengths)
+
+    def local_positions(lengths):
+        return concat(tf.tile(tf.expand_dims(tf.range(tf.reduce_max(lengths)), axis=0),
+                              tf.stack([tf.size(lengths), 1])), lengths)
+
+    segments = tf.range(1, tf.size(s.id) + 1)
+    source_length = tf.to_int32(s.source_length)
+    target_length = tf.to_int32(t.target_length)
+    # lengths that Frontend.prepare_target pads targets to. Segment boundaries fall on decoder steps.
+    spec_lengths = (target_length + length_factor - 1) // length_factor * length_factor
+    frame_lengths = spec_lengths // downsample_step
+    num_steps = frame_lengths // r
+    step_positions = local_positions(num_steps)
+    local_frames = local_positions(frame_lengths)
+    return PackedSourceData(
+        id=s.id[0],
+        text=tf.reduce_join(s.text, separator=" "),
+        source=concat(s.source, source_length),
+        source_length=tf.reduce_sum(s.source_length),
+        text_positions=concat(s.text_positions, source_length),
+        segment_ids=per_segment(segments, source_length),
+    ), PackedTargetData(
+        id=t.id[0],
+        spec=concat(t.spec, spec_lengths),
+        spec_width=t.spec_width[0],
+        mel=concat(t.mel, frame_lengths),
+        mel_width=t.mel_width[0],
+        target_length=tf.reduce_sum(t.target_length),
+        done=concat(t.done, num_steps),
+        frame_positions=step_positions + 1,
+        # the first decoder step of an utterance is predicted from the last step of the previous one
+        spec_loss_mask=tf.to_float(tf.logical_and(
+            tf.greater_equal(local_frames, r),
+            tf.less(local_frames, per_segment(target_length // downsample_step, frame_lengths)))),
+        binary_loss_mask=tf.to_float(
+            tf.less(step_positions, per_segment(target_length // r // downsample_step, num_steps))),
+        segment_ids=per_segment(segments, num_steps),
+    )
+
+
+def _packed_memory_mask(source_segment_ids, target_segment_ids):
+    '''
+    :return: (B, T_query, T_memory) mask that lets decoder steps attend only to their own utterance
+    '''
+    mask_value = -1e9
+    same_segment = tf.equal(tf.expand_dims(target_segment_ids, axis=2), tf.expand_dims(source_segment_ids, axis=1))
+    return tf.to_float(tf.logical_not(same_segment)) * mask_value
+
+
 class _FrontendPreparedView():
-    def __init__(self, source: tf.data.Dataset, target: tf.data.Dataset, hparams):
+    def __init__(self, source: tf.data.Dataset, target: tf.data.Dataset, hparams, mel_downsampled=False):
+        '''
+        :param mel_downsampled: True if mel of target is already downsampled by hparams.downsample_step
+        '''
         self.source = source
         self.target = target
         self.hparams = hparams
+        self.mel_downsampled = mel_downsampled
 
     def zip_source_and_target(self):
         def assert_id(source, target):
             with tf.control_dependencies([tf.assert_equal(source.id, target.id)]):
                 return (source, target)
 
-        zipped = tf.data.Dataset.zip((self.source, self.target)).map(lambda x, y: assert_id(x, y))
-        return _FrontendZippedView(zipped, self.hparams)
+        zipped = tf.data.Dataset.zip((self.source, self.target)).map(lambda x, y: assert_id(x, y),
+                                                                     num_parallel_calls=num_parallel_calls(self.hparams))
+        return _FrontendZippedView(zipped, self.hparams, self.mel_downsampled)
 
 
 class FrontendZippedViewBase:
@@ -141,6 +460,9 @@ class FrontendZippedViewBase:
     def apply(self, dataset, hparams):
         raise NotImplementedError("apply")
 
+    def _map(self, map_func):
+        return self.dataset.map(map_func, num_parallel_calls=num_parallel_calls(self.hparams))
+
     def shuffle(self, buffer_size):
         return self.apply(self.dataset.shuffle(buffer_size), self.hparams)
 
@@ -149,28 +471,9 @@ class FrontendZippedViewBase:
 
     def swap_source_random(self, swap_probability):
         def convert(s: PreparedSourceData, t):
-            r = tf.random_uniform(shape=(), minval=0, maxval=1)
-            def s1():
-                return s.text, s.source, s.source_length, s.text_positions
-            def s2():
-                return s.text2, s.source2, s.source_length2, s.text_positions2
-            condition = r > swap_probability
-            text, source, source_length, text_positions = tf.cond(condition, s1, s2)
-            text2, source2, source_length2, text_positions2 = tf.cond(condition, s2, s1)
-
-            return PreparedSourceData(
-                id=s.id,
-                text=text,
-                source=source,
-                source_length=source_length,
-                text_positions=text_positions,
-                text2=text2,
-                source2=source2,
-                source_length2=source_length2,
-                text_positions2=text_positions2,
-            ), t
+            return _swap_source_random(s, swap_probability), t
 
-        return self.apply(self.dataset.map(lambda x, y: convert(x, y)), self.hparams)
+        return self.apply(self._map(lambda x, y: convert(x, y)), self.hparams)
 
     def swap_source(self):
         def convert(s: PreparedSourceData, t):
@@ -186,16 +489,32 @@ class FrontendZippedViewBase:
                 text_positions2=s.text_positions,
             ), t
 
-        return self.apply(self.dataset.map(lambda x, y: convert(x, y)), self.hparams)
+        return self.apply(self._map(lambda x, y: convert(x, y)), self.hparams)
+
+    def cache(self, filename=""):
+        '''
+        :param filename: prefix of cache files, see cache.prepared_cache_filename. Elements are kept in memory if empty.
+        '''
+        return self.apply(self.dataset.cache(filename), self.hparams)
 
     def filter(self, predicate):
         return self.apply(tf.data.Dataset.filter(self.dataset, predicate), self.hparams)
 
+    def prefetch(self, buffer_size=None):
+        '''
+        :param buffer_size: number of prefetched elements. hparams.input_prefetch_buffer_size if None.
+        '''
+        buffer_size = prefetch_buffer_size(self.hparams) if buffer_size is None else buffer_size
+        if buffer_size is None:
+            return self
+        return self.apply(self.dataset.prefetch(buffer_size), self.hparams)
+
 
 class _FrontendZippedView(FrontendZippedViewBase):
-    def __init__(self, zipped: tf.data.Dataset, hparams):
+    def __init__(self, zipped: tf.data.Dataset, hparams, mel_downsampled=False):
         self._dataset = zipped
         self._hparams = hparams
+        self.mel_downsampled = mel_downsampled
 
     @property
     def dataset(self):
@@ -206,104 +525,149 @@ class _FrontendZippedView(FrontendZippedViewBase):
         return self._hparams
 
     def apply(self, dataset, hparams):
-        return _FrontendZippedView(dataset, hparams)
+        return _FrontendZippedView(dataset, hparams, self.mel_downsampled)
 
-    def group_by_batch(self):
+    def group_by_batch(self, bucket_boundaries: BucketBoundaries = None):
+        '''
+        :param bucket_boundaries: buckets of target and source lengths, see bucketing.bucket_boundaries_from_metadata.
+        If None, targets are bucketed by fixed width from hparams.approx_min_target_length.
+        '''
         batch_size = self.hparams.batch_size
         approx_min_target_length = self.hparams.approx_min_target_length
         bucket_width = self.hparams.batch_bucket_width
         num_buckets = self.hparams.batch_num_buckets
 
         def key_func(source, target):
-            target_length = tf.minimum(target.target_length - approx_min_target_length, 0)
-            bucket_id = target_length // bucket_width
-            return tf.minimum(tf.to_int64(num_buckets), bucket_id)
+            if bucket_boundaries is not None:
+                source_length = tf.maximum(source.source_length, source.source_length2)
+                return bucket_id(target.target_length, source_length, bucket_boundaries)
+            target_length = tf.maximum(target.target_length - approx_min_target_length, 0)
+            bucket = target_length // bucket_width
+            return tf.minimum(tf.to_int64(num_buckets), bucket)
 
         def reduce_func(unused_key, window: tf.data.Dataset):
-            # ToDo: use padded_batch instead of padded_batch_and_drop_remainder
-            # Currently this model only works with static batch size
-            apply_fn = tf.contrib.data.padded_batch_and_drop_remainder(batch_size, padded_shapes=(
-                PreparedSourceData(
-                    id=tf.TensorShape([]),
-                    text=tf.TensorShape([]),
-                    source=tf.TensorShape([None]),
-                    source_length=tf.TensorShape([]),
-                    text_positions=tf.TensorShape([None]),
-                    text2=tf.TensorShape([]),
-                    source2=tf.TensorShape([None]),
-                    source_length2=tf.TensorShape([]),
-                    text_positions2=tf.TensorShape([None]),
-                ),
-                _PreparedTargetData(
-                    id=tf.TensorShape([]),
-                    spec=tf.TensorShape([None, self.hparams.fft_size // 2 + 1]),
-                    spec_width=tf.TensorShape([]),
-                    mel=tf.TensorShape([None, self.hparams.num_mels]),
-                    mel_width=tf.TensorShape([]),
-                    target_length=tf.TensorShape([]),
-                    done=tf.TensorShape([None]),
-                )), padding_values=(
-                PreparedSourceData(
-                    id=tf.to_int64(0),
-                    text="",
-                    source=tf.to_int64(0),
-                    source_length=tf.to_int64(0),
-                    text_positions=tf.to_int64(0),
-                    text2="",
-                    source2=tf.to_int64(0),
-                    source_length2=tf.to_int64(0),
-                    text_positions2=tf.to_int64(0),
-                ),
-                _PreparedTargetData(
-                    id=tf.to_int64(0),
-                    spec=tf.to_float(0),
-                    spec_width=tf.to_int64(0),
-                    mel=tf.to_float(0),
-                    mel_width=tf.to_int64(0),
-                    target_length=tf.to_int64(0),
-                    done=tf.to_float(1),
-                )))
-            return window.apply(apply_fn)
+            return window.apply(tf.contrib.data.padded_batch_and_drop_remainder(
+                batch_size, padded_shapes=_padded_shapes(self.hparams), padding_values=_padding_values()))
 
         batched = self.dataset.apply(tf.contrib.data.group_by_window(key_func,
                                                                      reduce_func,
                                                                      window_size=batch_size*5))
-        return _FrontendBatchedView(batched, self.hparams)
+        return _FrontendBatchedView(batched, self.hparams, self.mel_downsampled)
+
+    def batch_in_order(self):
+        '''
+        Batches utterances in the order they are read without bucketing, and keeps the last smaller batch,
+        so that every utterance is batched.
+        '''
+        batched = self.dataset.padded_batch(self.hparams.batch_size, padded_shapes=_padded_shapes(self.hparams),
+                                            padding_values=_padding_values())
+        return _FrontendBatchedView(batched, self.hparams, self.mel_downsampled)
+
+    def group_by_budget(self, bucket_boundaries: BucketBoundaries = None):
+        '''
+        Batches utterances of a bucket up to hparams.batch_max_frames padded target frames and
+        hparams.batch_max_source_tokens padded source tokens, so batch size varies between buckets.
+        Utterances longer than hparams.max_target_length frames or hparams.max_source_length tokens are dropped.
+        :param bucket_boundaries: buckets of target and source lengths, see bucketing.bucket_boundaries_from_metadata.
+        If None, targets are bucketed by fixed width from hparams.approx_min_target_length.
+        '''
+        hparams = self.hparams
+        boundaries = fixed_width_bucket_boundaries(hparams) if bucket_boundaries is None else bucket_boundaries
+        batch_sizes = tf.constant(
+            budget_batch_sizes(boundaries, hparams.batch_max_frames, hparams.batch_max_source_tokens,
+                               hparams.max_target_length, hparams.max_source_length, hparams.outputs_per_step,
+                               hparams.downsample_step), dtype=tf.int64)
+
+        def source_length(source):
+            # sources are swapped after batching, so both of them count
+            return tf.maximum(source.source_length, source.source_length2)
+
+        def within_cap(source, target):
+            return tf.logical_and(tf.less_equal(target.target_length, hparams.max_target_length),
+                                  tf.less_equal(source_length(source), hparams.max_source_length))
 
+        def key_func(source, target):
+            return bucket_id(target.target_length, source_length(source), boundaries)
+
+        def window_size_func(key):
+            return tf.gather(batch_sizes, key)
+
+        def reduce_func(key, window: tf.data.Dataset):
+            return window.padded_batch(window_size_func(key), padded_shapes=_padded_shapes(hparams),
+                                       padding_values=_padding_values())
+
+        batched = self.dataset.filter(within_cap).apply(
+            tf.contrib.data.group_by_window(key_func, reduce_func, window_size_func=window_size_func))
+        return _FrontendBatchedView(batched, hparams, self.mel_downsampled)
+
+    def pack(self, bucket_boundaries: BucketBoundaries = None):
+        '''
+        Concatenates utterances of a bucket into rows of up to hparams.pack_max_frames target frames and
+        hparams.pack_max_source_tokens source tokens.
+        Each row has segment ids, and text and frame positions that start over at every utterance.
+        Rows are already downsampled and masked, and they only have the first source of every utterance,
+        so apply swap_source_random before packing.
+        Utterances longer than hparams.max_target_length frames or hparams.max_source_length tokens are dropped.
+        :param bucket_boundaries: buckets of target and source lengths, see bucketing.bucket_boundaries_from_metadata.
+        If None, targets are bucketed by fixed width from hparams.approx_min_target_length.
+        '''
+        hparams = self.hparams
+        r = hparams.outputs_per_step
+        downsample_step = hparams.downsample_step
+        mel_downsample_step = 1 if self.mel_downsampled else downsample_step
+        boundaries = fixed_width_bucket_boundaries(hparams) if bucket_boundaries is None else bucket_boundaries
+        rows = tf.constant(
+            budget_batch_sizes(boundaries, hparams.pack_max_frames, hparams.pack_max_source_tokens,
+                               hparams.max_target_length, hparams.max_source_length, r, downsample_step),
+            dtype=tf.int64)
+
+        def within_cap(source, target):
+            return tf.logical_and(tf.less_equal(target.target_length, hparams.max_target_length),
+                                  tf.less_equal(source.source_length, hparams.max_source_length))
 
-class _FrontendBatchedViewBase(FrontendZippedViewBase):
-    def add_memory_mask(self):
-        def convert(s: PreparedSourceData, t):
-            mask_value = -1e9
+        def key_func(source, target):
+            return bucket_id(target.target_length, source.source_length, boundaries)
 
-            def to_float_mask(mask):
-                return tf.to_float(tf.logical_not(mask)) * mask_value
+        def window_size_func(key):
+            return tf.gather(rows, key)
 
-            s1_mask = to_float_mask(tf.sequence_mask(s.source_length, tf.shape(s.source)[1]))
-            s2_mask = to_float_mask(tf.sequence_mask(s.source_length2, tf.shape(s.source2)[1]))
+        def downsample(source, target):
+            return source, target._replace(mel=target.mel[0::mel_downsample_step, :])
 
-            return PreparedSourceDataWithMask(
-                id=s.id,
-                text=s.text,
-                source=s.source,
-                source_length=s.source_length,
-                mask=s1_mask,
-                text_positions=s.text_positions,
-                text2=s.text2,
-                source2=s.source2,
-                source_length2=s.source_length2,
-                text_positions2=s.text_positions2,
-                mask2=s2_mask,
-            ), t
+        def reduce_func(key, window: tf.data.Dataset):
+            shapes, values = _padded_shapes(hparams), _padding_values()
+            return window.padded_batch(window_size_func(key), padded_shapes=shapes, padding_values=values)
+
+        packed = self.dataset.filter(within_cap).map(
+            downsample, num_parallel_calls=num_parallel_calls(hparams)).apply(
+            tf.contrib.data.group_by_window(key_func, reduce_func, window_size_func=window_size_func)).map(
+            lambda s, t: _concat_segments(s, t, r, downsample_step),
+            num_parallel_calls=num_parallel_calls(hparams))
+        return _FrontendPackedView(packed, hparams)
 
-        converted = self.dataset.map(lambda x, y: convert(x, y))
+
+class _FrontendBatchedViewBase(FrontendZippedViewBase):
+
+    @property
+    def mel_downsample_step(self):
+        '''
+        downsample_step of mel that is not downsampled yet, or 1 if it is already downsampled
+        '''
+        return 1 if self.mel_downsampled else self.hparams.downsample_step
+
+    def add_memory_mask(self):
+        def convert(s: PreparedSourceData, t):
+            return _add_memory_mask(s), t
+
+        converted = self._map(lambda x, y: convert(x, y))
         return self.apply(converted, self.hparams)
 
 
 class _FrontendBatchedView(_FrontendBatchedViewBase):
-    def __init__(self, batched: tf.data.Dataset, hparams):
+    def __init__(self, batched: tf.data.Dataset, hparams, mel_downsampled=False):
         self._dataset = batched
         self._hparams = hparams
+        self.mel_downsampled = mel_downsampled
 
     @property
     def dataset(self):
@@ -314,16 +678,14 @@ class _FrontendBatchedView(_FrontendBatchedViewBase):
         return self._hparams
 
     def apply(self, dataset, hparams):
-        return _FrontendBatchedView(dataset, hparams)
+        return _FrontendBatchedView(dataset, hparams, self.mel_downsampled)
 
     def add_frame_positions(self):
         r = self.hparams.outputs_per_step
-        downsample_step = self.hparams.downsample_step
+        downsample_step = self.mel_downsample_step
 
         def convert(source, target):
-            max_decoder_target_len = tf.shape(target.mel)[1] // r // downsample_step
-            frame_positions = tf.tile(tf.expand_dims(tf.range(1, max_decoder_target_len + 1), axis=0),
-                                      [self.hparams.batch_size, 1])
+            frame_positions = _frame_positions(target.mel, r, downsample_step)
             return source, PreparedTargetData(
                 id=target.id,
                 spec=target.spec,
@@ -335,14 +697,48 @@ class _FrontendBatchedView(_FrontendBatchedViewBase):
                 frame_positions=frame_positions,
             )
 
-        converted = self.dataset.map(lambda x, y: convert(x, y))
-        return _FrontendBatchedViewWithFramePositions(converted, self.hparams)
+        converted = self._map(lambda x, y: convert(x, y))
+        return _FrontendBatchedViewWithFramePositions(converted, self.hparams, self.mel_downsampled)
+
+    def finalize_batch(self, swap_probability=None):
+        '''
+        Fused swap_source_random, add_memory_mask, add_frame_positions, add_target_mask and downsample_mel.
+        All of them run in one map over the batch, so the batch is rebuilt once instead of once per stage.
+        :param swap_probability: if given, swap sources randomly as swap_source_random does
+        '''
+        r = self.hparams.outputs_per_step
+        downsample_step = self.hparams.downsample_step
+        mel_downsample_step = self.mel_downsample_step
+        mel_downsampled = self.mel_downsampled
+
+        def convert(s: PreparedSourceData, t: _PreparedTargetData):
+            if swap_probability is not None:
+                s = _swap_source_random(s, swap_probability)
+            frame_positions = _frame_positions(t.mel, r, mel_downsample_step)
+            spec_loss_mask, binary_loss_mask = _target_masks(t.target_length, t.mel, frame_positions, r,
+                                                             downsample_step, mel_downsample_step)
+            return _add_memory_mask(s), PreparedTargetDataWithMask(
+                id=t.id,
+                spec=t.spec,
+                spec_width=t.spec_width,
+                mel=t.mel if mel_downsampled else t.mel[:, 0::downsample_step, :],
+                mel_width=t.mel_width,
+                target_length=t.target_length,
+                done=t.done,
+                frame_positions=frame_positions,
+                spec_loss_mask=spec_loss_mask,
+                binary_loss_mask=binary_loss_mask,
+            )
+
+        converted = self._map(lambda x, y: convert(x, y))
+        return _FrontendBatchedViewWithFramePositions(converted, self.hparams, mel_downsampled=True)
 
 
 class _FrontendBatchedViewWithFramePositions(_FrontendBatchedViewBase):
-    def __init__(self, batched: tf.data.Dataset, hparams):
+    def __init__(self, batched: tf.data.Dataset, hparams, mel_downsampled=False):
         self._dataset = batched
         self._hparams = hparams
+        self.mel_downsampled = mel_downsampled
 
     @property
     def dataset(self):
@@ -353,9 +749,12 @@ class _FrontendBatchedViewWithFramePositions(_FrontendBatchedViewBase):
         return self._hparams
 
     def apply(self, dataset, hparams):
-        return _FrontendBatchedViewWithFramePositions(dataset, hparams)
+        return _FrontendBatchedViewWithFramePositions(dataset, hparams, self.mel_downsampled)
 
     def downsample_mel(self):
+        if self.mel_downsampled:
+            return self
+
         def convert(source, target):
             return source, PreparedTargetDataWithMask(
                 id=target.id,
@@ -370,20 +769,17 @@ class _FrontendBatchedViewWithFramePositions(_FrontendBatchedViewBase):
                 binary_loss_mask=target.binary_loss_mask,
             )
 
-        converted = self.dataset.map(lambda x, y: convert(x, y))
-        return _FrontendBatchedViewWithFramePositions(converted, self.hparams)
+        converted = self._map(lambda x, y: convert(x, y))
+        return _FrontendBatchedViewWithFramePositions(converted, self.hparams, mel_downsampled=True)
 
     def add_target_mask(self):
         r = self.hparams.outputs_per_step
         downsample_step = self.hparams.downsample_step
+        mel_downsample_step = self.mel_downsample_step
 
         def convert(s, t: PreparedTargetData):
-
-            def to_float_mask(mask):
-                return tf.to_float(mask)
-
-            spec_loss_mask = to_float_mask(tf.sequence_mask(t.target_length // downsample_step, tf.shape(t.mel)[1] // downsample_step))
-            binary_loss_mask = to_float_mask(tf.sequence_mask(t.target_length // r // downsample_step, tf.shape(t.frame_positions)[1]))
+            spec_loss_mask, binary_loss_mask = _target_masks(t.target_length, t.mel, t.frame_positions, r,
+                                                             downsample_step, mel_downsample_step)
 
             return s, PreparedTargetDataWithMask(
                 id=t.id,
@@ -398,5 +794,84 @@ class _FrontendBatchedViewWithFramePositions(_FrontendBatchedViewBase):
                 binary_loss_mask=binary_loss_mask,
             )
 
-        converted = self.dataset.map(lambda x, y: convert(x, y))
-        return self.apply(converted, self.hparams)
\ No newline at end of file
+        converted = self._map(lambda x, y: convert(x, y))
+        return self.apply(converted, self.hparams)
+
+class _FrontendPackedView(FrontendZippedViewBase):
+    def __init__(self, packed: tf.data.Dataset, hparams):
+        self._dataset = packed
+        self._hparams = hparams
+
+    @property
+    def dataset(self):
+        return self._dataset
+
+    @property
+    def hparams(self):
+        return self._hparams
+
+    def apply(self, dataset, hparams):
+        return _FrontendPackedView(dataset, hparams)
+
+    def batch(self):
+        '''
+        Batches hparams.batch_size packed rows and adds (B, T_query, T_memory) memory masks between utterances.
+        The last batch may be smaller.
+        '''
+        spec_width = _spec_width(self.hparams)
+        batched = self.dataset.padded_batch(self.hparams.batch_size, padded_shapes=(
+            PackedSourceData(
+                id=tf.TensorShape([]),
+                text=tf.TensorShape([]),
+                source=tf.TensorShape([None]),
+                source_length=tf.TensorShape([]),
+                text_positions=tf.TensorShape([None]),
+                segment_ids=tf.TensorShape([None]),
+            ),
+            PackedTargetData(
+                id=tf.TensorShape([]),
+                spec=tf.TensorShape([None, spec_width]),
+                spec_width=tf.TensorShape([]),
+                mel=tf.TensorShape([None, self.hparams.num_mels]),
+                mel_width=tf.TensorShape([]),
+                target_length=tf.TensorShape([]),
+                done=tf.TensorShape([None]),
+                frame_positions=tf.TensorShape([None]),
+                spec_loss_mask=tf.TensorShape([None]),
+                binary_loss_mask=tf.TensorShape([None]),
+                segment_ids=tf.TensorShape([None]),
+            )), padding_values=(
+            PackedSourceData(
+                id=tf.to_int64(0),
+                text="",
+                source=tf.to_int64(0),
+                source_length=tf.to_int64(0),
+                text_positions=tf.to_int64(0),
+                segment_ids=0,
+            ),
+            PackedTargetData(
+                id=tf.to_int64(0),
+                spec=tf.to_float(0),
+                spec_width=tf.to_int64(0),
+                mel=tf.to_float(0),
+                mel_width=tf.to_int64(0),
+                target_length=tf.to_int64(0),
+                done=tf.to_float(1),
+                frame_positions=0,
+                spec_loss_mask=tf.to_float(0),
+                binary_loss_mask=tf.to_float(0),
+                segment_ids=0,
+            )))
+
+        def convert(s: PackedSourceData, t: PackedTargetData):
+            return PackedSourceDataWithMask(
+                id=s.id,
+                text=s.text,
+                source=s.source,
+                source_length=s.source_length,
+                text_positions=s.text_positions,
+                segment_ids=s.segment_ids,
+                mask=_packed_memory_mask(s.segment_ids, t.segment_ids),
+            ), t
+
+        return self.apply(batched.map(convert, num_parallel_calls=num_parallel_calls(self.hparams)), self.hparams)
@@ -0,0 +1,148 @@
+import tensorflow as tf
+import numpy as np
+import collections
+import math
+import os
+
+
+class BucketBoundaries(collections.namedtuple("BucketBoundaries", ["target", "source"])):
+    '''
+    Ascending lower bounds of every bucket but the first, for target lengths and for source lengths.
+    A bucket is a pair of a target length bucket and a source length bucket.
+    '''
+
+    @property
+    def num_buckets(self):
+        return (len(self.target) + 1) * (len(self.source) + 1)
+
+
+class BucketReport(collections.namedtuple("BucketReport",
+                                          ["bucket_id", "size", "target_efficiency", "source_efficiency"])):
+    pass
+
+
+def read_lengths(data_root):
+    '''
+    Reads lengths from train-target.txt and train-source.txt that preprocess.py writes.
+    :return: ids, target lengths in frames and source lengths as numpy arrays in id order
+    '''
+    with open(os.path.join(data_root, "train-target.txt"), 'r', encoding='utf-8') as f:
+        # id|filename|n_frames
+        targets = {int(fields[0]): int(fields[2]) for fields in (line.rstrip('\n').split('|') for line in f)}
+    with open(os.path.join(data_root, "train-source.txt"), 'r', encoding='utf-8') as f:
+        # id|filename|text|text_length|source_length|text2|text2_length|source2_length
+        # sources are swapped after batching, so both of them have to fit in a bucket
+        sources = {int(fields[0]): max(int(fields[4]), int(fields[-1])) for fields in
+                   (line.rstrip('\n').split('|') for line in f)}
+    ids = np.array(sorted(set(targets) & set(sources)), dtype=np.int64)
+    target_lengths = np.array([targets[id] for id in ids], dtype=np.int64)
+    source_lengths = np.array([sources[id] for id in ids], dtype=np.int64)
+    return ids, target_lengths, source_lengths
+
+
+def _quantile_boundaries(lengths, num_buckets):
+    quantiles = np.linspace(0, 100, num_buckets + 1)[1:-1]
+    return sorted(set(int(np.ceil(q)) for q in np.percentile(lengths, quantiles)))
+
+
+def compute_bucket_boundaries(target_lengths, source_lengths, num_target_buckets, num_source_buckets,
+                              target_offset=0):
+    '''
+    Places boundaries at quantiles, so that buckets have roughly equal number of utterances.
+    :param target_offset: frames that Frontend adds to target lengths before batching (outputs_per_step)
+    '''
+    return BucketBoundaries(
+        target=[b + target_offset for b in _quantile_boundaries(target_lengths, num_target_buckets)],
+        source=_quantile_boundaries(source_lengths, num_source_buckets),
+    )
+
+
+def bucket_boundaries_from_metadata(data_root, hparams):
+    _, target_lengths, source_lengths = read_lengths(data_root)
+    return compute_bucket_boundaries(target_lengths, source_lengths, hparams.batch_num_target_buckets,
+                                     hparams.batch_num_source_buckets, target_offset=hparams.outputs_per_step)
+
+
+def fixed_width_bucket_boundaries(hparams):
+    '''
+    Boundaries of the fixed width target buckets that Frontend uses without metadata.
+    '''
+    return BucketBoundaries(
+        target=[hparams.approx_min_target_length + hparams.batch_bucket_width * (i + 1) for i in
+                range(hparams.batch_num_buckets)],
+        source=[],
+    )
+
+
+def budget_batch_sizes(boundaries: BucketBoundaries, max_frames, max_source_tokens, max_target_length,
+                       max_source_length, outputs_per_step=1, downsample_step=1):
+    '''
+    Batch size of every bucket so that a batch of the longest utterances in the bucket has at most
+    max_frames padded target frames and max_source_tokens padded source tokens.
+    The last buckets are bounded by max_target_length and max_source_length, longer utterances are dropped.
+    :param outputs_per_step: with downsample_step, targets are padded past their last frame to a multiple of
+    lcm(outputs_per_step, downsample_step) frames, as Frontend does
+    :return: list of batch sizes indexed by bucket id, at least 1
+    '''
+
+    length_multiple = outputs_per_step * downsample_step // math.gcd(outputs_per_step, downsample_step)
+
+    def padded_target_length(length):
+        return (length // length_multiple + 1) * length_multiple
+
+    # target boundaries are exclusive, max_target_length is not
+    target_bounds = [padded_target_length(min(b - 1, max_target_length)) for b in boundaries.target] + [
+        padded_target_length(max_target_length)]
+    source_bounds = [min(b, max_source_length) for b in boundaries.source] + [max_source_length]
+    return [max(1, min(max_frames // t, max_source_tokens // s)) for t in target_bounds for s in source_bounds]
+
+
+def bucket_ids(target_lengths, source_lengths, boundaries: BucketBoundaries):
+    target_bucket = np.searchsorted(boundaries.target, target_lengths, side='right')
+    source_bucket = np.searchsorted(boundaries.source, source_lengths, side='right')
+    return target_bucket * (len(boundaries.source) + 1) + source_bucket
+
+
+def bucket_id(target_length, source_length, boundaries: BucketBoundaries):
+    '''
+    Graph version of bucket_ids for a single example.
+    '''
+
+    def bucket(length, bounds):
+        if not bounds:
+            return tf.constant(0, dtype=tf.int64)
+        return tf.reduce_sum(tf.to_int64(tf.greater_equal(length, tf.constant(bounds, dtype=tf.int64))))
+
+    return bucket(target_length, boundaries.target) * (len(boundaries.source) + 1) + bucket(source_length,
+                                                                                             boundaries.source)
+
+
+def padding_efficiency(target_lengths, source_lengths, boundaries: BucketBoundaries, batch_size, seed=0):
+    '''
+    Simulates batching of shuffled utterances within each bucket.
+    Efficiency is the ratio of real frames (or source tokens) to padded frames in the batches of a bucket.
+    :param batch_size: batch size, or list of batch sizes indexed by bucket id
+    :return: list of BucketReport of non-empty buckets and overall BucketReport with bucket_id -1
+    '''
+    random = np.random.RandomState(seed)
+    ids = bucket_ids(target_lengths, source_lengths, boundaries)
+    reports = []
+    totals = np.zeros(4, dtype=np.int64)
+    for bucket in np.unique(ids):
+        members = random.permutation(np.nonzero(ids == bucket)[0])
+        sums = np.zeros(4, dtype=np.int64)
+        size = batch_size[bucket] if isinstance(batch_size, list) else batch_size
+        for start in range(0, len(members), size):
+            batch = members[start:start + size]
+            sums += [target_lengths[batch].sum(), target_lengths[batch].max() * len(batch),
+                     source_lengths[batch].sum(), source_lengths[batch].max() * len(batch)]
+        totals += sums
+        reports.append(BucketReport(int(bucket), len(members), sums[0] / sums[1], sums[2] / sums[3]))
+    return reports, BucketReport(-1, len(ids), totals[0] / totals[1], totals[2] / totals[3])
+
+
+def padding_efficiency_string(reports, total):
+    lines = ["bucket  size  target efficiency  source efficiency"]
+    lines += ["%6d %5d %18.3f %18.3f" % r for r in reports]
+    lines.append(" total %5d %18.3f %18.3f" % total[1:])
+    return '\n'.join(lines)
@@ -0,0 +1,28 @@
+import os
+from deepvoice3_tensorflow.frontend import loads_spec
+from deepvoice3_tensorflow.frontend.materialize import MATERIALIZED_HPARAMS
+from data.manifest import hparams_hash, files_fingerprint
+
+# Prepared utterances are padded and have done flags, so they depend on the same hyper parameters as
+# materialized targets, and on the training mode that decides whether linear spectrograms are loaded.
+PREPARED_HPARAMS = MATERIALIZED_HPARAMS
+
+
+def prepared_cache_filename(cache_dir, hparams, files, **extra):
+    '''
+    :param files: every file that the Frontend reads
+    :param extra: anything else that changes prepared utterances, such as the kind of Frontend
+    :return: file name prefix for tf.data.Dataset.cache, which changes whenever inputs or hyper parameters change
+    '''
+    key = hparams_hash(hparams, PREPARED_HPARAMS, spec=loads_spec(hparams), files=files_fingerprint(files), **extra)
+    return os.path.join(cache_dir, "prepared-" + key[:16])
+
+
+def remove_stale_lock(filename):
+    '''
+    tf.data leaves a lock file next to a cache that was not written to the end.
+    Call this before training when no other process writes the same cache.
+    '''
+    lockfile = filename + ".lockfile"
+    if os.path.exists(lockfile):
+        os.remove(lockfile)
@@ -0,0 +1,126 @@
+import tensorflow as tf
+import hashlib
+import os
+from deepvoice3_tensorflow.frontend import Frontend, _FrontendPreparedView, _PreparedTargetData, loads_spec, \
+    _spec_width, read_tfrecords, num_parallel_calls
+from data.tfrecord_utils import ShardedTFRecordWriter, read_shard_index, shard_files, shard_index_filename, \
+    bytes_feature, int64_feature
+from data.manifest import hparams_hash, files_fingerprint, AUDIO_HPARAMS
+
+# Materialized targets are padded, downsampled and have done flags, so they depend on these hyper parameters
+MATERIALIZED_HPARAMS = AUDIO_HPARAMS + ["outputs_per_step", "downsample_step"]
+
+_prefix = "materialized-target"
+
+
+def materialized_cache_dir(data_root, hparams, target_files):
+    '''
+    :param target_files: every file that targets are read from, such as target and spec TFRecords or the files of a
+    packed store. Storage format and layout changes of preprocessed targets change their fingerprint.
+    :return: cache directory for the current hyper parameters and preprocessed targets in data_root
+    '''
+    with open(os.path.join(data_root, "train-target.txt"), 'rb') as f:
+        targets_hash = hashlib.sha1(f.read()).hexdigest()
+    key = hparams_hash(hparams, MATERIALIZED_HPARAMS, spec=loads_spec(hparams), targets=targets_hash,
+                       files=files_fingerprint(target_files))
+    return os.path.join(data_root, "materialized-" + key[:16])
+
+
+def materialized_files(cache_dir):
+    '''
+    :return: shard files of materialized targets in the order they were written
+    '''
+    return shard_files(read_shard_index(os.path.join(cache_dir, shard_index_filename(_prefix))), cache_dir)
+
+
+def _complete_filename(cache_dir):
+    return os.path.join(cache_dir, _prefix + "-complete")
+
+
+def is_materialized(cache_dir):
+    # the index lists every finished shard, so it also exists when materialization was interrupted
+    return os.path.exists(_complete_filename(cache_dir))
+
+
+def _materialized_target_example(t: _PreparedTargetData, downsample_step):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'id': int64_feature([t.id]),
+        'spec': bytes_feature([t.spec.tostring()]),
+        'spec_width': int64_feature([t.spec_width]),
+        'mel': bytes_feature([t.mel[0::downsample_step, :].tostring()]),
+        'mel_width': int64_feature([t.mel_width]),
+        'target_length': int64_feature([t.target_length]),
+        'padded_length': int64_feature([len(t.mel)]),
+        'done': bytes_feature([t.done.tostring()]),
+    }))
+
+
+def _parse_materialized_target(proto, hparams):
+    features = {
+        'id': tf.FixedLenFeature((), tf.int64),
+        'spec': tf.FixedLenFeature((), tf.string),
+        'spec_width': tf.FixedLenFeature((), tf.int64),
+        'mel': tf.FixedLenFeature((), tf.string),
+        'mel_width': tf.FixedLenFeature((), tf.int64),
+        'target_length': tf.FixedLenFeature((), tf.int64),
+        'padded_length': tf.FixedLenFeature((), tf.int64),
+        'done': tf.FixedLenFeature((), tf.string),
+    }
+    parsed = tf.parse_single_example(proto, features)
+    padded_length = parsed['padded_length']
+    spec = tf.reshape(tf.decode_raw(parsed['spec'], tf.float32), tf.stack([padded_length, parsed['spec_width']]))
+    mel = tf.reshape(tf.decode_raw(parsed['mel'], tf.float32),
+                     tf.stack([padded_length // hparams.downsample_step, parsed['mel_width']]))
+    spec.set_shape((None, _spec_width(hparams)))
+    mel.set_shape((None, hparams.num_mels))
+    return _PreparedTargetData(
+        id=parsed['id'],
+        spec=spec,
+        spec_width=parsed['spec_width'],
+        mel=mel,
+        mel_width=parsed['mel_width'],
+        target_length=parsed['target_length'],
+        done=tf.decode_raw(parsed['done'], tf.float32),
+    )
+
+
+def materialize_targets(frontend: Frontend, cache_dir, shard_size=500):
+    '''
+    Runs Frontend.prepare_target once and writes padded and downsampled mel, done flags and lengths to cache_dir.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # shards of an interrupted run are replaced and removed
+    index_filename = os.path.join(cache_dir, shard_index_filename(_prefix))
+    previous_index = read_shard_index(index_filename) if os.path.exists(index_filename) else None
+    with tf.Graph().as_default():
+        next_element = frontend.prepare_target().make_one_shot_iterator().get_next()
+        with tf.Session() as sess, ShardedTFRecordWriter(cache_dir, _prefix, shard_size, previous_index) as writer:
+            while True:
+                try:
+                    t = sess.run(next_element)
+                except tf.errors.OutOfRangeError:
+                    break
+                example = _materialized_target_example(t, frontend.hparams.downsample_step)
+                writer.write(t.id, example.SerializeToString())
+    # written only after the writer has closed every shard and the final index
+    open(_complete_filename(cache_dir), 'w').close()
+
+
+class MaterializedFrontend(Frontend):
+    '''
+    Frontend whose targets are read from a materialized cache, so preparing them is a plain parse.
+    The views of prepare() know that mel is already downsampled.
+    '''
+
+    @staticmethod
+    def from_cache(source_files, cache_dir, hparams):
+        source = read_tfrecords(source_files, hparams)
+        return MaterializedFrontend(source, read_tfrecords(materialized_files(cache_dir), hparams), hparams)
+
+    def prepare_target(self):
+        return self.target.map(lambda d: _parse_materialized_target(d, self.hparams),
+                               num_parallel_calls=num_parallel_calls(self.hparams))
+
+    def prepare(self):
+        return _FrontendPreparedView(self.prepare_source(), self.prepare_target(), self.hparams, mel_downsampled=True)
@@ -0,0 +1,125 @@
+import tensorflow as tf
+import os
+from deepvoice3_tensorflow.frontend import Frontend, BATCH_BUDGET, BATCH_PACKED
+from deepvoice3_tensorflow.frontend.materialize import MaterializedFrontend, materialized_cache_dir, is_materialized, \
+    materialize_targets, materialized_files
+from deepvoice3_tensorflow.frontend.cache import prepared_cache_filename
+from deepvoice3_tensorflow.frontend.bucketing import BucketBoundaries
+
+
+def train_frontend(source_files, target_files, hparams, target_store=None, spec_files=None, materialized_dir=None):
+    '''
+    Frontend that train.py reads targets with: a materialized cache, a packed store or TFRecords in this order.
+    '''
+    if materialized_dir is not None:
+        return MaterializedFrontend.from_cache(source_files, materialized_dir, hparams)
+    if target_store is not None:
+        return Frontend.from_packed_store(source_files, target_store, hparams)
+    return Frontend.from_tfrecord_files(source_files, target_files, hparams, spec_files)
+
+
+def materialized_train_targets(data_root, source_files, target_files, hparams, target_store=None, spec_files=None):
+    '''
+    Materializes the targets of data_root for the current hyper parameters unless they already are.
+    :return: directory of the materialized targets for train_frontend
+    '''
+    # the cache is keyed by the files that targets are read from
+    input_files = target_store.files if target_store is not None else target_files + (spec_files or [])
+    materialized_dir = materialized_cache_dir(data_root, hparams, input_files)
+    if not is_materialized(materialized_dir):
+        tf.logging.info("Materializing targets to %s" % materialized_dir)
+        if target_store is not None:
+            frontend = Frontend.from_packed_store(source_files, target_store, hparams)
+        else:
+            frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams, spec_files)
+        materialize_targets(frontend, materialized_dir)
+    return materialized_dir
+
+
+def train_cache_filename(cache_dir, source_files, target_files, hparams, target_store=None, spec_files=None,
+                         materialized_dir=None):
+    '''
+    :return: cache file name for train_stages of the files that train_frontend reads with the same arguments
+    '''
+    if materialized_dir is not None:
+        # the directory does not change when its shards are rewritten
+        input_files, frontend_kind = source_files + materialized_files(materialized_dir), "materialized"
+    elif target_store is not None:
+        input_files, frontend_kind = source_files + target_store.files, "packed"
+    else:
+        input_files, frontend_kind = source_files + target_files + (spec_files or []), "tfrecord"
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return prepared_cache_filename(cache_dir, hparams, input_files, frontend=frontend_kind)
+
+
+def eval_frontend(source_files, target_files, hparams, target_store=None, spec_files=None, num_utterances=16):
+    '''
+    Frontend of the first num_utterances utterances, whose targets are read like train_frontend reads them.
+    '''
+    frontend = train_frontend(source_files, target_files, hparams, target_store, spec_files)
+    # records are taken regardless of whether the files are per utterance or sharded
+    spec = frontend.spec.take(num_utterances) if frontend.spec is not None else None
+    return Frontend(frontend.source.take(num_utterances), frontend.target.take(num_utterances), hparams,
+                    decoded_target=frontend.decoded_target, spec=spec)
+
+
+def train_stages(hparams, bucket_boundaries: BucketBoundaries = None, cache_filename=None):
+    '''
+    Stages that train.py applies to a Frontend.
+    :return: list of (name, function from a Frontend or view to the next view)
+    '''
+    stages = [
+        ("prepare", lambda frontend: frontend.prepare()),
+        ("zip", lambda view: view.zip_source_and_target()),
+    ]
+    if cache_filename is not None:
+        stages.append(("cache", lambda view: view.cache(cache_filename)))
+    stages += [
+        ("repeat", lambda view: view.repeat()),
+        ("shuffle", lambda view: view.shuffle(buffer_size=hparams.batch_size * 10)),
+    ]
+    if hparams.batch_mode == BATCH_PACKED:
+        stages += [
+            ("swap_source", lambda view: view.swap_source_random(hparams.replace_pronunciation_prob)),
+            ("pack", lambda view: view.pack(bucket_boundaries=bucket_boundaries)),
+            ("batch", lambda view: view.batch()),
+        ]
+    else:
+        if hparams.batch_mode == BATCH_BUDGET:
+            stages.append(("group_by_budget", lambda view: view.group_by_budget(bucket_boundaries=bucket_boundaries)))
+        else:
+            stages.append(("group_by_batch", lambda view: view.group_by_batch(bucket_boundaries=bucket_boundaries)))
+        stages.append(("finalize_batch",
+                       lambda view: view.finalize_batch(swap_probability=hparams.replace_pronunciation_prob)))
+    stages.append(("prefetch", lambda view: view.prefetch()))
+    return stages
+
+
+def eval_stages(hparams):
+    '''
+    Stages that eval.py applies to a Frontend. Every utterance is evaluated, so batches are not bucketed and the
+    last batch may be smaller.
+    '''
+    stages = [
+        ("prepare", lambda frontend: frontend.prepare()),
+        ("zip", lambda view: view.zip_source_and_target()),
+    ]
+    if hparams.swap_source:
+        stages.append(("swap_source", lambda view: view.swap_source()))
+    stages += [
+        ("batch", lambda view: view.batch_in_order()),
+        ("finalize_batch", lambda view: view.finalize_batch()),
+        ("prefetch", lambda view: view.prefetch()),
+    ]
+    return stages
+
+
+def apply_stages(frontend, stages):
+    '''
+    :return: tf.data.Dataset of the last stage
+    '''
+    view = frontend
+    for _, stage in stages:
+        view = stage(view)
+    return view.dataset
@@ -1,8 +1,14 @@
 import tensorflow as tf
 import os
+import json
+import time
+import queue
+import threading
 import numpy as np
+from tensorflow.python.client import timeline
 from typing import List
 from data.tfrecord_utils import write_tfrecord, int64_feature, bytes_feature
+from deepvoice3_tensorflow.result_log import ResultLogWriter
 from visualize_alignment import save_alignment
 from visualize_mel import plot_mel
 
@@ -33,11 +39,84 @@ def write_training_result(global_step: int, id: List[int], text: List[str], pred
     write_tfrecord(example, filename)
 
 
+class ResultWriter:
+    '''
+    Runs functions that write training results on background threads.
+    `put` blocks while `queue_size` functions are pending, so a slow disk throttles training instead of filling memory.
+    '''
+
+    # pyplot is not thread safe
+    plot_lock = threading.Lock()
+
+    def __init__(self, num_workers=1, queue_size=4):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except Exception:
+                tf.logging.exception("Failed to write a training result")
+
+    def put(self, function, *args):
+        self._queue.put((function, args))
+
+    def close(self):
+        '''
+        Waits for pending functions to finish.
+        '''
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def save_training_result(global_step, ids, texts, predicted_mels, ground_truth_mels, alignments, mode, log_dir,
+                         result_log: ResultLogWriter = None):
+    if result_log is not None:
+        tf.logging.info("Saving a training result for %d in %s", global_step, result_log.prefix)
+        result_log.write(global_step, ids, texts, predicted_mels, ground_truth_mels, alignments)
+    else:
+        id_strings = ",".join([str(i) for i in ids])
+        result_filename = "{}_result_step{:09d}_{}.tfrecord".format(mode, global_step, id_strings)
+        tf.logging.info("Saving a training result for %d at %s", global_step, result_filename)
+        write_training_result(global_step, list(ids), list(texts), list(predicted_mels),
+                              list(ground_truth_mels),
+                              alignments,
+                              filename=os.path.join(log_dir, result_filename))
+    if mode == tf.estimator.ModeKeys.EVAL:
+        alignments = [[a[i].T for a in alignments] for i in range(alignments[0].shape[0])]
+        for _id, text, align, pred_mel, gt_mel in zip(ids, texts, alignments, predicted_mels,
+                                                      ground_truth_mels):
+            output_filename = "{}_result_step{:09d}_{:d}.png".format(mode, global_step, _id)
+            with ResultWriter.plot_lock:
+                save_alignment(align, text.decode('utf-8'), _id,
+                               os.path.join(log_dir, "alignment_" + output_filename))
+                plot_mel(gt_mel, pred_mel, os.path.join(log_dir, "mel_" + output_filename))
+
+
 class AlignmentSaver(tf.train.SessionRunHook):
+    '''
+    Saves alignments and mels of every save_steps steps.
+    The tensors are fetched by the run of the step itself, and written on background threads.
+    '''
 
     def __init__(self, alignment_tensors, global_step_tensor, predicted_mel_tensor, ground_truth_mel_tensor, id_tensor,
                  text_tensor, save_steps,
-                 tag_prefix, mode, writer: tf.summary.FileWriter):
+                 tag_prefix, mode, writer: tf.summary.FileWriter, num_workers=1, queue_size=4,
+                 result_log: ResultLogWriter = None):
+        '''
+        :param result_log: if given, results are appended to it instead of written as a TFRecord per save
+        :param num_workers: number of threads writing results
+        :param queue_size: number of results waiting for the threads before the training blocks
+        '''
         self.alignment_tensors = alignment_tensors
         self.global_step_tensor = global_step_tensor
         self.predicted_mel_tensor = predicted_mel_tensor
@@ -48,33 +127,142 @@ class AlignmentSaver(tf.train.SessionRunHook):
         self.tag_prefix = tag_prefix
         self.mode = mode
         self.writer = writer
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.result_log = result_log
+        self._stale_global_step = 0
+        self._result_writer = None
+
+    def begin(self):
+        self._result_writer = ResultWriter(self.num_workers, self.queue_size)
+
+    def after_create_session(self, session, coord):
+        self._stale_global_step = session.run(self.global_step_tensor)
+
+    def _should_save(self):
+        return (self._stale_global_step + 1) % self.save_steps == 0 or self._stale_global_step == 0
 
     def before_run(self, run_context):
+        fetches = {"global_step": self.global_step_tensor}
+        if self._should_save():
+            fetches.update({
+                "alignments": self.alignment_tensors,
+                "predicted_mel": self.predicted_mel_tensor,
+                "ground_truth_mel": self.ground_truth_mel_tensor,
+                "id": self.id_tensor,
+                "text": self.text_tensor,
+            })
+        return tf.train.SessionRunArgs(fetches)
+
+    def after_run(self,
+                  run_context,
+                  run_values):
+        results = run_values.results
+        self._stale_global_step = results["global_step"] + 1
+        if "alignments" in results:
+            self._result_writer.put(save_training_result, results["global_step"], results["id"], results["text"],
+                                    results["predicted_mel"], results["ground_truth_mel"], results["alignments"],
+                                    self.mode, self.writer.get_logdir(), self.result_log)
+
+    def end(self, session):
+        self._result_writer.close()
+        if self.result_log is not None:
+            self.result_log.close()
+
+
+def _input_wait(step_stats):
+    '''
+    :return: seconds spent in IteratorGetNext ops of a step
+    '''
+    micros = 0
+    for device in step_stats.dev_stats:
+        for node in device.node_stats:
+            if "IteratorGetNext" in node.node_name:
+                micros += node.all_end_rel_micros
+    return micros / 1e6
+
+
+class StepTimeProfiler(tf.train.SessionRunHook):
+    '''
+    Measures wall time and throughput of every step.
+    Every profile_steps steps, a step is traced to split its time into waiting for the input iterator and compute.
+    Every trace_steps steps, a full trace is written as a Chrome trace.
+    Scalars go to TensorBoard and to a JSON lines log.
+    '''
+
+    def __init__(self, global_step_tensor, num_examples_tensor, num_frames_tensor, num_padded_frames_tensor,
+                 profile_steps, trace_steps, writer: tf.summary.FileWriter, log_filename="step_times.jsonl"):
+        '''
+        :param num_frames_tensor: number of target frames in a batch without padding
+        :param num_padded_frames_tensor: number of target frames in a batch with padding
+        :param profile_steps: interval of steps with input wait and compute time, 0 to disable
+        :param trace_steps: interval of steps with Chrome traces, 0 to disable
+        '''
+        self.global_step_tensor = global_step_tensor
+        self.num_examples_tensor = num_examples_tensor
+        self.num_frames_tensor = num_frames_tensor
+        self.num_padded_frames_tensor = num_padded_frames_tensor
+        self.profile_steps = profile_steps
+        self.trace_steps = trace_steps
+        self.writer = writer
+        self.log_filename = os.path.join(writer.get_logdir(), log_filename)
+        self._step = 0
+        self._start = None
+        self._trace = False
+        self._log = None
+
+    def begin(self):
+        self._log = open(self.log_filename, 'a')
+
+    def _every(self, steps):
+        return steps > 0 and self._step % steps == 0
+
+    def before_run(self, run_context):
+        self._trace = self._every(self.trace_steps)
+        if self._trace:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        elif self._every(self.profile_steps):
+            options = tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE)
+        else:
+            options = None
+        self._start = time.perf_counter()
         return tf.train.SessionRunArgs({
-            "global_step": self.global_step_tensor
-        })
+            "global_step": self.global_step_tensor,
+            "num_examples": self.num_examples_tensor,
+            "num_frames": self.num_frames_tensor,
+            "num_padded_frames": self.num_padded_frames_tensor,
+        }, options=options)
 
     def after_run(self,
                   run_context,
                   run_values):
-        stale_global_step = run_values.results["global_step"]
-        if (stale_global_step + 1) % self.save_steps == 0 or stale_global_step == 0:
-            global_step_value, alignments, predicted_mels, ground_truth_mels, ids, texts = run_context.session.run(
-                (self.global_step_tensor, self.alignment_tensors, self.predicted_mel_tensor,
-                 self.ground_truth_mel_tensor, self.id_tensor, self.text_tensor))
-            id_strings = ",".join([str(i) for i in ids])
-            result_filename = "{}_result_step{:09d}_{}.tfrecord".format(self.mode, global_step_value, id_strings)
-            tf.logging.info("Saving a training result for %d at %s", global_step_value, result_filename)
-            write_training_result(global_step_value, list(ids), list(texts), list(predicted_mels),
-                                  list(ground_truth_mels),
-                                  alignments,
-                                  filename=os.path.join(self.writer.get_logdir(), result_filename))
-            if self.mode == tf.estimator.ModeKeys.EVAL:
-                alignments = [[a[i].T for a in alignments] for i in range(alignments[0].shape[0])]
-                for _id, text, align, pred_mel, gt_mel in zip(ids, texts, alignments, predicted_mels,
-                                                              ground_truth_mels):
-                    output_filename = "{}_result_step{:09d}_{:d}.png".format(self.mode,
-                                                                             global_step_value, _id)
-                    save_alignment(align, text.decode('utf-8'), _id,
-                                   os.path.join(self.writer.get_logdir(), "alignment_" + output_filename))
-                    plot_mel(gt_mel, pred_mel, os.path.join(self.writer.get_logdir(), "mel_" + output_filename))
+        wall_time = time.perf_counter() - self._start
+        results = run_values.results
+        self._step = results["global_step"] + 1
+        record = {
+            "step": int(results["global_step"]),
+            "wall_time": wall_time,
+            "examples_per_sec": results["num_examples"] / wall_time,
+            "frames_per_sec": results["num_frames"] / wall_time,
+            "padded_frame_ratio": 1.0 - results["num_frames"] / max(results["num_padded_frames"], 1),
+        }
+        step_stats = run_values.run_metadata.step_stats if run_values.run_metadata is not None else None
+        if step_stats is not None and step_stats.dev_stats:
+            input_wait = _input_wait(step_stats)
+            record["input_wait"] = input_wait
+            record["compute_time"] = wall_time - input_wait
+            if self._trace:
+                trace = timeline.Timeline(step_stats).generate_chrome_trace_format()
+                trace_filename = os.path.join(self.writer.get_logdir(), "timeline_step{:09d}.json".format(
+                    results["global_step"]))
+                with open(trace_filename, 'w') as f:
+                    f.write(trace)
+        self.writer.add_summary(tf.Summary(value=[
+            tf.Summary.Value(tag="step_time/" + name, simple_value=value) for name, value in record.items() if
+            name != "step"]), record["step"])
+        self._log.write(json.dumps(record) + "\n")
+        # records of a run that is killed are kept
+        self._log.flush()
+
+    def end(self, session):
+        self._log.close()
@@ -1,6 +1,8 @@
 import tensorflow as tf
 from deepvoice3_tensorflow.deepvoice3 import Encoder, Decoder, Converter, DecoderPreNetArgs, MultiHopAttentionArgs
-from deepvoice3_tensorflow.hooks import AlignmentSaver
+from deepvoice3_tensorflow.hooks import AlignmentSaver, StepTimeProfiler
+from deepvoice3_tensorflow.result_log import ResultLogWriter
+from deepvoice3_tensorflow.weight_normalization import folded_weight_normalization
 
 
 class SingleSpeakerTTSModel(tf.estimator.Estimator):
@@ -40,9 +42,18 @@ class SingleSpeakerTTSModel(tf.estimator.Estimator):
                               max_decoder_steps=params.max_decoder_steps,
                               min_decoder_steps=params.min_decoder_steps,
                               is_incremental=is_incremental,
+                              window_attention=params.window_attention,
+                              window_ahead=params.window_ahead,
+                              window_backward=params.window_backward,
+                              window_teacher_forcing=params.window_teacher_forcing,
+                              compact_finished=params.compact_finished,
                               training=training)
 
-            keys, values = encoder(features.source, text_positions=features.text_positions)
+            # packed batches have ids of the utterances that are concatenated in each row
+            source_segment_ids = getattr(features, "segment_ids", None)
+            target_segment_ids = getattr(labels, "segment_ids", None)
+            keys, values = encoder(features.source, text_positions=features.text_positions,
+                                   segment_ids=source_segment_ids)
 
             global_step = tf.train.get_global_step()
 
@@ -51,9 +62,10 @@ class SingleSpeakerTTSModel(tf.estimator.Estimator):
                 mel_outputs, done_hat, attention_states = decoder((keys, values), input=labels.mel,
                                                                   frame_positions=labels.frame_positions,
                                                                   text_positions=features.text_positions,
-                                                                  memory_mask=features.mask)
+                                                                  memory_mask=features.mask,
+                                                                  segment_ids=target_segment_ids)
                 # undo reduction
-                mel_outputs = tf.reshape(mel_outputs, shape=(params.batch_size, -1, params.num_mels))
+                mel_outputs = tf.reshape(mel_outputs, shape=(tf.shape(mel_outputs)[0], -1, params.num_mels))
 
                 alignments = [s.alignments for s in attention_states]
                 # drop last unused frame and artificial initial zero frame
@@ -69,17 +81,25 @@ class SingleSpeakerTTSModel(tf.estimator.Estimator):
                 alignment_saver = AlignmentSaver(alignments, global_step, mel_outputs, labels.mel, features.id,
                                                  features.text,
                                                  params.alignment_save_steps,
-                                                 "alignment_layer", mode, summary_writer)
+                                                 "alignment_layer", mode, summary_writer,
+                                                 result_log=result_log_writer(params, model_dir, mode))
+                step_time_profiler = StepTimeProfiler(global_step, num_examples(labels),
+                                                      tf.reduce_sum(labels.target_length),
+                                                      tf.size(labels.mel) // params.num_mels * params.downsample_step,
+                                                      params.profile_steps, params.trace_steps, summary_writer)
                 add_stats(encoder, decoder, mel_loss, done_loss)
-                return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op, training_hooks=[alignment_saver])
+                return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op,
+                                                  training_hooks=[alignment_saver, step_time_profiler])
 
             if mode == tf.estimator.ModeKeys.EVAL:
                 test_inputs = labels.mel if params.teacher_forcing else None
-                mel_outputs, done_hat, attention_states = decoder((keys, values),
-                                                                  text_positions=features.text_positions,
-                                                                  test_inputs=test_inputs)
+                # batches are padded, so padded keys are masked in incremental decoding too
+                mel_outputs, done_hat, attention_states, _ = decoder((keys, values),
+                                                                     text_positions=features.text_positions,
+                                                                     test_inputs=test_inputs,
+                                                                     memory_mask=features.mask)
                 # undo reduction
-                mel_outputs = tf.reshape(mel_outputs, shape=(params.batch_size, -1, params.num_mels))
+                mel_outputs = tf.reshape(mel_outputs, shape=(tf.shape(mel_outputs)[0], -1, params.num_mels))
                 alignments = [tf.transpose(tf.squeeze(s.alignment_history.stack(), axis=2), perm=[1, 0, 2]) for s in
                               attention_states]
 
@@ -87,11 +107,26 @@ class SingleSpeakerTTSModel(tf.estimator.Estimator):
                 alignment_saver = AlignmentSaver(alignments, global_step, mel_outputs, labels.mel, features.id,
                                                  features.text,
                                                  save_steps=1,
-                                                 tag_prefix="eval_alignment_layer", mode=mode, writer=summary_writer)
+                                                 tag_prefix="eval_alignment_layer", mode=mode, writer=summary_writer,
+                                                 result_log=result_log_writer(params, model_dir, mode))
                 # ToDo: calculate loss
                 return tf.estimator.EstimatorSpec(mode, loss=tf.constant(0),
                                                   evaluation_hooks=[alignment_saver])
 
+        def num_examples(labels):
+            if getattr(labels, "segment_ids", None) is not None:
+                # packed rows have segments 1 to the number of utterances in them
+                return tf.reduce_sum(tf.reduce_max(labels.segment_ids, axis=1))
+            return tf.size(labels.id)
+
+        def result_log_writer(params, model_dir, mode):
+            if not params.result_log:
+                return None
+            return ResultLogWriter(model_dir, "{}_results".format(mode), dtype=params.result_log_dtype,
+                                   top_k=params.result_log_top_k, mel_downsample=params.result_log_mel_downsample,
+                                   max_segment_bytes=params.result_log_segment_mb << 20,
+                                   max_segments=params.result_log_max_segments)
+
         def spec_loss(y_hat, y, mask, priority_bin=None, priority_w=0):
             l1_loss = tf.abs(y_hat - y)
 
@@ -112,6 +147,11 @@ class SingleSpeakerTTSModel(tf.estimator.Estimator):
             decoder.register_metrics()
             return tf.summary.merge_all()
 
+        def folded_model_fn(features, labels, mode, params):
+            # inference graphs read weights folded by export_inference_checkpoint.py
+            with folded_weight_normalization(params.fold_weight_normalization and mode != tf.estimator.ModeKeys.TRAIN):
+                return model_fn(features, labels, mode, params)
+
         super(SingleSpeakerTTSModel, self).__init__(
-            model_fn=model_fn, model_dir=model_dir, config=config,
+            model_fn=folded_model_fn, model_dir=model_dir, config=config,
             params=params, warm_start_from=warm_start_from)
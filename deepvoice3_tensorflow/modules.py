@@ -1,9 +1,10 @@
 import tensorflow as tf
 from tensorflow.python.layers import utils
-from .ops import causal_conv, noncausal_conv, conv_transpose_1d, Conv1dIncremental
+from .ops import causal_conv, noncausal_conv, conv_transpose_1d, segment_causal_conv, segment_noncausal_conv, \
+    conv1d_incremental_step, Conv1dIncrementalState
 from .weight_normalization import WeightNormalization
 from .cnn_cell import CNNCell
-from .positional_concoding import PositionalEncoding
+from .positional_concoding import PositionalEncoding, sinusoidal_encode_positions
 import math
 
 
@@ -92,6 +93,9 @@ class SinusoidalEncodingEmbedding(tf.layers.Layer):
         self.built = True
 
     def call(self, positions, w=1.0):
+        if not self.trainable:
+            # the weight keeps its initial value, so only the requested positions are encoded
+            return sinusoidal_encode_positions(positions, self.embedding_dim, w)
         encoded = PositionalEncoding(self.weight, self.num_embeddings, self.embedding_dim).sinusoidal_encode(w)
         return tf.nn.embedding_lookup(encoded.value, positions)
 
@@ -122,7 +126,8 @@ class Conv1d(CNNCell):
     def state_size(self):
         kernel_size = self.kernel_size
         buffer_size = kernel_size + (kernel_size - 1) * (self.dilation - 1)
-        return tf.TensorShape([None, buffer_size, self.in_channels])
+        return Conv1dIncrementalState(buffer=tf.TensorShape([None, buffer_size, self.in_channels]),
+                                      index=tf.TensorShape([]))
 
     @property
     def output_size(self):
@@ -133,13 +138,28 @@ class Conv1d(CNNCell):
         return self._is_incremental
 
     def zero_state(self, batch_size, dtype):
-        shape = self.state_size
-        # ToDo: Does not work if batch_size is a Tensor
-        shape = shape.merge_with(tf.TensorShape([batch_size, None, None])) if not shape.is_fully_defined() else shape
-        return tf.zeros(shape=shape, dtype=dtype)
+        shape = self.state_size.buffer
+        if isinstance(batch_size, tf.Tensor):
+            buffer = tf.zeros(shape=tf.stack([batch_size, shape[1].value, shape[2].value]), dtype=dtype)
+        else:
+            buffer = tf.zeros(shape=shape.merge_with(tf.TensorShape([batch_size, None, None])), dtype=dtype)
+        return Conv1dIncrementalState(buffer=buffer, index=tf.zeros(shape=[], dtype=tf.int32))
 
     def build(self, input_shape):
         assert input_shape[2].value == self.in_channels
+        if self.is_incremental:
+            # The first call of an incremental layer is in the body of tf.while_loop.
+            # Prepare the kernel outside of the loop so that it is computed once instead of at every step.
+            with tf.control_dependencies(None):
+                self._build_kernel()
+                # (kernel_size * in_channels, out_channels) with the oldest tap first
+                self.incremental_weight = tf.reshape(self.kernel,
+                                                     shape=[self.kernel_size * self.in_channels, self.out_channels])
+        else:
+            self._build_kernel()
+        self.built = True
+
+    def _build_kernel(self):
         kernel_size = self.kernel_size
         in_channels = self.in_channels
         out_channels = self.out_channels
@@ -160,29 +180,30 @@ class Conv1d(CNNCell):
         self.bias = self.add_variable("bias",
                                       shape=(1, 1, out_channels),
                                       initializer=bias_initializer)
-        self.built = True
 
-    def call(self, inputs, state=None):
-        kernel_size = self.kernel_size
-        in_channels = self.in_channels
-        out_channels = self.out_channels
+    def call(self, inputs, state=None, segment_ids=None):
+        '''
+        :param segment_ids: (B, T) ids of packed utterances. The receptive field does not cross segments.
+        '''
         padding = self.padding
-        input_buffer = state
-        if padding > 0:
+        if padding > 0 and segment_ids is None:
             inputs = tf.pad(inputs, [[0, 0], [padding, 0], [0, 0]], 'constant')
 
-        if self.is_incremental:
-            conv1d_incremental = Conv1dIncremental(tf.transpose(self.kernel, perm=[2, 1, 0]), in_channels,
-                                                   out_channels,
-                                                   kernel_size, self.dilation)
-            conv1d_output, next_input_buffer = conv1d_incremental.apply(inputs, training=self.is_training,
-                                                                        input_buffer=input_buffer)
+        if segment_ids is not None and not self.is_incremental:
+            conv1d_output = segment_causal_conv(inputs, self.kernel, self.dilation, segment_ids)
+        elif self.is_incremental:
+            if self.is_training:
+                raise RuntimeError('incremental Conv1d only supports eval mode')
+            if state is None:
+                raise ValueError("state is required")
+            conv1d_output, next_state = conv1d_incremental_step(inputs, self.incremental_weight, state,
+                                                                self.kernel_size, self.dilation)
         else:
             conv1d_output = causal_conv(inputs, self.kernel, self.dilation)
         ha = self.activation(conv1d_output + self.bias) if self.activation is not None else (
                 conv1d_output + self.bias)
         if self.is_incremental:
-            return ha, next_input_buffer
+            return ha, next_state
         else:
             return ha
 
@@ -231,8 +252,11 @@ class NonCausalConv1d(tf.layers.Layer):
                                       initializer=bias_initializer)
         self.built = True
 
-    def call(self, inputs, **kwargs):
-        conv1d_output = noncausal_conv(inputs, self.kernel, self.dilation)
+    def call(self, inputs, segment_ids=None, **kwargs):
+        if segment_ids is not None and self.kernel_size > 1:
+            conv1d_output = segment_noncausal_conv(inputs, self.kernel, self.dilation, segment_ids)
+        else:
+            conv1d_output = noncausal_conv(inputs, self.kernel, self.dilation)
         ha = self.activation(conv1d_output + self.bias) if self.activation is not None else (
                 conv1d_output + self.bias)
         return ha
@@ -341,7 +365,7 @@ class Conv1dGLU(CNNCell):
         ]):
             self.built = True
 
-    def call(self, inputs, input_buffer=None):
+    def call(self, inputs, input_buffer=None, segment_ids=None):
         residual = inputs
         x = tf.layers.dropout(inputs, rate=self.dropout, training=self.training)
         # split at C
@@ -349,7 +373,7 @@ class Conv1dGLU(CNNCell):
         if self.is_incremental:
             x, next_input_buffer = self.convolution(x, input_buffer)
         else:
-            x = self.convolution(x)
+            x = self.convolution(x, segment_ids=segment_ids)
 
         a, b = tf.split(x, num_or_size_splits=2, axis=splitdim)
         # apply GLU
@@ -419,13 +443,13 @@ class NonCausalConv1dGLU(tf.layers.Layer):
         ]):
             self.built = True
 
-    def call(self, inputs, input_buffer=None):
+    def call(self, inputs, input_buffer=None, segment_ids=None):
         residual = inputs
         x = tf.layers.dropout(inputs, rate=self.dropout, training=self.training)
         # split at C
         splitdim = -1
 
-        x = self.convolution(x)
+        x = self.convolution(x, segment_ids=segment_ids)
 
         a, b = tf.split(x, num_or_size_splits=2, axis=splitdim)
         # apply GLU
@@ -1,4 +1,5 @@
 import tensorflow as tf
+from collections import namedtuple
 from tensorflow.python.ops.nn_ops import conv1d_transpose
 
 
@@ -25,76 +26,75 @@ def noncausal_conv(value, filter_, dilation):
     return tf.nn.convolution(value, filter_, padding='SAME', dilation_rate=[dilation])
 
 
+def _shift(value, offset, padding_value=0):
+    '''
+    :param value: (B, T, ...)
+    :return: value shifted along T so that result[:, t] = value[:, t + offset], padded with padding_value
+    '''
+    if offset == 0:
+        return value
+    length = tf.shape(value)[1]
+    paddings = [[0, 0], [max(-offset, 0), max(offset, 0)]] + [[0, 0]] * (value.shape.ndims - 2)
+    padded = tf.pad(value, paddings, constant_values=padding_value)
+    return padded[:, max(offset, 0):max(offset, 0) + length]
+
+
+def _segment_conv(value, filter_, offsets, segment_ids):
+    # a tap contributes only if it reads from the same segment as the output position
+    outputs = []
+    for i, offset in enumerate(offsets):
+        same_segment = tf.equal(_shift(segment_ids, offset, padding_value=-1), segment_ids)
+        tap = _shift(value, offset) * tf.expand_dims(tf.cast(same_segment, value.dtype), axis=2)
+        outputs.append(tf.einsum("btc,ce->bte", tap, filter_[i]))
+    return tf.add_n(outputs)
+
+
+def segment_causal_conv(value, filter_, dilation, segment_ids):
+    '''
+    causal_conv for packed sequences. Taps never reach into a preceding segment.
+    :param value: (B, T, C) without causal padding
+    :param filter_: (filter_width, in_channels, out_channels) with a static filter_width
+    :param segment_ids: (B, T)
+    '''
+    filter_width = filter_.shape[0].value
+    offsets = [-(filter_width - 1 - i) * dilation for i in range(filter_width)]
+    return _segment_conv(value, filter_, offsets, segment_ids)
+
+
+def segment_noncausal_conv(value, filter_, dilation, segment_ids):
+    '''
+    noncausal_conv for packed sequences. Taps never reach into neighbouring segments.
+    '''
+    filter_width = filter_.shape[0].value
+    left = (filter_width - 1) * dilation // 2
+    offsets = [i * dilation - left for i in range(filter_width)]
+    return _segment_conv(value, filter_, offsets, segment_ids)
+
+
 def conv_transpose_1d(value, filter_, output_shape, stride, padding="SAME"):
     return conv1d_transpose(value, filter_, output_shape, stride, padding)
 
 
-# ToDo: do not use tf.layers.Layer. see tf.nn.convolution.
-class Conv1dIncremental(tf.layers.Layer):
-    def __init__(self, weight, in_channels, out_channels, kernel_size, dilation=1, name="conv1d_incremental",
-                 trainable=True, **kwargs):
-        '''
-
-        :param weight: (out_channels, in_channels, kernel_size)
-        :param in_channels:
-        :param out_channels:
-        :param kernel_size:
-        :param dilation:
-        :param bias:
-        :param name:
-        :param trainable:
-        :param kwargs:
-        '''
-        super(Conv1dIncremental, self).__init__(name=name, trainable=trainable, **kwargs)
-        # (out_channels, in_channels, kernel_size)
-        self.weight = weight
-        self.in_channels = in_channels
-        self.out_channels = out_channels
-        self.kernel_size = kernel_size
-        self.dilation = dilation
-
-    def build(self, input_shape):
-        # input: bsz x len x dim
-        self.batch_size = input_shape[0]
-        self.shape_c = input_shape[2]
-        with tf.control_dependencies(
-                [tf.assert_equal(tf.shape(self.weight), (self.out_channels, self.in_channels, self.kernel_size))]):
-            super(Conv1dIncremental, self).build(input_shape)
-
-    def call(self, inputs, input_buffer=None, training=False):
-        # input: (B, T, C) where T=1
-        if training:
-            raise RuntimeError('Conv1dIncremental only supports eval mode')
-        if input_buffer is None:
-            raise ValueError("input_buffer tensor is required")
-        input_buffer_shape = input_buffer.get_shape()
-
-        dilation = self.dilation
-
-        input_buffer = tf.slice(input_buffer, begin=[0, 1, 0], size=[-1, -1, -1])
-        # append next input
-        input_buffer = tf.concat(
-            [input_buffer,
-             tf.slice(inputs, begin=[0, tf.shape(inputs)[1] - 1, 0], size=[-1, -1, -1])],
-            axis=1)
-        input_buffer.set_shape(input_buffer_shape)
-        next_input_buffer = input_buffer
-        if dilation > 1:
-            input_buffer = input_buffer[:, 0::dilation, :]
-
-        # (out_channels, in_channels, dilation(kernel_size))
-        weight = tf.transpose(self.weight, perm=[0, 2, 1])
-        # (out_channels, dilation(kernel_size) * in_channels)
-        weight = tf.reshape(weight, shape=[self.out_channels, -1])
-        # (batch_size, dilation(kernel_size) * in_channels)
-        inputs = tf.reshape(input_buffer, shape=[self.batch_size, -1])
-        # (batch_size, out_channels)
-        output = tf.matmul(inputs, tf.transpose(weight))
-        # (batch_size, 1, out_channels)
-        output = tf.reshape(output, shape=[self.batch_size, 1, -1])
-        return output, next_input_buffer
-
-    def initial_input_buffer(self):
-        kw = self.kernel_size
-        input_buffer = tf.zeros(shape=[self.batch_size, kw + (kw - 1) * (self.dilation - 1), self.shape_c])
-        return input_buffer
+# ring buffer of the last (kernel_size - 1) * dilation + 1 inputs and the slot that the next input is written to
+Conv1dIncrementalState = namedtuple("Conv1dIncrementalState", ["buffer", "index"])
+
+
+def conv1d_incremental_step(inputs, weight, state, kernel_size, dilation):
+    '''
+    One step of a causal convolution. Only the kernel_size taps of the ring buffer are read.
+    :param inputs: (B, 1, in_channels)
+    :param weight: (kernel_size * in_channels, out_channels) kernel flattened with the oldest tap first
+    :param state: Conv1dIncrementalState
+    :return: (B, 1, out_channels) output and the next Conv1dIncrementalState
+    '''
+    inputs = inputs[:, -1:, :]
+    if kernel_size == 1:
+        return tf.expand_dims(tf.matmul(tf.squeeze(inputs, axis=1), weight), axis=1), state
+    buffer_size = (kernel_size - 1) * dilation + 1
+    write = tf.reshape(tf.one_hot(state.index, buffer_size), [1, buffer_size, 1])
+    buffer = state.buffer + write * (inputs - state.buffer)
+    # slots from the oldest tap to the input just written
+    taps = tf.mod(state.index - dilation * tf.range(kernel_size - 1, -1, -1), buffer_size)
+    x = tf.reshape(tf.gather(buffer, taps, axis=1), tf.stack([tf.shape(inputs)[0], -1]))
+    output = tf.expand_dims(tf.matmul(x, weight), axis=1)
+    return output, Conv1dIncrementalState(buffer, tf.mod(state.index + 1, buffer_size))
@@ -34,14 +34,28 @@ class PositionalEncoding(object):
 
     @staticmethod
     def initial_value(n_position, dimension, position_rate=1.0):
-        def value_at(position, index):
-            return position_rate * position / np.power(10000, 2 * (index // 2) / dimension)
+        values = position_rate * np.arange(n_position)[:, np.newaxis] / _dimension_constants(dimension)
+        return PositionalEncoding(tf.constant(values, dtype=tf.float32), n_position, dimension)
 
-        values = [[
-            value_at(pos, i) for i in
-            range(dimension)
-        ] for pos in range(n_position)]
-        return PositionalEncoding(tf.constant(np.array(values), dtype=tf.float32), n_position, dimension)
+
+def _dimension_constants(dimension):
+    return np.power(10000, 2 * (np.arange(dimension) // 2) / dimension)
+
+
+def sinusoidal_encode_positions(positions, dimension, position_rate=1.0):
+    '''
+    Closed form of rows of `PositionalEncoding.initial_value(...).sinusoidal_encode(position_rate).value`.
+    Only the requested positions are evaluated, so a lookup does not depend on the number of positions.
+    :param positions: integer tensor of any shape
+    :return: tensor of shape positions.shape + [dimension]
+    '''
+    assert dimension % 2 == 0
+    frequencies = tf.constant(1.0 / _dimension_constants(dimension)[0::2], dtype=tf.float32)
+    angles = position_rate * tf.expand_dims(tf.to_float(positions), axis=-1) * frequencies
+    sin_cos = tf.stack([tf.sin(angles), tf.cos(angles)], axis=-1)
+    # position 0 is not encoded and stays zero
+    not_zero = tf.expand_dims(tf.expand_dims(tf.to_float(tf.not_equal(positions, 0)), axis=-1), axis=-1)
+    return tf.reshape(sin_cos * not_zero, tf.concat([tf.shape(positions), [dimension]], axis=0))
 
 
 class SinusoidalEncoding(object):
@@ -60,12 +74,8 @@ class SinusoidalEncoding(object):
 
     @property
     def value(self):
-        dimension = self._pe.dimension
-        odd_idx = [[d] for d in range(0, dimension, 2)]
-        even_idx = [[d] for d in range(1, dimension, 2)]
-        shape = [self._pe.dimension, self._pe.n_positions] # transposed
-        updates = tf.transpose(tf.concat([self.odd, self.even], axis=-1), perm=(1,0))
-        return tf.transpose(tf.scatter_nd(indices=odd_idx + even_idx, updates=updates, shape=shape), perm=(1,0))
+        # interleave odd and even columns
+        return tf.reshape(tf.stack([self.odd, self.even], axis=-1), [-1, self._pe.dimension])
 
     def shift_factor(self, shift):
         ''' return shift factor matrix for sinusoidal encoding table
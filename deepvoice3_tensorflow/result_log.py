@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+import numpy as np
+from collections import namedtuple
+
+# A result log keeps training results of many steps in a few append-only files:
+#   <prefix>-<segment>.bin: raw arrays of results, a new segment is started every max_segment_bytes
+#   <prefix>-index.jsonl: one line per utterance with the step, id, text, segment and array locations
+# Only the last max_segments segments are kept, so the log rolls over in long runs.
+
+
+class TrainingResult(
+    namedtuple("TrainingResult",
+               ["global_step", "id", "text", "predicted_mel", "ground_truth_mel", "alignments"])):
+    pass
+
+
+def result_log_index_filename(prefix):
+    return prefix + "-index.jsonl"
+
+
+def result_log_segment_filename(prefix, segment):
+    return "%s-%05d.bin" % (prefix, segment)
+
+
+def downsample_mel(mel, factor):
+    '''
+    Averages every factor frames. Trailing frames that do not fill a group are dropped.
+    '''
+    if factor <= 1:
+        return mel
+    length = mel.shape[0] // factor * factor
+    return mel[:length].reshape(-1, factor, mel.shape[1]).mean(axis=1)
+
+
+def encode_top_k(alignment, k):
+    '''
+    :param alignment: (T_dec, T_enc) attention weights
+    :return: (T_dec, k) indices and values of the k largest weights of each decoder step
+    '''
+    k = min(k, alignment.shape[1])
+    indices = np.argpartition(-alignment, k - 1, axis=1)[:, :k]
+    index_dtype = np.uint16 if alignment.shape[1] <= np.iinfo(np.uint16).max else np.int32
+    return indices.astype(index_dtype), np.take_along_axis(alignment, indices, axis=1)
+
+
+def decode_top_k(indices, values, shape):
+    alignment = np.zeros(shape, dtype=np.float32)
+    np.put_along_axis(alignment, indices.astype(np.int64), values, axis=1)
+    return alignment
+
+
+class ResultLogWriter():
+    '''
+    Appends training results to a result log. Safe to call from several threads.
+    '''
+
+    def __init__(self, log_dir, prefix, dtype="float16", top_k=0, mel_downsample=1, max_segment_bytes=64 << 20,
+                 max_segments=0):
+        '''
+        :param dtype: dtype that mels and alignment weights are stored in
+        :param top_k: if positive, only the k largest alignment weights of each decoder step are stored
+        :param mel_downsample: number of mel frames averaged into one stored frame
+        :param max_segments: number of segments kept, 0 to keep all
+        '''
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.top_k = top_k
+        self.mel_downsample = mel_downsample
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        entries = _read_index(self._index_path())
+        self._segments = sorted({e["segment"] for e in entries})
+        self._segment = self._segments[-1] if self._segments else -1
+        # a new run starts a new segment, so a segment torn by a crash is never appended to.
+        # Segments are opened by the first write to them, so no empty segment is left behind.
+        self._data_file = None
+        self._index_file = open(self._index_path(), 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, global_step, ids, texts, predicted_mels, ground_truth_mels, alignments):
+        '''
+        Appends a batch of results with the same arguments as write_training_result.
+        :param alignments: list of (B, T_dec, T_enc) alignments of each layer
+        '''
+        with self._lock:
+            if self._data_file is None:
+                self._open_next_segment()
+            for i, (id, text, predicted_mel, ground_truth_mel) in enumerate(
+                    zip(ids, texts, predicted_mels, ground_truth_mels)):
+                self._write_entry(int(global_step), int(id), text.decode('utf-8') if isinstance(text, bytes) else text,
+                                  predicted_mel, ground_truth_mel, [a[i] for a in alignments])
+            # the index never refers to bytes that are not on disk
+            self._data_file.flush()
+            self._index_file.flush()
+            if self._data_file.tell() >= self.max_segment_bytes:
+                self._data_file.close()
+                self._data_file = None
+
+    def _write_entry(self, global_step, id, text, predicted_mel, ground_truth_mel, alignments):
+        arrays = {
+            "predicted_mel": downsample_mel(predicted_mel, self.mel_downsample).astype(self.dtype),
+            "ground_truth_mel": downsample_mel(ground_truth_mel, self.mel_downsample).astype(self.dtype),
+        }
+        for layer, alignment in enumerate(alignments):
+            if self.top_k > 0:
+                indices, values = encode_top_k(alignment, self.top_k)
+                arrays["alignment%d_indices" % layer] = indices
+                arrays["alignment%d_values" % layer] = values.astype(self.dtype)
+            else:
+                arrays["alignment%d" % layer] = alignment.astype(self.dtype)
+        locations = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            locations[name] = [self._data_file.tell(), array.dtype.str, list(array.shape)]
+            self._data_file.write(array.tobytes())
+        entry = {
+            "step": global_step,
+            "id": id,
+            "text": text,
+            "segment": self._segment,
+            "mel_downsample": self.mel_downsample,
+            "alignment_shapes": [list(a.shape) for a in alignments],
+            "arrays": locations,
+        }
+        self._index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _open_next_segment(self):
+        self._segment += 1
+        self._segments.append(self._segment)
+        self._data_file = open(self._segment_path(self._segment), 'ab')
+        if 0 < self.max_segments < len(self._segments):
+            dropped = set(self._segments[:-self.max_segments])
+            self._segments = self._segments[-self.max_segments:]
+            self._index_file.close()
+            entries = [e for e in _read_index(self._index_path()) if e["segment"] not in dropped]
+            with open(self._index_path() + ".tmp", 'w', encoding='utf-8') as f:
+                for e in entries:
+                    f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            os.replace(self._index_path() + ".tmp", self._index_path())
+            for segment in dropped:
+                if os.path.exists(self._segment_path(segment)):
+                    os.remove(self._segment_path(segment))
+            self._index_file = open(self._index_path(), 'a', encoding='utf-8')
+
+    def close(self):
+        with self._lock:
+            if self._data_file is not None:
+                self._data_file.close()
+            self._index_file.close()
+
+    def _index_path(self):
+        return os.path.join(self.log_dir, result_log_index_filename(self.prefix))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.log_dir, result_log_segment_filename(self.prefix, segment))
+
+
+def _read_index(filename):
+    if not os.path.exists(filename):
+        return []
+    entries = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            # the last line may be incomplete while the log is written
+            if line.endswith("\n"):
+                entries.append(json.loads(line))
+    return entries
+
+
+class ResultLog():
+    '''
+    Lazy reader of a result log. Only the index is read up front, and arrays are read when an entry is decoded.
+    '''
+
+    def __init__(self, log_dir, prefix):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.index = _read_index(os.path.join(log_dir, result_log_index_filename(prefix)))
+        # memory maps of segments that entries have been read from
+        self._segments = {}
+
+    @staticmethod
+    def from_index_filename(filename):
+        suffix = result_log_index_filename("")
+        assert filename.endswith(suffix)
+        return ResultLog(os.path.dirname(filename), os.path.basename(filename)[:-len(suffix)])
+
+    @staticmethod
+    def is_index_filename(filename):
+        return filename.endswith(result_log_index_filename(""))
+
+    def __len__(self):
+        return len(self.index)
+
+    def entries(self, min_step=None, max_step=None, ids=None):
+        '''
+        :return: index entries with a step in [min_step, max_step] and an id in ids
+        '''
+        return [e for e in self.index if
+                (min_step is None or e["step"] >= min_step) and
+                (max_step is None or e["step"] <= max_step) and
+                (ids is None or e["id"] in ids)]
+
+    def _array(self, entry, name):
+        offset, dtype, shape = entry["arrays"][name]
+        dtype = np.dtype(dtype)
+        segment = entry["segment"]
+        if segment not in self._segments:
+            self._segments[segment] = np.memmap(
+                os.path.join(self.log_dir, result_log_segment_filename(self.prefix, segment)), dtype=np.uint8,
+                mode='r')
+        return self._segments[segment][offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+
+    def read(self, entry):
+        '''
+        :return: TrainingResult with float32 arrays. alignments are transposed to (T_enc, T_dec) like
+        read_training_result. Arrays stored as float32 are views into the log without copies.
+        '''
+        alignments = []
+        for layer, shape in enumerate(entry["alignment_shapes"]):
+            if "alignment%d" % layer in entry["arrays"]:
+                alignment = self._array(entry, "alignment%d" % layer).astype(np.float32, copy=False)
+            else:
+                alignment = decode_top_k(self._array(entry, "alignment%d_indices" % layer),
+                                         self._array(entry, "alignment%d_values" % layer), shape)
+            alignments.append(alignment.T)
+        return TrainingResult(
+            global_step=entry["step"],
+            id=entry["id"],
+            text=entry["text"],
+            predicted_mel=self._array(entry, "predicted_mel").astype(np.float32, copy=False),
+            ground_truth_mel=self._array(entry, "ground_truth_mel").astype(np.float32, copy=False),
+            alignments=alignments,
+        )
+
+    def __iter__(self):
+        for entry in self.index:
+            yield self.read(entry)
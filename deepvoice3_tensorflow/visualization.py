@@ -0,0 +1,148 @@
+import glob
+import os
+import re
+import struct
+import zlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from data.parallel import imap_unordered
+from deepvoice3_tensorflow.result_log import ResultLog, result_log_index_filename
+
+# Bulk rendering of training results in result TFRecords and result logs.
+# Files and log entries are filtered by step and id before they are decoded, and decoding and rendering run in
+# worker processes.
+
+_result_filename_pattern = re.compile(r"_result_step(\d+)_([\d,]*)\.tfrecord$")
+
+
+def parse_result_filename(filename):
+    '''
+    :return: step and ids encoded in a result TFRecord filename, or None if it is not one
+    '''
+    match = _result_filename_pattern.search(filename)
+    if match is None:
+        return None
+    return int(match.group(1)), [int(i) for i in match.group(2).split(",") if i]
+
+
+def result_source_name(filename):
+    '''
+    :return: name of a result TFRecord or result log without the step and ids, such as "train" or "eval_results"
+    '''
+    basename = os.path.basename(filename)
+    if ResultLog.is_index_filename(basename):
+        return basename[:-len(result_log_index_filename(""))]
+    match = _result_filename_pattern.search(basename)
+    if match is not None:
+        return basename[:match.start()]
+    return os.path.splitext(basename)[0]
+
+
+def _in_range(step, min_step, max_step):
+    return (min_step is None or step >= min_step) and (max_step is None or step <= max_step)
+
+
+def result_tasks(path, min_step=None, max_step=None, ids=None, entries_per_task=16):
+    '''
+    :param path: directory, glob, result TFRecord or result log index
+    :return: list of (filename, entries). entries are result log index entries, or None for a TFRecord.
+    '''
+    if os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(path, "*_result_step*.tfrecord")) +
+                           glob.glob(os.path.join(path, "*-index.jsonl")))
+    else:
+        filenames = sorted(glob.glob(path))
+    tasks = []
+    for filename in filenames:
+        if ResultLog.is_index_filename(filename):
+            entries = ResultLog.from_index_filename(filename).entries(min_step, max_step, ids)
+            tasks += [(filename, entries[i:i + entries_per_task]) for i in
+                      range(0, len(entries), entries_per_task)]
+        else:
+            step_and_ids = parse_result_filename(filename)
+            if step_and_ids is not None:
+                step, file_ids = step_and_ids
+                if not _in_range(step, min_step, max_step) or (ids is not None and not ids.intersection(file_ids)):
+                    continue
+            tasks.append((filename, None))
+    return tasks
+
+
+def _render_task(read_training_result, render, output_dir, prefix, min_step, max_step, ids, filename, entries):
+    if entries is None:
+        results = (r for r in read_training_result(filename) if
+                   _in_range(r.global_step, min_step, max_step) and (ids is None or r.id in ids))
+    else:
+        log = ResultLog.from_index_filename(filename)
+        results = (log.read(entry) for entry in entries)
+    outputs = []
+    for result in results:
+        # results of train and eval in one directory do not overwrite each other
+        output_filename = os.path.join(output_dir, "{}{}_step{:09d}_{}.png".format(prefix, result_source_name(filename),
+                                                                                 result.global_step, result.id))
+        render(result, output_filename)
+        outputs.append(output_filename)
+    return outputs
+
+
+def render_results(tasks, read_training_result, render, output_dir, prefix, min_step=None, max_step=None, ids=None,
+                   num_workers=None):
+    '''
+    Renders results of tasks from result_tasks in worker processes.
+    :param read_training_result: function from a result TFRecord filename to TrainingResults
+    :param render: function of a TrainingResult and an output filename. It must be picklable.
+    :return: generator of filenames of rendered images
+    '''
+    num_workers = num_workers or cpu_count()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        inputs = ((read_training_result, render, output_dir, prefix, min_step, max_step, ids, filename, entries) for
+                  filename, entries in tasks)
+        for _, outputs in imap_unordered(executor, _render_task, inputs, max_in_flight=num_workers * 2):
+            yield from outputs
+
+
+def _colormap(name="viridis"):
+    from matplotlib import cm
+    return (cm.get_cmap(name)(np.linspace(0.0, 1.0, 256))[:, :3] * 255).astype(np.uint8)
+
+
+_lut = None
+
+
+def alignment_image(alignments, separator=2):
+    '''
+    Colors alignments without matplotlib. Each layer is scaled to its own range like imshow.
+    :param alignments: list of (T_enc, T_dec) alignments
+    :return: (H, W, 3) uint8 image with the layers stacked from top to bottom and encoder step 0 at the bottom
+    '''
+    global _lut
+    if _lut is None:
+        _lut = _colormap()
+    width = max(a.shape[1] for a in alignments)
+    rows = []
+    for alignment in alignments:
+        low, high = alignment.min(), alignment.max()
+        scaled = (alignment - low) * (255.0 / max(high - low, 1e-8))
+        layer = np.full((alignment.shape[0], width, 3), 255, dtype=np.uint8)
+        layer[:, :alignment.shape[1]] = _lut[scaled[::-1].astype(np.uint8)]
+        rows += [layer, np.full((separator, width, 3), 255, dtype=np.uint8)]
+    return np.concatenate(rows[:-1], axis=0)
+
+
+def _png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png(image, filename):
+    '''
+    Writes a (H, W, 3) uint8 image as an RGB PNG.
+    '''
+    height, width, _ = image.shape
+    # every scanline starts with filter type 0
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * 3)], axis=1)
+    with open(filename, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(_png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(_png_chunk(b"IEND", b""))
@@ -1,5 +1,27 @@
+import os
+import re
+from contextlib import contextmanager
+import numpy as np
 import tensorflow as tf
 
+# When folding is enabled, WeightNormalization layers read the normalized weight g/||v|| * v from a single variable
+# "w" instead of computing it from g and v at every use. fold_checkpoint writes w into a copy of a trained checkpoint.
+_folded = False
+
+
+@contextmanager
+def folded_weight_normalization(enabled=True):
+    '''
+    WeightNormalization layers constructed in this context read folded weights.
+    '''
+    global _folded
+    previous = _folded
+    _folded = enabled
+    try:
+        yield
+    finally:
+        _folded = previous
+
 
 class WeightNormalization(tf.layers.Layer):
     def __init__(self, weight, dimension=0, trainable=True, name=None, **kwargs):
@@ -9,8 +31,16 @@ class WeightNormalization(tf.layers.Layer):
         self.dimension = dimension
         self.ndims = self.weight_value.shape.ndims
         self.reduction_axis = self._compute_reduction_axis()
+        self.folded = _folded
 
     def build(self, weight_shape):
+        if self.folded:
+            self.w = self.add_variable(name="w", shape=weight_shape, dtype=tf.float32,
+                                       initializer=lambda shape, dtype=None, partition_info=None,
+                                                          verify_shape=None: self.weight_value,
+                                       trainable=False)
+            self.built = True
+            return
         # add g and v as new parameters and express w as g/||v|| * v
         g_shape = [weight_shape[i].value for i in self.reduction_axis]
         self.g = self.add_variable(name="g", shape=g_shape, dtype=tf.float32,
@@ -29,6 +59,8 @@ class WeightNormalization(tf.layers.Layer):
         return norm
 
     def compute_weight(self):
+        if self.folded:
+            return self.w
         g = self.g
         v = self.v
         gv = (g / tf.norm(v, axis=self._unwrap_if_rank0(self.reduction_axis)))
@@ -43,9 +75,54 @@ class WeightNormalization(tf.layers.Layer):
         return r[0] if len(r) == 1 else r
 
     def register_metrics(self):
+        if self.folded:
+            tf.summary.histogram(self.w.name, self.w)
+            return
         tf.summary.histogram(self.g.name, self.g)
         tf.summary.histogram(self.v.name, self.v)
 
 def weight_normalization(weight, dimension=0):
     wn = WeightNormalization(weight, dimension)
     return wn.apply(weight)
+
+
+def fold(g, v, dimension=0):
+    '''
+    numpy version of WeightNormalization.compute_weight
+    '''
+    reduction_axis = tuple(i for i in range(v.ndim) if i != dimension)
+    gv = g / np.sqrt(np.sum(np.square(v), axis=reduction_axis))
+    shape = [1] * v.ndim
+    shape[dimension] = -1
+    return v * gv.reshape(shape)
+
+
+_optimizer_slot_pattern = re.compile(r"(/Adam(_\d+)?|^beta\d_power(_\d+)?)$")
+
+
+def fold_checkpoint(checkpoint_path, output_dir):
+    '''
+    Writes a copy of a checkpoint for graphs built with folded_weight_normalization.
+    Every pair of WeightNormalization variables g and v is replaced by w = g/||v|| * v, and optimizer slots are dropped.
+    :return: path of the written checkpoint
+    '''
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    names = reader.get_variable_to_shape_map()
+    scopes = sorted(name[:-len("/g")] for name in names if
+                    name.endswith("/g") and name[:-len("/g")] + "/v" in names and
+                    name.split("/")[-2].startswith("weight_normalization"))
+    normalized = {s + "/g" for s in scopes} | {s + "/v" for s in scopes}
+    with tf.Graph().as_default():
+        variables = []
+        for name in sorted(names):
+            if name in normalized or _optimizer_slot_pattern.search(name):
+                continue
+            variables.append(tf.Variable(reader.get_tensor(name), name=name, trainable=False))
+        for scope in scopes:
+            w = fold(reader.get_tensor(scope + "/g"), reader.get_tensor(scope + "/v"))
+            variables.append(tf.Variable(w, name=scope + "/w", trainable=False))
+        saver = tf.train.Saver(variables)
+        global_step = int(reader.get_tensor("global_step")) if reader.has_tensor("global_step") else None
+        with tf.Session() as sess:
+            sess.run(tf.variables_initializer(variables))
+            return saver.save(sess, os.path.join(output_dir, "model.ckpt"), global_step=global_step)
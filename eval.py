@@ -16,35 +16,16 @@ options:
 from docopt import docopt
 import tensorflow as tf
 import importlib
-from deepvoice3_tensorflow.frontend import Frontend
+from deepvoice3_tensorflow.frontend import TRAIN_SEQ2SEQ
+from deepvoice3_tensorflow.frontend.pipeline import eval_frontend, eval_stages, apply_stages
 from deepvoice3_tensorflow.models import SingleSpeakerTTSModel
 from hparams import hparams, hparams_debug_string
 
 
-def eval(hparams, model_dir, source_files, target_files, checkpoint_path=None):
+def eval(hparams, model_dir, source_files, target_files, checkpoint_path=None, target_store=None, spec_files=None):
     def eval_input_fn():
-        source = tf.data.TFRecordDataset(list(source_files)[:16])
-        target = tf.data.TFRecordDataset(list(target_files)[:16])
-
-        frontend = Frontend(source, target, hparams)
-        batched = frontend.prepare(
-
-        ).zip_source_and_target(
-
-        )
-        batched = batched.swap_source() if hparams.swap_source else batched
-        batched = batched.group_by_batch(
-
-        ).add_memory_mask(
-
-        ).add_frame_positions(
-
-        ).add_target_mask(
-
-        ).downsample_mel(
-
-        ).dataset
-        return batched
+        frontend = eval_frontend(source_files, target_files, hparams, target_store, spec_files)
+        return apply_stages(frontend, eval_stages(hparams))
 
     estimator = SingleSpeakerTTSModel(hparams, model_dir)
 
@@ -63,11 +44,15 @@ def main():
     dataset_instance = dataset.instantiate(in_dir="", out_dir=data_root)
 
     hparams.parse(args["--hparams"])
-    hparams.batch_size = 1
+    # only the seq2seq model is evaluated, so linear spectrograms are not loaded
+    hparams.train_mode = TRAIN_SEQ2SEQ
     print(hparams_debug_string())
 
     tf.logging.set_verbosity(tf.logging.INFO)
-    eval(hparams, checkpoint_dir, dataset_instance.source_files, dataset_instance.target_files, checkpoint_path)
+    spec_files = dataset_instance.spec_files
+    spec_files = None if spec_files is None else list(spec_files)
+    eval(hparams, checkpoint_dir, list(dataset_instance.source_files), list(dataset_instance.target_files),
+         checkpoint_path, dataset_instance.packed_target_store, spec_files)
 
 
 if __name__ == '__main__':
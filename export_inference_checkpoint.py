@@ -0,0 +1,29 @@
+"""Folds weight normalization of a trained checkpoint for inference.
+
+usage: export_inference_checkpoint.py [options] <checkpoint> <output-dir>
+
+<checkpoint> is a checkpoint path or a checkpoint directory, whose latest checkpoint is exported.
+Evaluate or synthesize from <output-dir> with the fold_weight_normalization=True hyper parameter.
+
+options:
+    -h, --help                   Show this help message and exit
+"""
+
+from docopt import docopt
+import tensorflow as tf
+import os
+from deepvoice3_tensorflow.weight_normalization import fold_checkpoint
+
+
+def main():
+    args = docopt(__doc__)
+    checkpoint_path = args["<checkpoint>"]
+    output_dir = args["<output-dir>"]
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    os.makedirs(output_dir, exist_ok=True)
+    print(fold_checkpoint(checkpoint_path, output_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -42,15 +42,39 @@ hparams = tf.contrib.training.HParams(
     # can be computed by `compute_timestamp_ratio.py`.
     key_position_rate=1.03, # for jsut
     use_memory_mask=True,
+    # attend only to keys from window_backward before to window_ahead after the last attended key
+    # at each step of incremental decoding
+    window_attention=False,
+    window_ahead=3,
+    window_backward=1,
     trainable_positional_encodings=False,
     freeze_embedding=False,
     converter_channels=256,
 
     # Training
+    # seq2seq, postnet or seq2seq_and_postnet. Linear spectrograms are not loaded in seq2seq mode.
+    # SingleSpeakerTTSModel builds only the seq2seq model.
+    train_mode="seq2seq",
     batch_size=16,
     approx_min_target_length=200,
     batch_bucket_width=40,
     batch_num_buckets=50,
+    # buckets at quantiles of target and source lengths in preprocessed metadata.
+    # approx_min_target_length, batch_bucket_width and batch_num_buckets are used if it is disabled.
+    bucket_by_metadata=True,
+    batch_num_target_buckets=10,
+    batch_num_source_buckets=3,
+    # fixed, budget or packed. budget fills each batch up to batch_max_frames padded target frames
+    # and batch_max_source_tokens padded source tokens instead of batch_size utterances.
+    # packed concatenates utterances into batch_size rows of up to pack_max_frames and pack_max_source_tokens.
+    batch_mode="fixed",
+    batch_max_frames=8000,
+    batch_max_source_tokens=1600,
+    pack_max_frames=1200,
+    pack_max_source_tokens=200,
+    # utterances longer than these are dropped in the budget and packed batch modes
+    max_target_length=1200,
+    max_source_length=200,
     initial_learning_rate=1e-4,  # 0.0001,
     adam_beta1=0.5,
     adam_beta2=0.9,
@@ -58,10 +82,39 @@ hparams = tf.contrib.training.HParams(
     save_summary_steps=50,
     log_step_count_steps=1,
     alignment_save_steps=100,
+    # append saved results to <mode>_results-index.jsonl and rolling segments instead of a TFRecord per save
+    result_log=False,
+    # dtype of stored mels and alignments
+    result_log_dtype="float16",
+    # if positive, only the k largest alignment weights of each decoder step are stored
+    result_log_top_k=0,
+    # number of mel frames averaged into one stored frame
+    result_log_mel_downsample=1,
+    result_log_segment_mb=64,
+    # number of segments kept, 0 to keep all
+    result_log_max_segments=0,
+    # interval of steps whose time is split into waiting for input and compute, 0 to disable
+    profile_steps=100,
+    # interval of steps with a full Chrome trace, 0 to disable
+    trace_steps=0,
+
+    # Input pipeline
+    # parallel calls of each map, -1 for autotune
+    input_num_parallel_calls=-1,
+    # number of files read concurrently
+    input_num_parallel_reads=4,
+    # number of prefetched batches, -1 for autotune
+    input_prefetch_buffer_size=-1,
 
     # Evaluation
     teacher_forcing=False,
+    # apply window_attention to teacher forced evaluation too
+    window_teacher_forcing=False,
+    # decode only the utterances of a batch that have not finished instead of masking finished ones
+    compact_finished=False,
     swap_source=False,
+    # read weights folded by export_inference_checkpoint.py instead of weight normalization variables
+    fold_weight_normalization=False,
     )
 
 
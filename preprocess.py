@@ -9,6 +9,15 @@ options:
     --download               Download data.
     --source-only            Process source only.
     --target-only            Process target only.
+    --shard-size=<n>         Pack n utterances per TFRecord shard with an offset index.
+    --force                  Reprocess utterances whose outputs are up to date.
+    --streaming              Keep a bounded number of tasks in flight and consume results as they complete.
+    --max-in-flight=<n>      Maximum number of pending tasks in streaming mode (4 x num_workers by default).
+    --chunk-size=<n>         Number of utterances per task in streaming mode [default: 1].
+    --packed                 Write targets into a memory-mapped packed feature store instead of TFRecords.
+    --packed-spec            Also pack linear spectrograms into the packed feature store.
+    --split-spec             Write mel and linear spectrograms of targets to separate TFRecords.
+    --storage-format=<fmt>   Spectrogram storage in target TFRecords: float32, float16, uint8 or uint16 [default: float32].
     -h, --help               Show help message.
 """
 
@@ -16,6 +25,7 @@ from docopt import docopt
 from multiprocessing import cpu_count
 import importlib
 from data import SOURCE_ONLY, TARGET_ONLY, SOURCE_AND_TARGET
+from data.tfrecord_utils import STORAGE_FORMATS
 
 if __name__ == "__main__":
     args = docopt(__doc__)
@@ -27,6 +37,18 @@ if __name__ == "__main__":
     download = args["--download"]
     source_only = args["--source-only"]
     target_only = args["--target-only"]
+    shard_size = args["--shard-size"]
+    shard_size = None if shard_size is None else int(shard_size)
+    force = args["--force"]
+    streaming = args["--streaming"]
+    max_in_flight = args["--max-in-flight"]
+    max_in_flight = None if max_in_flight is None else int(max_in_flight)
+    chunk_size = int(args["--chunk-size"])
+    packed = args["--packed"]
+    packed_spec = args["--packed-spec"]
+    split_spec = args["--split-spec"]
+    storage_format = args["--storage-format"]
+    assert storage_format in STORAGE_FORMATS
     mode = SOURCE_AND_TARGET
     if source_only:
         mode = SOURCE_ONLY
@@ -38,4 +60,6 @@ if __name__ == "__main__":
     instance = mod.instantiate(in_dir, out_dir)
     if download:
         instance.download()
-    instance.preprocess(num_workers, mode=mode)
\ No newline at end of file
+    instance.preprocess(num_workers, mode=mode, shard_size=shard_size, force=force, streaming=streaming,
+                        max_in_flight=max_in_flight, chunk_size=chunk_size, packed=packed, packed_spec=packed_spec,
+                        storage_format=storage_format, split_spec=split_spec)
\ No newline at end of file
@@ -42,6 +42,37 @@ class AttentionLayerTest(tf.test.TestCase):
         #     sess.run(tf.global_variables_initializer())
         #     sess.run(output)
 
+    @given(tensors=attention_tensors(), window_ahead=integers(1, 4), window_backward=integers(0, 3))
+    @settings(max_examples=10, timeout=unlimited)
+    def test_windowed_attention(self, tensors, window_ahead, window_backward):
+        B, _, _, T_encoder, embed_dim, _, encoder_out = tensors
+        keys, values = tf.constant(encoder_out), tf.constant(encoder_out)
+        # small queries keep every weight of the unwindowed softmax from underflowing
+        query = tf.constant(np.random.uniform(-0.1, 0.1, size=(B, 1, embed_dim)).astype(np.float32))
+        last_attended = tf.constant(np.random.randint(0, T_encoder, size=B).astype(np.int32))
+
+        attention_mechanism = ScaledDotProductAttentionMechanism(keys, values, embed_dim,
+                                                                 window_ahead=window_ahead,
+                                                                 window_backward=window_backward,
+                                                                 dropout=0.0, use_key_projection=False,
+                                                                 use_value_projection=False)
+        output, alignment = attention_mechanism(query)
+        windowed_output, windowed_alignment = attention_mechanism(query, last_attended=last_attended)
+
+        width = min(window_ahead + window_backward, T_encoder)
+        for b in range(B):
+            start = int(np.clip(last_attended[b].numpy() - window_backward, 0, T_encoder - width))
+            window = slice(start, start + width)
+            # softmax renormalized over the window
+            expected = alignment[b, 0, window].numpy() / np.sum(alignment[b, 0, window].numpy())
+            self.assertAllClose(expected, windowed_alignment[b, 0, window], atol=1e-5)
+            self.assertAllClose(np.sum(windowed_alignment[b, 0, :].numpy()), 1.0, atol=1e-5)
+
+        # a window that covers the whole memory is the same as attention without a window
+        if width == T_encoder:
+            self.assertAllClose(output, windowed_output, atol=1e-5)
+            self.assertAllClose(alignment, windowed_alignment, atol=1e-5)
+
     @given(tensors=attention_tensors(), kernel_size=integers(2, 10),
            dilation=integers(1, 20), r=integers(1, 1))
     @settings(max_examples=10, timeout=unlimited)
@@ -5,6 +5,7 @@ from hypothesis import given, settings, unlimited, assume
 from hypothesis.strategies import integers, composite
 from hypothesis.extra.numpy import arrays
 from deepvoice3_tensorflow.modules import Conv1dGLU
+from deepvoice3_tensorflow.ops import Conv1dIncrementalState
 
 
 @composite
@@ -41,24 +42,26 @@ class Conv1dGLUTest(tf.test.TestCase):
 
         btc_one_pf = tf.placeholder(dtype=tf.float32, shape=[B, 1, C])
         buffer_size = kernel_size + (kernel_size - 1) * (dilation - 1)
-        input_buffer_pf = tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C])
+        state_pf = Conv1dIncrementalState(buffer=tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C]),
+                                          index=tf.placeholder(dtype=tf.int32, shape=[]))
 
         conv1dGLU_incremental = Conv1dGLU(C, 2 * C, kernel_size,
                                           dropout=0.0, dilation=dilation,
                                           residual=False,
                                           kernel_initializer=kernel_initializer,
                                           is_incremental=True)
-        out_online, next_input_buffer = conv1dGLU_incremental.apply(btc_one_pf, input_buffer=input_buffer_pf)
+        out_online, next_state = conv1dGLU_incremental.apply(btc_one_pf, input_buffer=state_pf)
 
         with self.test_session() as sess:
             sess.run(tf.global_variables_initializer())
             output_conv_online = []
-            input_buffer = np.zeros(shape=[B, buffer_size, C], dtype=np.float32)
+            state = Conv1dIncrementalState(buffer=np.zeros(shape=[B, buffer_size, C], dtype=np.float32), index=0)
 
             for t in range(T):
-                result, input_buffer = sess.run([out_online, next_input_buffer], feed_dict={
+                result, state = sess.run([out_online, next_state], feed_dict={
                     btc_one_pf: btc[:, t, :].reshape(B, -1, C),
-                    input_buffer_pf: input_buffer
+                    state_pf.buffer: state.buffer,
+                    state_pf.index: state.index,
                 })
                 output_conv_online += [result]
 
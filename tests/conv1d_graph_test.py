@@ -2,7 +2,8 @@ import tensorflow as tf
 import numpy as np
 from hypothesis import given, settings, unlimited
 from hypothesis.strategies import integers
-from deepvoice3_tensorflow.modules import Conv1d
+from deepvoice3_tensorflow.modules import Conv1d, NonCausalConv1d
+from deepvoice3_tensorflow.ops import Conv1dIncrementalState
 
 
 def curried_leaky_relu(alpha):
@@ -10,7 +11,7 @@ def curried_leaky_relu(alpha):
 
 class ModuleTest(tf.test.TestCase):
 
-    @given(B=integers(1, 3), T=integers(10, 30), C=integers(1, 4), kernel_size=integers(2, 9), dilation=integers(1, 27))
+    @given(B=integers(1, 3), T=integers(10, 30), C=integers(1, 4), kernel_size=integers(1, 9), dilation=integers(1, 27))
     @settings(max_examples=10, timeout=unlimited)
     def test_conv1d(self, kernel_size, dilation, T, B, C):
         bct_value = np.zeros(shape=[B, C, T], dtype=np.float32) + (
@@ -30,25 +31,55 @@ class ModuleTest(tf.test.TestCase):
         btc_one = tf.placeholder(dtype=tf.float32, shape=[B, 1, C])
         output_conv_online = []
         buffer_size = kernel_size + (kernel_size - 1) * (dilation - 1)
-        input_buffer_pf = tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C])
-        input_buffer = np.zeros(shape=[B, buffer_size, C], dtype=np.float32)
+        state_pf = Conv1dIncrementalState(buffer=tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C]),
+                                          index=tf.placeholder(dtype=tf.int32, shape=[]))
+        state = Conv1dIncrementalState(buffer=np.zeros(shape=[B, buffer_size, C], dtype=np.float32), index=0)
         conv1d_incremental = Conv1d(C, 2 * C, kernel_size=kernel_size,
                                                             dilation=dilation,
                                                             activation=curried_leaky_relu(0.5),
                                                             is_incremental=True,
                                                             is_training=False,
                                                             kernel_initializer=kernel_initializer)
-        out_incremental = conv1d_incremental(btc_one, input_buffer_pf)
+        out_incremental = conv1d_incremental(btc_one, state_pf)
         with self.test_session() as sess:
             sess.run(tf.global_variables_initializer())
             for t in range(T):
-                result, input_buffer = sess.run(out_incremental,
-                                                feed_dict={
-                                                    btc_one: btc_value[:, t, :].reshape(B, -1, C),
-                                                    input_buffer_pf: input_buffer
-                                                })
+                result, state = sess.run(out_incremental,
+                                         feed_dict={
+                                             btc_one: btc_value[:, t, :].reshape(B, -1, C),
+                                             state_pf.buffer: state.buffer,
+                                             state_pf.index: state.index,
+                                         })
                 output_conv_online += [result]
 
         output_conv_online = np.stack(output_conv_online).squeeze(axis=2)
         output_conv_online = output_conv_online.transpose((1, 0, 2))
         self.assertAllEqual(output_causal_conv, output_conv_online)
+
+    @given(T1=integers(1, 20), T2=integers(1, 20), C=integers(1, 4), kernel_size=integers(2, 5),
+           dilation=integers(1, 9))
+    @settings(max_examples=10, timeout=unlimited)
+    def test_segment_conv1d(self, kernel_size, dilation, T1, T2, C):
+        x1 = np.random.normal(size=[1, T1, C]).astype(np.float32)
+        x2 = np.random.normal(size=[1, T2, C]).astype(np.float32)
+        packed = np.concatenate([x1, x2], axis=1)
+        segment_ids = np.array([[1] * T1 + [2] * T2], dtype=np.int32)
+
+        kernel_initializer = tf.constant_initializer(np.arange(0, kernel_size * C * 2 * C) / 10.0)
+        causal = Conv1d(C, 2 * C, kernel_size, dilation, None, is_incremental=False, is_training=False,
+                        kernel_initializer=kernel_initializer)
+        noncausal = NonCausalConv1d(C, 2 * C, kernel_size, dilation, None, kernel_initializer=kernel_initializer)
+        btc = tf.placeholder(dtype=tf.float32, shape=[1, None, C])
+        segments = tf.placeholder(dtype=tf.int32, shape=[1, None])
+        outputs = (causal(btc), causal(btc, segment_ids=segments), noncausal(btc),
+                   noncausal(btc, segment_ids=segments))
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            causal1, _, noncausal1, _ = sess.run(outputs, feed_dict={btc: x1, segments: segment_ids[:, :T1]})
+            causal2, _, noncausal2, _ = sess.run(outputs, feed_dict={btc: x2, segments: segment_ids[:, T1:]})
+            _, causal_packed, _, noncausal_packed = sess.run(outputs, feed_dict={btc: packed, segments: segment_ids})
+
+        # packed segments are convolved as if they were separate sequences
+        self.assertAllClose(np.concatenate([causal1, causal2], axis=1), causal_packed, atol=1e-4)
+        self.assertAllClose(np.concatenate([noncausal1, noncausal2], axis=1), noncausal_packed, atol=1e-4)
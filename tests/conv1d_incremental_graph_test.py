@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 from hypothesis import given, assume, settings, unlimited
 from hypothesis.strategies import integers
-from deepvoice3_tensorflow.ops import causal_conv, Conv1dIncremental
+from deepvoice3_tensorflow.ops import causal_conv, conv1d_incremental_step, Conv1dIncrementalState
 
 
 class Conv1dIncrementalTest(tf.test.TestCase):
@@ -45,22 +45,22 @@ class Conv1dIncrementalTest(tf.test.TestCase):
             print(output_causal_conv)
 
         btc_one = tf.placeholder(dtype=tf.float32, shape=[B, 1, C])
-        filter = tf.Variable(
-            initial_value=np.arange(0, kernel_size * C * 2 * C, dtype=np.float32).reshape(C * 2, C, kernel_size))
-        conv1d_incremental = Conv1dIncremental(filter, C, C * 2, kernel_size=kernel_size, dilation=dilation)
+        # (kernel_size * in_channels, out_channels) with the oldest tap first
+        weight = tf.constant(filter_value.transpose([2, 1, 0]).reshape(kernel_size * C, C * 2))
         buffer_size = kernel_size + (kernel_size - 1) * (dilation - 1)
-        input_buffer_pf = tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C])
-        output_conv, next_input_buffer = conv1d_incremental.apply(btc_one, input_buffer=input_buffer_pf, training=False)
+        state_pf = Conv1dIncrementalState(buffer=tf.placeholder(dtype=tf.float32, shape=[B, buffer_size, C]),
+                                          index=tf.placeholder(dtype=tf.int32, shape=[]))
+        output_conv, next_state = conv1d_incremental_step(btc_one, weight, state_pf, kernel_size, dilation)
 
         with self.test_session() as sess:
-            sess.run(tf.global_variables_initializer())
             output_conv_online = []
-            input_buffer = np.zeros(shape=[B, buffer_size, C], dtype=np.float32)
+            state = Conv1dIncrementalState(buffer=np.zeros(shape=[B, buffer_size, C], dtype=np.float32), index=0)
 
             for t in range(T):
-                result, input_buffer = sess.run([output_conv, next_input_buffer], feed_dict={
+                result, state = sess.run([output_conv, next_state], feed_dict={
                     btc_one: btc_value[:, t, :].reshape(B, -1, C),
-                    input_buffer_pf: input_buffer
+                    state_pf.buffer: state.buffer,
+                    state_pf.index: state.index,
                 })
                 output_conv_online += [result]
 
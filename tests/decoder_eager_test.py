@@ -119,9 +119,8 @@ class DecoderTest(tf.test.TestCase):
         out, done, decoder_state = decoder((keys, values), input=tf.constant(query),
                                            frame_positions=frame_positions, text_positions=text_positions)
 
-        out_online, done_online, decoder_state_online = decoder_online((keys, values),
-                                                                       text_positions=text_positions,
-                                                                       test_inputs=tf.constant(query))
+        out_online, done_online, decoder_state_online, lengths_online = decoder_online(
+            (keys, values), text_positions=text_positions, test_inputs=tf.constant(query))
         alignments = [ds.alignments for ds in decoder_state]
 
         # (T_query, batch_size, 1, T_memory) -> (batch_size, T_query, T_memory)
@@ -138,6 +137,7 @@ class DecoderTest(tf.test.TestCase):
         print("-" * 100)
         self.assertAllClose(out, out_online)
         self.assertAllClose(alignments, alignments_online)
+        self.assertAllEqual(np.full([batch_size], T_query // r), lengths_online)
 
     @given(args=all_args(), num_preattention=integers(1, 3), preattention_kernel_size=integers(1, 9),
            num_mha=integers(1, 4))
@@ -167,8 +167,8 @@ class DecoderTest(tf.test.TestCase):
         text_positions = tf.zeros(shape=(batch_size, T_memory), dtype=tf.int32) + tf.range(0, T_memory, dtype=tf.int32)
 
         keys, values = tf.constant(memory), tf.constant(memory)
-        out_online, done_online, decoder_state_online = decoder_online((keys, values),
-                                                                       text_positions=text_positions)
+        out_online, done_online, decoder_state_online, lengths_online = decoder_online((keys, values),
+                                                                                       text_positions=text_positions)
 
         # with self.test_session() as sess:
         #     sess.run(tf.global_variables_initializer())
@@ -177,6 +177,67 @@ class DecoderTest(tf.test.TestCase):
         print(out_online)
         print("-" * 100)
 
+    @given(args=all_args(), num_preattention=integers(1, 3), num_mha=integers(1, 4))
+    @settings(max_examples=10, timeout=unlimited, suppress_health_check=[HealthCheck.too_slow])
+    def test_decoder_early_termination(self, args, num_preattention, num_mha):
+        query, mha_arg, memory, in_dim, r = args
+        batch_size = query.shape[0]
+        max_positions = 30
+        max_decoder_steps = 10
+        embed_dim = memory.shape[2]
+        T_memory = memory.shape[1]
+        assume(T_memory < max_positions)
+
+        def one_tenth_initializer(length):
+            half = length // 2
+            return np.stack([0.1 * -1 * np.ones(half), 0.1 * np.ones(half)]).reshape(length, order='F')
+
+        preattention_args = [DecoderPreNetArgs(mha_arg.out_channels) for _ in range(num_preattention)]
+        _attention_weight = one_tenth_initializer(mha_arg.out_channels * embed_dim)
+        # done probabilities are close to 0.5, so utterances finish at different steps
+        decoder_online = Decoder(embed_dim, in_dim, r, max_positions, preattention=preattention_args,
+                                 mh_attentions=(mha_arg,) * num_mha,
+                                 dropout=0.0, max_decoder_steps=max_decoder_steps, min_decoder_steps=1,
+                                 is_incremental=True,
+                                 prenet_weight_initializer=tf.ones_initializer(),
+                                 attention_key_projection_weight_initializer=tf.constant_initializer(
+                                     one_tenth_initializer(embed_dim * embed_dim)),
+                                 attention_value_projection_weight_initializer=tf.constant_initializer(
+                                     one_tenth_initializer(embed_dim * embed_dim)),
+                                 attention_kernel_initializer=tf.constant_initializer(one_tenth_initializer(
+                                     mha_arg.kernel_size * mha_arg.out_channels * mha_arg.out_channels * 2)),
+                                 attention_query_projection_weight_initializer=tf.constant_initializer(
+                                     _attention_weight),
+                                 attention_out_projection_weight_initializer=tf.constant_initializer(
+                                     _attention_weight),
+                                 last_conv_kernel_initializer=tf.constant_initializer(
+                                     one_tenth_initializer(mha_arg.out_channels * in_dim * r)),
+                                 done_weight_initializer=tf.ones_initializer(),
+                                 done_bias_initializer=tf.constant_initializer(-0.5 * in_dim * r))
+
+        text_positions = tf.zeros(shape=(batch_size, T_memory), dtype=tf.int32) + tf.range(0, T_memory, dtype=tf.int32)
+        keys, values = tf.constant(memory), tf.constant(memory)
+
+        out, done, decoder_state, lengths = decoder_online((keys, values), text_positions=text_positions)
+        alignments = [s.alignment_history.stack() for s in decoder_state]
+
+        decoder_online.compact_finished = True
+        out_compact, done_compact, decoder_state_compact, lengths_compact = decoder_online(
+            (keys, values), text_positions=text_positions)
+        alignments_compact = [s.alignment_history.stack() for s in decoder_state_compact]
+
+        self.assertAllEqual(lengths, lengths_compact)
+        self.assertTrue(np.all(lengths <= max_decoder_steps))
+        self.assertAllClose(out, out_compact)
+        self.assertAllClose(done, done_compact)
+        for b, length in enumerate(lengths.numpy()):
+            # finished utterances are not attended in compact mode
+            for a, a_compact in zip(alignments, alignments_compact):
+                self.assertAllClose(a[:length, b], a_compact[:length, b])
+            self.assertAllEqual(np.zeros_like(out[b, length:]), out[b, length:])
+            if length < max_decoder_steps:
+                self.assertGreater(done[b], 0.5)
+
 
 if __name__ == '__main__':
     tf.enable_eager_execution()
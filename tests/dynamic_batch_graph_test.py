@@ -0,0 +1,109 @@
+import tensorflow as tf
+import numpy as np
+from deepvoice3_tensorflow.deepvoice3 import Encoder, Decoder, MultiHopAttentionArgs, DecoderPreNetArgs
+
+
+class DynamicBatchTest(tf.test.TestCase):
+    n_vocab = 20
+    embed_dim = 8
+    channels = 6
+    in_dim = 4
+    r = 2
+    T_source = 7
+    T_query = 5
+    max_decoder_steps = 8
+    # rows of different source lengths, so that the memory mask differs between rows
+    source_lengths = [7, 4, 6, 3, 5, 7]
+    max_batch_size = len(source_lengths)
+
+    def setUp(self):
+        np.random.seed(1234)
+        tf.set_random_seed(1234)
+        B = self.max_batch_size
+        valid = np.arange(self.T_source) < np.array(self.source_lengths)[:, None]
+        self.source = np.random.randint(1, self.n_vocab, size=[B, self.T_source]).astype(np.int32) * valid
+        self.text_positions = np.tile(np.arange(1, self.T_source + 1, dtype=np.int32), [B, 1]) * valid
+        self.mask = np.where(valid, 0.0, -1e9).astype(np.float32)
+        self.mel = np.random.uniform(size=[B, self.T_query * self.r, self.in_dim]).astype(np.float32)
+        self.frame_positions = np.tile(np.arange(1, self.T_query + 1, dtype=np.int32), [B, 1])
+
+    def build(self, is_incremental, **kwargs):
+        # the batch dimension of every input is unknown
+        self.source_pf = tf.placeholder(tf.int32, shape=[None, self.T_source])
+        self.text_positions_pf = tf.placeholder(tf.int32, shape=[None, self.T_source])
+        self.mask_pf = tf.placeholder(tf.float32, shape=[None, self.T_source])
+        self.mel_pf = tf.placeholder(tf.float32, shape=[None, self.T_query * self.r, self.in_dim])
+        self.frame_positions_pf = tf.placeholder(tf.int32, shape=[None, self.T_query])
+        encoder = Encoder(self.n_vocab, self.embed_dim, convolutions=((self.channels, 3, 1), (self.channels, 3, 2)),
+                          dropout=0.0)
+        decoder = Decoder(self.embed_dim, self.in_dim, self.r, max_positions=30,
+                          preattention=(DecoderPreNetArgs(self.channels),),
+                          mh_attentions=(MultiHopAttentionArgs(self.channels, 3, 1, 0.0),) * 2,
+                          dropout=0.0, use_memory_mask=True, max_decoder_steps=self.max_decoder_steps,
+                          min_decoder_steps=1, is_incremental=is_incremental,
+                          # done probabilities are close to 0.5, so utterances finish at different steps
+                          done_weight_initializer=tf.ones_initializer(),
+                          done_bias_initializer=tf.constant_initializer(-0.5 * self.in_dim * self.r), **kwargs)
+        keys, values = encoder(self.source_pf, text_positions=self.text_positions_pf)
+        if is_incremental:
+            outputs, done, _, lengths = decoder((keys, values), text_positions=self.text_positions_pf,
+                                                memory_mask=self.mask_pf)
+            return outputs, done, lengths
+        outputs, done, _ = decoder((keys, values), input=self.mel_pf, frame_positions=self.frame_positions_pf,
+                                   text_positions=self.text_positions_pf, memory_mask=self.mask_pf)
+        return outputs, done
+
+    def feed(self, rows):
+        return {self.source_pf: self.source[rows], self.text_positions_pf: self.text_positions[rows],
+                self.mask_pf: self.mask[rows], self.mel_pf: self.mel[rows],
+                self.frame_positions_pf: self.frame_positions[rows]}
+
+    def run_batch_sizes(self, fetches):
+        '''
+        :return: values of fetches for each row run alone, and for each batch size
+        '''
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            singles = [sess.run(fetches, feed_dict=self.feed([b])) for b in range(self.max_batch_size)]
+            batches = [sess.run(fetches, feed_dict=self.feed(list(range(batch_size)))) for batch_size in
+                       range(1, self.max_batch_size + 1)]
+            return singles, batches
+
+    def assert_batch_sizes(self, fetches):
+        singles, batches = self.run_batch_sizes(fetches)
+        for batch_size, batch in enumerate(batches, start=1):
+            for b in range(batch_size):
+                for batch_value, single_value in zip(batch, singles[b]):
+                    self.assertAllClose(single_value[0], batch_value[b], atol=1e-5)
+
+    def assert_incremental_batch_sizes(self, fetches):
+        singles, batches = self.run_batch_sizes(fetches)
+        single_lengths = [lengths[0] for _, _, lengths in singles]
+        self.assertGreater(len(set(single_lengths)), 1, "rows must finish at different steps")
+        for batch_size, (outputs, done, lengths) in enumerate(batches, start=1):
+            self.assertAllEqual(single_lengths[:batch_size], lengths)
+            self.assertEqual(max(single_lengths[:batch_size]), outputs.shape[1])
+            for b, (single_outputs, single_done, single_length) in enumerate(singles[:batch_size]):
+                self.assertAllClose(single_outputs[0], outputs[b, :single_length[0]], atol=1e-5)
+                # outputs after the last step of an utterance are zero
+                self.assertAllEqual(np.zeros_like(outputs[b, single_length[0]:]), outputs[b, single_length[0]:])
+                self.assertAllClose(single_done[0], done[b], atol=1e-5)
+
+    def test_parallel(self):
+        self.assert_batch_sizes(self.build(is_incremental=False))
+
+    def test_incremental(self):
+        outputs, done, lengths = self.build(is_incremental=True)
+        self.assertIsNone(outputs.shape[0].value)
+        self.assert_incremental_batch_sizes((outputs, done, lengths))
+
+    def test_incremental_compact(self):
+        self.assert_incremental_batch_sizes(self.build(is_incremental=True, compact_finished=True))
+
+    def test_incremental_compact_window(self):
+        self.assert_incremental_batch_sizes(
+            self.build(is_incremental=True, compact_finished=True, window_attention=True))
+
+
+if __name__ == '__main__':
+    tf.test.main()
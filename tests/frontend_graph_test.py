@@ -1,7 +1,15 @@
 import tensorflow as tf
 import numpy as np
 import os
-from deepvoice3_tensorflow.frontend import Frontend, _lcm
+import tempfile
+from deepvoice3_tensorflow.frontend import Frontend, _lcm, TRAIN_SEQ2SEQ, TRAIN_SEQ2SEQ_AND_POSTNET, read_tfrecords
+from deepvoice3_tensorflow.frontend.bucketing import compute_bucket_boundaries, bucket_ids
+from deepvoice3_tensorflow.frontend.materialize import MaterializedFrontend, materialize_targets, is_materialized
+from deepvoice3_tensorflow.frontend.cache import prepared_cache_filename
+from deepvoice3_tensorflow.frontend.pipeline import train_stages, eval_stages, eval_frontend, apply_stages
+from data.packed_store import PackedFeatureWriter, PackedFeatureStore
+from data.tfrecord_utils import read_preprocessed_target_data, preprocessed_mel_example, preprocessed_spec_example, \
+    write_tfrecord, ShardedTFRecordWriter, read_shard_index, shard_files, shard_index_filename
 
 
 class FrontendTest(tf.test.TestCase):
@@ -184,4 +192,359 @@ class FrontendTest(tf.test.TestCase):
                                     t.binary_loss_mask[0][target_length1 // r // hparams.downsample_step:])
                 self.assertAllEqual(np.zeros(
                     max_target_length // r // hparams.downsample_step - target_length2 // r // hparams.downsample_step),
-                                    t.binary_loss_mask[1][target_length2 // r // hparams.downsample_step:])
\ No newline at end of file
+                                    t.binary_loss_mask[1][target_length2 // r // hparams.downsample_step:])
+
+    def test_column_split(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        targets = [next(read_preprocessed_target_data(f)) for f in target_files]
+
+        out_dir = tempfile.mkdtemp()
+        mel_files = [os.path.join(out_dir, "jsut-target-%05d.tfrecords" % t.id) for t in targets]
+        spec_files = [os.path.join(out_dir, "jsut-spec-%05d.tfrecords" % t.id) for t in targets]
+        for t, mel_file, spec_file in zip(targets, mel_files, spec_files):
+            write_tfrecord(preprocessed_mel_example(t.id, t.mel), mel_file)
+            write_tfrecord(preprocessed_spec_example(t.id, t.spec), spec_file)
+
+        for train_mode in [TRAIN_SEQ2SEQ, TRAIN_SEQ2SEQ_AND_POSTNET]:
+            hparams = tf.contrib.training.HParams(
+                num_mels=80,
+                fft_size=1024,
+                downsample_step=4,
+                outputs_per_step=1,
+                batch_size=2,
+                train_mode=train_mode,
+            )
+            for files in [target_files, mel_files]:
+                frontend = Frontend.from_tfrecord_files(source_files, files, hparams, spec_files)
+                decoded = frontend._decode_target()
+                with self.test_session() as sess:
+                    next_element = decoded.make_one_shot_iterator().get_next()
+                    for target in targets:
+                        t = sess.run(next_element)
+                        self.assertEqual(target.id, t.id)
+                        self.assertAllEqual(target.mel, t.mel)
+                        if train_mode == TRAIN_SEQ2SEQ:
+                            self.assertEqual((target.target_length, 0), t.spec.shape)
+                        else:
+                            self.assertAllEqual(target.spec, t.spec)
+
+    def test_materialized(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=3,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+        )
+
+        cache_dir = tempfile.mkdtemp()
+        # an interrupted run leaves an index of its finished shards
+        with ShardedTFRecordWriter(cache_dir, "materialized-target", 3) as writer:
+            writer.write(1, b"partial")
+        self.assertFalse(is_materialized(cache_dir))
+        materialize_targets(Frontend.from_tfrecord_files(source_files, target_files, hparams), cache_dir,
+                            shard_size=3)
+        self.assertTrue(is_materialized(cache_dir))
+        self.assertEqual(list(range(1, 11)), sorted(
+            e.id for e in read_shard_index(os.path.join(cache_dir, shard_index_filename("materialized-target")))))
+
+        def batches(frontend):
+            return frontend.prepare().zip_source_and_target().group_by_batch().add_memory_mask(
+            ).add_frame_positions().add_target_mask().downsample_mel().dataset.make_one_shot_iterator().get_next()
+
+        expected = batches(Frontend.from_tfrecord_files(source_files, target_files, hparams))
+        actual = batches(MaterializedFrontend.from_cache(source_files, cache_dir, hparams))
+        with self.test_session() as sess:
+            for _ in range(5):
+                (_, e), (_, a) = sess.run([expected, actual])
+                self.assertAllEqual(e.id, a.id)
+                self.assertAllEqual(e.mel, a.mel)
+                self.assertAllEqual(e.spec, a.spec)
+                self.assertAllEqual(e.done, a.done)
+                self.assertAllEqual(e.frame_positions, a.frame_positions)
+                self.assertAllEqual(e.spec_loss_mask, a.spec_loss_mask)
+                self.assertAllEqual(e.binary_loss_mask, a.binary_loss_mask)
+
+    def test_parallel_reads_keep_order(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        records = [next(tf.python_io.tf_record_iterator(f)) for f in source_files]
+        out_dir = tempfile.mkdtemp()
+        with ShardedTFRecordWriter(out_dir, "jsut-source", 3) as writer:
+            for i, record in enumerate(records):
+                writer.write(i + 1, record)
+        shards = shard_files(read_shard_index(os.path.join(out_dir, shard_index_filename("jsut-source"))), out_dir)
+
+        for files in [source_files, shards]:
+            hparams = tf.contrib.training.HParams(input_num_parallel_reads=3)
+            next_element = read_tfrecords(files, hparams).make_one_shot_iterator().get_next()
+            with self.test_session() as sess:
+                self.assertEqual(records, [sess.run(next_element) for _ in records])
+
+    def test_fused_batch(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=3,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+        )
+
+        def batched():
+            frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams)
+            return frontend.prepare().zip_source_and_target().group_by_batch()
+
+        # swap_probability of 1.0 always swaps like swap_source
+        for swap_probability, chained in [(None, batched()), (1.0, batched().swap_source())]:
+            chained = chained.add_memory_mask().add_frame_positions().add_target_mask().downsample_mel()
+            fused = batched().finalize_batch(swap_probability)
+            expected = chained.dataset.make_one_shot_iterator().get_next()
+            actual = fused.dataset.make_one_shot_iterator().get_next()
+            with self.test_session() as sess:
+                for _ in range(5):
+                    (es, et), (a_s, at) = sess.run([expected, actual])
+                    for name in es._fields:
+                        self.assertAllEqual(getattr(es, name), getattr(a_s, name))
+                    for name in et._fields:
+                        self.assertAllEqual(getattr(et, name), getattr(at, name))
+
+    def test_bucketing(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        r = 3
+        target_lengths = np.array([next(read_preprocessed_target_data(f)).target_length for f in target_files])
+        source_lengths = []
+        for f in source_files:
+            example = tf.train.Example()
+            example.ParseFromString(next(tf.python_io.tf_record_iterator(f)))
+            source_lengths.append(max(example.features.feature['source_length'].int64_list.value))
+        boundaries = compute_bucket_boundaries(target_lengths, source_lengths, 3, 2, target_offset=r)
+
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=r,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+        )
+
+        frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams)
+        batched = frontend.prepare().zip_source_and_target().repeat(2).group_by_batch(boundaries).dataset
+        with self.test_session() as sess:
+            next_element = batched.make_one_shot_iterator().get_next()
+            for _ in range(5):
+                s, t = sess.run(next_element)
+                ids = bucket_ids(t.target_length, np.maximum(s.source_length, s.source_length2), boundaries)
+                self.assertEqual(1, len(set(ids)))
+
+    def test_budget_batching(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        r = 3
+        target_lengths = np.array([next(read_preprocessed_target_data(f)).target_length for f in target_files])
+        max_target_length = int(np.percentile(target_lengths, 80)) + r
+
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=r,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+            batch_max_frames=max_target_length * 3,
+            batch_max_source_tokens=1000,
+            max_target_length=max_target_length,
+            max_source_length=200,
+        )
+
+        frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams)
+        batched = frontend.prepare().zip_source_and_target().group_by_budget().finalize_batch().dataset
+        with self.test_session() as sess:
+            next_element = batched.make_one_shot_iterator().get_next()
+            num_utterances = 0
+            while True:
+                try:
+                    s, t = sess.run(next_element)
+                except tf.errors.OutOfRangeError:
+                    break
+                batch_size = len(t.id)
+                num_utterances += batch_size
+                self.assertTrue(np.all(t.target_length <= max_target_length))
+                # padded frames count, and mel is downsampled
+                self.assertLessEqual(batch_size * t.mel.shape[1] * hparams.downsample_step, hparams.batch_max_frames)
+                self.assertEqual(batch_size, len(t.frame_positions))
+            # utterances over the memory cap are dropped
+            self.assertEqual(np.sum(target_lengths + r <= max_target_length), num_utterances)
+
+    def test_packing(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        r = 3
+        target_lengths = np.array([next(read_preprocessed_target_data(f)).target_length for f in target_files])
+
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=r,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+            pack_max_frames=int(target_lengths.max()) * 3,
+            pack_max_source_tokens=1000,
+            max_target_length=int(target_lengths.max()) + r,
+            max_source_length=1000,
+        )
+
+        frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams)
+        batched = frontend.prepare().zip_source_and_target().pack().batch().dataset
+        with self.test_session() as sess:
+            next_element = batched.make_one_shot_iterator().get_next()
+            num_segments = 0
+            while True:
+                try:
+                    s, t = sess.run(next_element)
+                except tf.errors.OutOfRangeError:
+                    break
+                for i in range(len(t.id)):
+                    steps = t.segment_ids[i] > 0
+                    self.assertEqual(len(t.mel[i]), len(t.segment_ids[i]) * r)
+                    frame_segment_ids = np.repeat(t.segment_ids[i], r)
+                    for segment in np.unique(t.segment_ids[i][steps]):
+                        num_segments += 1
+                        # positions start over at every utterance
+                        self.assertEqual(1, t.frame_positions[i][t.segment_ids[i] == segment][0])
+                        self.assertEqual(1, s.text_positions[i][s.segment_ids[i] == segment][0])
+                        # the first frames of an utterance are not predicted from the previous one
+                        self.assertAllEqual(np.zeros(r), t.spec_loss_mask[i][frame_segment_ids == segment][:r])
+                        # decoder steps attend only to their own utterance
+                        mask = s.mask[i][t.segment_ids[i] == segment]
+                        self.assertAllEqual(np.zeros_like(mask[:, s.segment_ids[i] == segment]),
+                                            mask[:, s.segment_ids[i] == segment])
+                        self.assertTrue(np.all(mask[:, s.segment_ids[i] != segment] < 0))
+            self.assertEqual(len(target_files), num_segments)
+
+    def test_cache(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        hparams = tf.contrib.training.HParams(
+            num_mels=80, fmin=125, fmax=7600, fft_size=1024, hop_size=256, sample_rate=22050, preemphasis=0.97,
+            min_level_db=-100, ref_level_db=20, rescaling=False, rescaling_max=0.999,
+            allow_clipping_in_normalization=False, downsample_step=4, outputs_per_step=3,
+            train_mode=TRAIN_SEQ2SEQ_AND_POSTNET,
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            filename = prepared_cache_filename(cache_dir, hparams, source_files + target_files)
+            self.assertEqual(filename, prepared_cache_filename(cache_dir, hparams, source_files + target_files))
+            # inputs and hyper parameters invalidate the cache
+            self.assertNotEqual(filename, prepared_cache_filename(cache_dir, hparams, source_files))
+            hparams.train_mode = TRAIN_SEQ2SEQ
+            self.assertNotEqual(filename, prepared_cache_filename(cache_dir, hparams, source_files + target_files))
+            hparams.train_mode = TRAIN_SEQ2SEQ_AND_POSTNET
+
+            frontend = Frontend.from_tfrecord_files(source_files, target_files, hparams)
+            cached = frontend.prepare().zip_source_and_target().cache(filename).repeat(2).dataset
+            with self.test_session() as sess:
+                next_element = cached.make_one_shot_iterator().get_next()
+                first = [sess.run(next_element) for _ in range(10)]
+                second = [sess.run(next_element) for _ in range(10)]
+            for (s1, t1), (s2, t2) in zip(first, second):
+                self.assertEqual(s1.id, s2.id)
+                self.assertAllEqual(t1.mel, t2.mel)
+                self.assertAllEqual(t1.done, t2.done)
+            self.assertTrue(any(name.startswith(os.path.basename(filename)) for name in os.listdir(cache_dir)))
+
+    def test_train_stages(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=3,
+            batch_size=2,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+            batch_mode="fixed",
+            replace_pronunciation_prob=0.5,
+        )
+        stages = train_stages(hparams)
+        self.assertEqual(["prepare", "zip", "repeat", "shuffle", "group_by_batch", "finalize_batch", "prefetch"],
+                         [name for name, _ in stages])
+        batched = apply_stages(Frontend.from_tfrecord_files(source_files, target_files, hparams), stages)
+        with self.test_session() as sess:
+            s, t = sess.run(batched.make_one_shot_iterator().get_next())
+            self.assertEqual(2, len(t.id))
+            self.assertEqual(t.mel.shape[1], t.spec_loss_mask.shape[1])
+
+    def test_eval_stages(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        hparams = tf.contrib.training.HParams(
+            num_mels=80,
+            fft_size=1024,
+            downsample_step=4,
+            outputs_per_step=3,
+            batch_size=4,
+            approx_min_target_length=200,
+            batch_bucket_width=50,
+            batch_num_buckets=3,
+            swap_source=False,
+            train_mode=TRAIN_SEQ2SEQ,
+        )
+        out_dir = tempfile.mkdtemp()
+        with PackedFeatureWriter(out_dir, "jsut-packed-target") as writer:
+            for f in target_files:
+                t = next(read_preprocessed_target_data(f))
+                writer.write(t.id, (None, t.mel))
+        store = PackedFeatureStore(out_dir, "jsut-packed-target")
+
+        def evaluated(frontend):
+            batched = apply_stages(frontend, eval_stages(hparams))
+            with self.test_session() as sess:
+                next_element = batched.make_one_shot_iterator().get_next()
+                targets = []
+                while True:
+                    try:
+                        _, t = sess.run(next_element)
+                    except tf.errors.OutOfRangeError:
+                        return targets
+                    targets += zip(t.id, t.mel)
+
+        expected = evaluated(eval_frontend(source_files, target_files, hparams))
+        # every utterance is evaluated, including the last batch of 2 utterances
+        self.assertEqual(list(range(1, 11)), sorted(id for id, _ in expected))
+        # targets of a packed store are read like in training
+        actual = evaluated(eval_frontend(source_files, [], hparams, target_store=store))
+        self.assertEqual([id for id, _ in expected], [id for id, _ in actual])
+        for (_, e), (_, a) in zip(expected, actual):
+            self.assertAllEqual(e, a)
@@ -0,0 +1,54 @@
+import tensorflow as tf
+import json
+import os
+import tempfile
+from deepvoice3_tensorflow.hooks import StepTimeProfiler, AlignmentSaver
+
+
+class HooksTest(tf.test.TestCase):
+
+    def test_step_time_profiler(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            with tf.Graph().as_default():
+                global_step = tf.train.get_or_create_global_step()
+                dataset = tf.data.Dataset.range(100).map(lambda x: tf.ones([2, x + 1, 80])).prefetch(1)
+                mel = dataset.make_one_shot_iterator().get_next()
+                train_op = tf.assign_add(global_step, 1)
+                writer = tf.summary.FileWriter(log_dir)
+                profiler = StepTimeProfiler(global_step, tf.shape(mel)[0], tf.size(mel) // 80,
+                                            tf.size(mel) // 80 * 2, profile_steps=2, trace_steps=5,
+                                            writer=writer)
+                with tf.train.MonitoredSession(hooks=[profiler]) as sess:
+                    for _ in range(10):
+                        sess.run(train_op)
+                writer.close()
+
+            with open(os.path.join(log_dir, "step_times.jsonl")) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(10, len(records))
+            for r in records:
+                self.assertAlmostEqual(0.5, r["padded_frame_ratio"])
+            self.assertTrue(any("input_wait" in r for r in records))
+            self.assertTrue(any(f.startswith("timeline_step") for f in os.listdir(log_dir)))
+
+    def test_alignment_saver(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            with tf.Graph().as_default():
+                global_step = tf.train.get_or_create_global_step()
+                # exactly as many batches as steps, so that an extra run of the iterator fails
+                ids = tf.data.Dataset.range(20).batch(2).make_one_shot_iterator().get_next()
+                mel = tf.ones([2, 5, 80]) * tf.cast(tf.reshape(ids, [2, 1, 1]), tf.float32)
+                alignments = [tf.ones([2, 5, 7]), tf.zeros([2, 5, 7])]
+                train_op = tf.group(tf.assign_add(global_step, 1), mel)
+                writer = tf.summary.FileWriter(log_dir)
+                saver = AlignmentSaver(alignments, global_step, mel, mel, ids, tf.as_string(ids), save_steps=3,
+                                       tag_prefix="alignment_layer", mode=tf.estimator.ModeKeys.TRAIN, writer=writer,
+                                       queue_size=1)
+                with tf.train.MonitoredSession(hooks=[saver]) as sess:
+                    for _ in range(10):
+                        sess.run(train_op)
+                writer.close()
+
+            results = [f for f in os.listdir(log_dir) if f.endswith(".tfrecord")]
+            self.assertGreaterEqual(len(results), 3)
+            self.assertLessEqual(len(results), 4)
@@ -32,6 +32,12 @@ class ModelTest(tf.test.TestCase):
             key_projection=False,
             value_projection=False,
             use_memory_mask=True,
+            window_attention=False,
+            window_ahead=3,
+            window_backward=1,
+            window_teacher_forcing=False,
+            compact_finished=False,
+            fold_weight_normalization=False,
 
             batch_size=2,
             approx_min_target_length=200,
@@ -42,6 +48,9 @@ class ModelTest(tf.test.TestCase):
             adam_beta2=0.9,
             adam_eps=1e-6,
             alignment_save_steps=2,
+            profile_steps=2,
+            trace_steps=0,
+            result_log=False,
         )
 
         def train_input_fn():
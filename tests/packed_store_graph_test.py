@@ -0,0 +1,76 @@
+import tensorflow as tf
+import numpy as np
+import os
+import tempfile
+from unittest import mock
+from data.packed_store import PackedFeatureWriter, PackedFeatureStore
+from data.tfrecord_utils import parse_preprocessed_target_data, decode_preprocessed_target_data
+
+
+class PackedStoreTest(tf.test.TestCase):
+
+    def test_packed_store(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        target_files = [os.path.join(data_dir, "jsut-target-%05d.tfrecords" % i) for i in range(1, 11)]
+        decoded = tf.data.TFRecordDataset(target_files).map(
+            lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d)))
+
+        with self.test_session() as sess:
+            next_decoded = decoded.make_one_shot_iterator().get_next()
+            targets = [sess.run(next_decoded) for _ in target_files]
+
+        out_dir = tempfile.mkdtemp()
+        with PackedFeatureWriter(out_dir, "jsut-packed-target", with_spec=True) as writer:
+            for t in targets:
+                writer.write(t.id, (t.spec, t.mel))
+
+        store = PackedFeatureStore(out_dir, "jsut-packed-target")
+        self.assertEqual(len(targets), len(store))
+        for t in targets:
+            self.assertAllEqual(t.mel, store.mel(t.id))
+            self.assertAllEqual(t.spec, store.spec(t.id))
+
+        with self.test_session() as sess:
+            next_packed = store.dataset().make_one_shot_iterator().get_next()
+            for t in targets:
+                p = sess.run(next_packed)
+                self.assertEqual(t.id, p.id)
+                self.assertEqual(t.target_length, p.target_length)
+                self.assertAllEqual(t.mel, p.mel)
+                self.assertAllEqual(t.spec, p.spec)
+
+    def test_interrupted_close(self):
+        out_dir = tempfile.mkdtemp()
+        first = [np.full((i + 1, 4), i, dtype=np.float32) for i in range(3)]
+        second = [np.full((i + 2, 4), i + 10, dtype=np.float32) for i in range(3)]
+        with PackedFeatureWriter(out_dir, "packed") as writer:
+            for id, mel in enumerate(first):
+                writer.write(id, (None, mel))
+
+        # the data file of the new store is replaced, and then the process dies
+        replace = os.replace
+        replaced = []
+
+        def replace_once(src, dst):
+            if replaced:
+                raise KeyboardInterrupt()
+            replaced.append(dst)
+            replace(src, dst)
+
+        writer = PackedFeatureWriter(out_dir, "packed")
+        for id, mel in enumerate(second):
+            writer.write(id, (None, mel))
+        with mock.patch("os.replace", replace_once):
+            with self.assertRaises(KeyboardInterrupt):
+                writer.close()
+
+        # opening the store completes the close, so data, index and header match
+        self.assertTrue(PackedFeatureStore.exists(out_dir, "packed"))
+        store = PackedFeatureStore(out_dir, "packed")
+        for id, mel in enumerate(second):
+            self.assertAllEqual(mel, store.mel(id))
+        self.assertFalse(any(name.endswith(".tmp") for name in os.listdir(out_dir)))
+
+
+if __name__ == '__main__':
+    tf.test.main()
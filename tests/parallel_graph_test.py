@@ -0,0 +1,40 @@
+import tensorflow as tf
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from data.parallel import imap, imap_unordered
+
+
+class ParallelTest(tf.test.TestCase):
+
+    def test_imap_bounds_reorder_buffer(self):
+        max_in_flight = 4
+        lock = threading.Lock()
+        counts = {"started": 0, "yielded": 0, "max_outstanding": 0}
+
+        def slow_first(x):
+            with lock:
+                counts["started"] += 1
+                counts["max_outstanding"] = max(counts["max_outstanding"], counts["started"] - counts["yielded"])
+            # every later item completes while the first one is still running
+            time.sleep(0.5 if x == 0 else 0.001)
+            return x * 2
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for (x,), y in imap(executor, slow_first, [(x,) for x in range(40)], max_in_flight):
+                with lock:
+                    counts["yielded"] += 1
+                results.append((x, y))
+
+        self.assertEqual([(x, x * 2) for x in range(40)], results)
+        self.assertLessEqual(counts["max_outstanding"], max_in_flight)
+
+    def test_imap_unordered(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(imap_unordered(executor, lambda x: x * 2, [(x,) for x in range(20)], 3, chunk_size=2))
+        self.assertEqual([(x, x * 2) for x in range(20)], sorted((x, y) for (x,), y in results))
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,69 @@
+import tensorflow as tf
+import numpy as np
+import os
+import tempfile
+from deepvoice3_tensorflow.result_log import ResultLogWriter, ResultLog
+
+
+class ResultLogTest(tf.test.TestCase):
+
+    def test_result_log(self):
+        random = np.random.RandomState(0)
+        alignments = [random.uniform(size=(2, 30, 12)).astype(np.float32) for _ in range(3)]
+        mel = random.uniform(size=(2, 30, 80)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as log_dir:
+            with ResultLogWriter(log_dir, "train_results") as writer:
+                for step in range(3):
+                    writer.write(step, [1, 2], [b"a", b"b"], mel, mel, alignments)
+            log = ResultLog.from_index_filename(os.path.join(log_dir, "train_results-index.jsonl"))
+            self.assertEqual(6, len(log))
+            entries = log.entries(min_step=1, ids={2})
+            self.assertEqual([1, 2], [e["step"] for e in entries])
+            result = log.read(entries[0])
+            self.assertEqual("b", result.text)
+            self.assertAllClose(mel[1], result.predicted_mel, atol=1e-3)
+            for expected, actual in zip(alignments, result.alignments):
+                self.assertAllClose(expected[1].T, actual, atol=1e-3)
+
+    def test_top_k_and_downsampling(self):
+        random = np.random.RandomState(0)
+        alignment = random.uniform(size=(1, 30, 12)).astype(np.float32)
+        mel = random.uniform(size=(1, 30, 80)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as log_dir:
+            with ResultLogWriter(log_dir, "train_results", top_k=4, mel_downsample=3) as writer:
+                writer.write(0, [1], [b"a"], mel, mel, [alignment])
+            result = next(iter(ResultLog(log_dir, "train_results")))
+            self.assertAllClose(mel[0].reshape(10, 3, 80).mean(axis=1), result.ground_truth_mel, atol=1e-3)
+            # the 4 largest weights of each decoder step are kept and the others are zero
+            self.assertAllClose(np.sort(alignment[0], axis=1)[:, -4:], np.sort(result.alignments[0].T, axis=1)[:, -4:],
+                                atol=1e-3)
+            self.assertAllEqual(np.full(30, 8), np.sum(result.alignments[0].T == 0, axis=1))
+
+    def test_rolling(self):
+        alignment = np.ones((1, 30, 12), dtype=np.float32)
+        mel = np.ones((1, 30, 80), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as log_dir:
+            with ResultLogWriter(log_dir, "train_results", max_segment_bytes=1, max_segments=2) as writer:
+                for step in range(5):
+                    writer.write(step, [1], [b"a"], mel, mel, [alignment])
+            log = ResultLog(log_dir, "train_results")
+            # every write fills a segment and the last two segments are kept
+            self.assertEqual([3, 4], [e["step"] for e in log.entries()])
+            self.assertEqual(2, len([f for f in os.listdir(log_dir) if f.endswith(".bin")]))
+            self.assertEqual(1.0, log.read(log.entries()[0]).alignments[0][0, 0])
+
+    def test_reopen(self):
+        alignment = np.ones((1, 30, 12), dtype=np.float32)
+        mel = np.ones((1, 30, 80), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as log_dir:
+            with ResultLogWriter(log_dir, "eval_results"):
+                pass
+            # a writer that writes nothing leaves no segment
+            self.assertEqual([], [f for f in os.listdir(log_dir) if f.endswith(".bin")])
+            for step in range(2):
+                with ResultLogWriter(log_dir, "eval_results") as writer:
+                    writer.write(step, [1], [b"a"], mel, mel, [alignment])
+            # every run appends to a new segment
+            log = ResultLog(log_dir, "eval_results")
+            self.assertEqual([0, 1], [e["segment"] for e in log.entries()])
+            self.assertEqual(2, len([f for f in os.listdir(log_dir) if f.endswith(".bin")]))
@@ -0,0 +1,75 @@
+import tensorflow as tf
+import os
+import tempfile
+from hypothesis import given, settings, unlimited
+from hypothesis.strategies import integers
+from data.tfrecord_utils import ShardedTFRecordWriter, read_shard_index, shard_files, shard_index_filename, \
+    read_tfrecord_at
+
+
+class ShardedTFRecordTest(tf.test.TestCase):
+
+    @given(shard_size=integers(1, 12))
+    @settings(max_examples=5, timeout=unlimited)
+    def test_sharded_writer(self, shard_size):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        records = [next(tf.python_io.tf_record_iterator(f)) for f in source_files]
+
+        out_dir = tempfile.mkdtemp()
+        with ShardedTFRecordWriter(out_dir, "jsut-source", shard_size) as writer:
+            for i, record in enumerate(records):
+                writer.write(i + 1, record)
+
+        index = read_shard_index(os.path.join(out_dir, shard_index_filename("jsut-source")))
+        self.assertEqual(list(range(1, 11)), [entry.id for entry in index])
+        files = shard_files(index, out_dir)
+        self.assertEqual((len(records) + shard_size - 1) // shard_size, len(files))
+
+        # random access through the index
+        for entry, record in zip(index, records):
+            self.assertEqual(len(record), entry.length)
+            self.assertEqual(record, read_tfrecord_at(os.path.join(out_dir, entry.filename), entry.offset))
+
+        # sequential access through tf.data
+        next_element = tf.data.TFRecordDataset(files).make_one_shot_iterator().get_next()
+        with self.test_session() as sess:
+            for record in records:
+                self.assertEqual(record, sess.run(next_element))
+
+    def test_rewrite_with_previous_index(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        source_files = [os.path.join(data_dir, "jsut-source-%05d.tfrecords" % i) for i in range(1, 11)]
+        records = [next(tf.python_io.tf_record_iterator(f)) for f in source_files]
+        index_path = lambda out_dir: os.path.join(out_dir, shard_index_filename("jsut-source"))
+
+        out_dir = tempfile.mkdtemp()
+        with ShardedTFRecordWriter(out_dir, "jsut-source", 4) as writer:
+            for i, record in enumerate(records):
+                writer.write(i + 1, record)
+        previous_index = read_shard_index(index_path(out_dir))
+        previous_files = set(shard_files(previous_index, out_dir))
+
+        with ShardedTFRecordWriter(out_dir, "jsut-source", 4, previous_index) as writer:
+            for i, record in enumerate(records[:4]):
+                writer.write(i + 1, record)
+            self.assertEqual(4, writer.finished)
+            # the finished shard replaces the first records of the previous index, which stays readable
+            index = read_shard_index(index_path(out_dir))
+            self.assertEqual(list(range(1, 11)), [entry.id for entry in index])
+            self.assertTrue(previous_files.isdisjoint(shard_files(index[:4], out_dir)))
+            for entry, record in zip(index, records):
+                self.assertEqual(record, read_tfrecord_at(os.path.join(out_dir, entry.filename), entry.offset))
+            for i, record in enumerate(records[4:], start=4):
+                writer.write(i + 1, record)
+
+        index = read_shard_index(index_path(out_dir))
+        files = shard_files(index, out_dir)
+        self.assertTrue(previous_files.isdisjoint(files))
+        self.assertFalse(any(os.path.exists(f) for f in previous_files))
+        for entry, record in zip(index, records):
+            self.assertEqual(record, read_tfrecord_at(os.path.join(out_dir, entry.filename), entry.offset))
+
+
+if __name__ == '__main__':
+    tf.test.main()
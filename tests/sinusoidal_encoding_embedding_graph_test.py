@@ -39,5 +39,20 @@ class SinusoidalEncodingEmbeddingTest(tf.test.TestCase):
             x2x = sess.run(x2x)
             print(x2x)
 
+    @given(n_positions=integers(2, 512), dimension=integers(2, 128))
+    @settings(max_examples=10, timeout=unlimited)
+    def test_closed_form(self, n_positions, dimension):
+        assume(dimension % 2 == 0)
+
+        fixed = SinusoidalEncodingEmbedding(n_positions, dimension)
+        trainable = SinusoidalEncodingEmbedding(n_positions, dimension, trainable=True)
+        positions = tf.constant(np.random.randint(0, n_positions, size=(3, 7)))
+        with self.test_session() as sess:
+            x, y = fixed(positions, w=2.37), trainable(positions, w=2.37)
+            sess.run(tf.global_variables_initializer())
+            x, y = sess.run([x, y])
+            self.assertEqual((3, 7, dimension), x.shape)
+            self.assertAllClose(y, x, atol=1e-3)
+
 if __name__ == '__main__':
     tf.test.main()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import tensorflow as tf
+import numpy as np
+import os
+from data.tfrecord_utils import preprocessed_target_example, parse_preprocessed_target_data, \
+    decode_preprocessed_target_data, read_preprocessed_target_data, STORAGE_FORMATS, STORAGE_FLOAT32, \
+    STORAGE_FLOAT16, STORAGE_UINT8, STORAGE_UINT16
+
+
+class StorageFormatTest(tf.test.TestCase):
+
+    def test_dequantization(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        target = next(read_preprocessed_target_data(os.path.join(data_dir, "jsut-target-00001.tfrecords")))
+        tolerances = {
+            STORAGE_FLOAT32: 0.0,
+            STORAGE_FLOAT16: 1e-3,
+            STORAGE_UINT8: 0.5 / 255 + 1e-6,
+            STORAGE_UINT16: 0.5 / 65535 + 1e-6,
+        }
+
+        serialized = tf.placeholder(tf.string, shape=())
+        decoded = decode_preprocessed_target_data(parse_preprocessed_target_data(serialized))
+        with self.test_session() as sess:
+            for storage_format in STORAGE_FORMATS:
+                example = preprocessed_target_example(target.id, target.spec, target.mel, storage_format)
+                d = sess.run(decoded, feed_dict={serialized: example.SerializeToString()})
+                self.assertEqual(target.target_length, d.target_length)
+                self.assertEqual(np.float32, d.mel.dtype)
+                self.assertAllClose(target.mel, d.mel, rtol=0, atol=tolerances[storage_format])
+                self.assertAllClose(target.spec, d.spec, rtol=0, atol=tolerances[storage_format])
+
+    def test_records_without_storage_format(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+        filename = os.path.join(data_dir, "jsut-target-00001.tfrecords")
+        target = next(read_preprocessed_target_data(filename))
+        decoded = tf.data.TFRecordDataset([filename]).map(
+            lambda d: decode_preprocessed_target_data(parse_preprocessed_target_data(d)))
+        with self.test_session() as sess:
+            d = sess.run(decoded.make_one_shot_iterator().get_next())
+            self.assertAllEqual(target.mel, d.mel)
+            self.assertAllEqual(target.spec, d.spec)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,49 @@
+import tensorflow as tf
+import numpy as np
+import os
+import tempfile
+from matplotlib import image
+from deepvoice3_tensorflow.result_log import ResultLogWriter
+from deepvoice3_tensorflow.visualization import result_tasks, render_results, alignment_image, write_png, \
+    parse_result_filename, result_source_name
+
+
+def render_shape(result, filename):
+    np.save(filename, np.array(result.alignments[0].shape))
+
+
+class VisualizationTest(tf.test.TestCase):
+
+    def test_result_tasks(self):
+        random = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as log_dir:
+            with ResultLogWriter(log_dir, "train_results") as writer:
+                for step in range(0, 50, 10):
+                    writer.write(step, [1, 2], [b"a", b"b"], random.uniform(size=(2, 30, 80)),
+                                 random.uniform(size=(2, 30, 80)), [random.uniform(size=(2, 30, 12))])
+            open(os.path.join(log_dir, "train_result_step000000020_3,4.tfrecord"), 'w').close()
+            open(os.path.join(log_dir, "train_result_step000000100_2.tfrecord"), 'w').close()
+
+            self.assertEqual((100, [2]), parse_result_filename("train_result_step000000100_2.tfrecord"))
+            self.assertEqual("train", result_source_name("train_result_step000000100_2.tfrecord"))
+            self.assertEqual("eval_results", result_source_name(os.path.join(log_dir, "eval_results-index.jsonl")))
+            tasks = result_tasks(log_dir, min_step=10, max_step=30, ids={2}, entries_per_task=2)
+            # the TFRecords are skipped by the step and the ids in their names
+            self.assertEqual([[10, 20], [30]], [[e["step"] for e in entries] for _, entries in tasks])
+
+            outputs = list(render_results(tasks, None, render_shape, log_dir, "shape_", num_workers=2))
+            self.assertEqual(3, len(outputs))
+            self.assertEqual({"shape_train_results_step000000010_2.png", "shape_train_results_step000000020_2.png",
+                              "shape_train_results_step000000030_2.png"}, {os.path.basename(o) for o in outputs})
+            for output in outputs:
+                self.assertAllEqual([12, 30], np.load(output + ".npy"))
+
+    def test_write_png(self):
+        alignments = [np.random.uniform(size=(12, 30)).astype(np.float32),
+                      np.random.uniform(size=(5, 20)).astype(np.float32)]
+        with tempfile.TemporaryDirectory() as out_dir:
+            filename = os.path.join(out_dir, "alignment.png")
+            expected = alignment_image(alignments)
+            self.assertEqual((12 + 2 + 5, 30, 3), expected.shape)
+            write_png(expected, filename)
+            self.assertAllClose(expected / 255.0, image.imread(filename)[:, :, :3], atol=1e-6)
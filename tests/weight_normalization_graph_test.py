@@ -1,10 +1,13 @@
 import tensorflow as tf
 import numpy as np
 import uuid
+import tempfile
 from hypothesis import given, assume, settings, unlimited
 from hypothesis.strategies import integers
 from hypothesis.extra.numpy import arrays
-from deepvoice3_tensorflow.weight_normalization import weight_normalization, WeightNormalization
+from deepvoice3_tensorflow.weight_normalization import weight_normalization, WeightNormalization, fold, \
+    fold_checkpoint, folded_weight_normalization
+from deepvoice3_tensorflow.modules import Linear, Conv1d
 
 
 class WeightNormalizationTest(tf.test.TestCase):
@@ -78,4 +81,54 @@ class WeightNormalizationTest(tf.test.TestCase):
             v_norm = np.linalg.norm(v, axis=(1, 2))
             # \nabla_g L = \sum_{i,j}\frac{\partial L}{\partial w_{ij}}\nabla_g w_{i,j}
             self.assertAllClose(grad_g_value[0],
-                                np.sum(grad_w_original_value[0] * v, axis=(1,2)) / v_norm)
\ No newline at end of file
+                                np.sum(grad_w_original_value[0] * v, axis=(1,2)) / v_norm)
+
+    def test_fold(self):
+        _weight = np.random.normal(size=[3, 4, 5]).astype(np.float32)
+        weight = tf.Variable(_weight, trainable=False)
+        wn = WeightNormalization(weight, dimension=0)
+        normalized_weight = wn.apply(weight)
+        assign_g = tf.assign(wn.g, tf.constant([0.5, 1.0, 2.0]))
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(assign_g)
+            g, v, nw = sess.run([wn.g, wn.v, normalized_weight])
+            self.assertAllClose(nw, fold(g, v))
+
+    def test_fold_checkpoint(self):
+        model_dir = tempfile.mkdtemp()
+        output_dir = tempfile.mkdtemp()
+        input = np.random.normal(size=[2, 7, 4]).astype(np.float32)
+
+        def build(folded):
+            with folded_weight_normalization(folded):
+                linear = Linear(4, 6, name="linear")
+                conv = Conv1d(6, 5, 3, 2, None, is_incremental=False, is_training=False, normalize_weight=True,
+                              name="conv")
+                return conv(linear(tf.constant(input)))
+
+        with tf.Graph().as_default():
+            output = build(folded=False)
+            global_step = tf.train.get_or_create_global_step()
+            g = [v for v in tf.global_variables() if v.op.name.endswith("/g")]
+            # move g away from its initial value so that folding is not an identity
+            assign_g = [tf.assign(v, v * 1.5) for v in g]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(assign_g)
+                expected = sess.run(output)
+                checkpoint_path = tf.train.Saver().save(sess, model_dir + "/model.ckpt", global_step=global_step)
+
+        folded_checkpoint_path = fold_checkpoint(checkpoint_path, output_dir)
+        reader = tf.train.NewCheckpointReader(folded_checkpoint_path)
+        names = reader.get_variable_to_shape_map()
+        self.assertFalse(any(name.endswith("/g") or name.endswith("/v") for name in names))
+        self.assertEqual(2, len([name for name in names if name.endswith("/w")]))
+
+        with tf.Graph().as_default():
+            output = build(folded=True)
+            self.assertFalse(any(v.op.name.endswith("/g") for v in tf.global_variables()))
+            with tf.Session() as sess:
+                tf.train.Saver().restore(sess, folded_checkpoint_path)
+                self.assertAllClose(expected, sess.run(output), atol=1e-5)
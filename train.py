@@ -12,44 +12,29 @@ options:
     --checkpoint-postnet=<path>  Restore postnet model from checkpoint path.
     --train-seq2seq-only         Train only seq2seq model.
     --train-postnet-only         Train only postnet model.
+    --materialize                Pad and downsample targets once into a cache keyed by hparams and train from it.
+    --cache-dir=<dir>            Cache prepared utterances in a file keyed by input files and hparams.
+    --cache-in-memory            Cache prepared utterances in memory after the first epoch.
     -h, --help                   Show this help message and exit
 """
 
 from docopt import docopt
 import tensorflow as tf
 import importlib
-from deepvoice3_tensorflow.frontend import Frontend
+from deepvoice3_tensorflow.frontend import TRAIN_SEQ2SEQ, TRAIN_POSTNET, BATCH_BUDGET
+from deepvoice3_tensorflow.frontend.pipeline import train_frontend, train_stages, apply_stages, \
+    materialized_train_targets, train_cache_filename
+from deepvoice3_tensorflow.frontend.cache import remove_stale_lock
+from deepvoice3_tensorflow.frontend.bucketing import bucket_boundaries_from_metadata, read_lengths, \
+    padding_efficiency, padding_efficiency_string, budget_batch_sizes
 from deepvoice3_tensorflow.models import SingleSpeakerTTSModel
 from hparams import hparams, hparams_debug_string
 
-def train(hparams, model_dir, source_files, target_files):
+def train(hparams, model_dir, source_files, target_files, target_store=None, spec_files=None,
+          materialized_dir=None, bucket_boundaries=None, cache_filename=None):
     def train_input_fn():
-        source = tf.data.TFRecordDataset(list(source_files))
-        target = tf.data.TFRecordDataset(list(target_files))
-
-        frontend = Frontend(source, target, hparams)
-        batched = frontend.prepare(
-
-        ).zip_source_and_target(
-
-        ).repeat(
-
-        ).shuffle(
-            buffer_size=hparams.batch_size*10
-        ).group_by_batch(
-
-        ).swap_source_random(
-            swap_probability=hparams.replace_pronunciation_prob
-        ).add_memory_mask(
-
-        ).add_frame_positions(
-
-        ).add_target_mask(
-
-        ).downsample_mel(
-
-        ).dataset
-        return batched
+        frontend = train_frontend(source_files, target_files, hparams, target_store, spec_files, materialized_dir)
+        return apply_stages(frontend, train_stages(hparams, bucket_boundaries, cache_filename))
 
     run_config = tf.estimator.RunConfig(save_summary_steps=hparams.save_summary_steps, log_step_count_steps=hparams.log_step_count_steps)
     estimator = SingleSpeakerTTSModel(hparams, model_dir, config=run_config)
@@ -69,10 +54,48 @@ def main():
     dataset_instance = dataset.instantiate(in_dir="", out_dir=data_root)
 
     hparams.parse(args["--hparams"])
+    if args["--train-seq2seq-only"]:
+        hparams.train_mode = TRAIN_SEQ2SEQ
+    if args["--train-postnet-only"]:
+        hparams.train_mode = TRAIN_POSTNET
     print(hparams_debug_string())
 
     tf.logging.set_verbosity(tf.logging.INFO)
-    train(hparams, checkpoint_dir, dataset_instance.source_files, dataset_instance.target_files)
+    source_files = list(dataset_instance.source_files)
+    target_files = list(dataset_instance.target_files)
+    target_store = dataset_instance.packed_target_store
+    spec_files = dataset_instance.spec_files
+    spec_files = None if spec_files is None else list(spec_files)
+    materialized_dir = None
+    if args["--materialize"]:
+        materialized_dir = materialized_train_targets(data_root, source_files, target_files, hparams, target_store,
+                                                      spec_files)
+    bucket_boundaries = None
+    if hparams.bucket_by_metadata:
+        bucket_boundaries = bucket_boundaries_from_metadata(data_root, hparams)
+        _, target_lengths, source_lengths = read_lengths(data_root)
+        # Frontend adds outputs_per_step frames to targets before bucketing
+        batch_size = hparams.batch_size
+        if hparams.batch_mode == BATCH_BUDGET:
+            batch_size = budget_batch_sizes(bucket_boundaries, hparams.batch_max_frames,
+                                            hparams.batch_max_source_tokens, hparams.max_target_length,
+                                            hparams.max_source_length, hparams.outputs_per_step,
+                                            hparams.downsample_step)
+            tf.logging.info("Batch sizes per bucket: %s" % (batch_size,))
+        reports, total = padding_efficiency(target_lengths + hparams.outputs_per_step, source_lengths,
+                                            bucket_boundaries, batch_size)
+        tf.logging.info("Bucket boundaries: %s" % (bucket_boundaries,))
+        tf.logging.info("Padding efficiency per bucket:\n" + padding_efficiency_string(reports, total))
+    cache_filename = None
+    if args["--cache-in-memory"]:
+        cache_filename = ""
+    elif args["--cache-dir"]:
+        cache_filename = train_cache_filename(args["--cache-dir"], source_files, target_files, hparams, target_store,
+                                              spec_files, materialized_dir)
+        remove_stale_lock(cache_filename)
+        tf.logging.info("Caching prepared utterances at %s" % cache_filename)
+    train(hparams, checkpoint_dir, source_files, target_files, target_store, spec_files, materialized_dir,
+          bucket_boundaries, cache_filename)
 
 
 if __name__ == '__main__':
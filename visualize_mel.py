@@ -2,26 +2,31 @@
 """
 usage: visualize_mel.py [options] <filename>
 
+<filename> is a result TFRecord or the index (*-index.jsonl) of a result log.
+If it is a directory or a glob, all result files in it are rendered in parallel.
+
 options:
     --output-prefix=<prefix>        output filename prefix
+    --step=<step>                   only results of this step
+    --id=<ids>                      only results of these comma separated ids
+    --min-step=<step>               only results of this step or later in bulk mode
+    --max-step=<step>               only results of this step or earlier in bulk mode
+    --output-dir=<dir>              output directory in bulk mode, the directory of <filename> by default
+    --num-workers=<n>               number of processes in bulk mode, the number of CPUs by default
 
 """
 from docopt import docopt
 import numpy as np
 import tensorflow as tf
-from collections import namedtuple
+from deepvoice3_tensorflow.result_log import TrainingResult, ResultLog
+from deepvoice3_tensorflow.visualization import result_tasks, render_results
 import matplotlib
 import os
+import glob
 
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
-class TrainingResult(
-    namedtuple("TrainingResult",
-               ["global_step", "id", "text", "predicted_mel", "ground_truth_mel", "alignments"])):
-    pass
-
-
 def read_training_result(filename):
     record_iterator = tf.python_io.tf_record_iterator(filename)
     for string_record in record_iterator:
@@ -59,6 +64,21 @@ def read_training_result(filename):
             )
 
 
+def read_result_log(filename, step=None, ids=None):
+    '''
+    Decodes only the results of a result log that match step and ids.
+    '''
+    log = ResultLog.from_index_filename(filename)
+    for entry in log.entries(min_step=step, max_step=step, ids=ids):
+        yield log.read(entry)
+
+
+def read_results(filename, step=None, ids=None):
+    if ResultLog.is_index_filename(filename):
+        return read_result_log(filename, step, ids)
+    return read_training_result(filename)
+
+
 def plot_mel(mel, mel_predicted, filename):
     from matplotlib import pylab as plt
     fig = plt.figure(figsize=(16, 10))
@@ -73,13 +93,33 @@ def plot_mel(mel, mel_predicted, filename):
     plt.close()
 
 
+def render_mel(result, filename):
+    plot_mel(result.ground_truth_mel, result.predicted_mel, filename)
+
+
 if __name__ == "__main__":
     args = docopt(__doc__)
     filename = args["<filename>"]
     prefix = args["--output-prefix"] or "mel_"
-    output_base_filename, _ = os.path.splitext(os.path.basename(filename))
-    output_dir = os.path.dirname(filename)
-    output_filename = prefix + output_base_filename + "_{}.png"
+    step = int(args["--step"]) if args["--step"] else None
+    ids = {int(i) for i in args["--id"].split(",")} if args["--id"] else None
+    render = render_mel
+
+    if os.path.isdir(filename) or glob.escape(filename) != filename:
+        min_step = step if step is not None else (int(args["--min-step"]) if args["--min-step"] else None)
+        max_step = step if step is not None else (int(args["--max-step"]) if args["--max-step"] else None)
+        output_dir = args["--output-dir"] or (filename if os.path.isdir(filename) else os.path.dirname(filename))
+        num_workers = int(args["--num-workers"]) if args["--num-workers"] else None
+        tasks = result_tasks(filename, min_step, max_step, ids)
+        for output in render_results(tasks, read_training_result, render, output_dir, prefix, min_step, max_step,
+                                     ids, num_workers):
+            print(output)
+    else:
+        output_base_filename, _ = os.path.splitext(os.path.basename(filename))
+        output_dir = os.path.dirname(filename)
+        output_filename = prefix + output_base_filename + "_{}.png"
 
-    for result in read_training_result(filename):
-        plot_mel(result.ground_truth_mel, result.predicted_mel, os.path.join(output_dir, output_filename).format(result.id))
\ No newline at end of file
+        for result in read_results(filename, step, ids):
+            result_filename = prefix + output_base_filename + "_{}_{}.png".format(result.global_step, result.id) \
+                if ResultLog.is_index_filename(filename) else output_filename.format(result.id)
+            render(result, os.path.join(output_dir, result_filename))